@@ -0,0 +1,39 @@
+"""Per-message cost of the message ciphers: legacy AES-CBC vs. AES-GCM with a cached key object.
+
+Run from the project root:  python benchmarks/bench_crypto.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from server.crypto_utils import (
+    generate_aes_key, encrypt_aes, decrypt_aes, encrypt_aes_cbc, decrypt_aes_cbc
+)
+
+SIZES = (32, 256, 1024, 4096, 16384)   # Message sizes in characters
+NUMBER = 5000
+
+def per_call_us(fn):
+    return min(timeit.repeat(fn, number=NUMBER, repeat=3)) / NUMBER * 1e6
+
+def main():
+    key = generate_aes_key()
+    print(f"{'size':>6} {'cbc enc':>10} {'gcm enc':>10} {'cbc dec':>10} {'gcm dec':>10}   (us/message)")
+
+    for size in SIZES:
+        message = "12:00:00|" + "x" * size
+        cbc_ct = encrypt_aes_cbc(key, message)
+        gcm_ct = encrypt_aes(key, message)
+        assert decrypt_aes(key, cbc_ct) == decrypt_aes(key, gcm_ct) == message
+
+        results = (
+            per_call_us(lambda: encrypt_aes_cbc(key, message)),
+            per_call_us(lambda: encrypt_aes(key, message)),
+            per_call_us(lambda: decrypt_aes_cbc(key, cbc_ct)),
+            per_call_us(lambda: decrypt_aes(key, gcm_ct)),
+        )
+        print(f"{size:>6} " + " ".join(f"{r:>10.2f}" for r in results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Log throughput: one INSERT + commit per call vs. the batched background writer.
+
+Run from the project root:  python benchmarks/bench_db_logger.py [rows]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from logs.db_logger import BatchLogWriter
+
+def make_row(i):
+    return (time.time_ns() // 1_000_000, "server", "global_msg", f"sid{i % 50}", f"user{i % 50}",
+            f"[GLOBAL] From user{i % 50}: message {i}")
+
+def make_v1_row(i):
+    # Row of the original free-text schema
+    return ("server", "global_msg", f"[GLOBAL] From user{i % 50}: message {i}",
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+def bench_sync(db_path, rows):
+    # The previous db_logger: global lock, one INSERT and one commit per event
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("""CREATE TABLE IF NOT EXISTS logs (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    role TEXT NOT NULL, source TEXT NOT NULL, event TEXT NOT NULL, timestamp TEXT NOT NULL)""")
+    conn.commit()
+    lock = threading.Lock()
+    cursor = conn.cursor()
+
+    start = time.perf_counter()
+    for i in range(rows):
+        with lock:
+            cursor.execute("INSERT INTO logs (role, source, event, timestamp) VALUES (?, ?, ?, ?)", make_v1_row(i))
+            conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed, elapsed
+
+def bench_batched(db_path, rows):
+    writer = BatchLogWriter(db_path=db_path, max_queue=rows + 1)
+
+    start = time.perf_counter()
+    for i in range(rows):
+        writer.put(make_row(i))
+    enqueue = time.perf_counter() - start
+    writer.flush()
+    total = time.perf_counter() - start
+    writer.close()
+    return enqueue, total
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    print(f"Logging {rows} rows\n")
+    print(f"{'mode':<10}{'caller time':>14}{'caller rows/s':>16}{'until on disk':>16}{'disk rows/s':>14}")
+
+    for name, bench in (("sync", bench_sync), ("batched", bench_batched)):
+        with tempfile.TemporaryDirectory() as tmp:
+            caller, total = bench(os.path.join(tmp, "bench_logs.db"), rows)
+        print(f"{name:<10}{caller:>13.3f}s{rows / caller:>16.0f}{total:>15.3f}s{rows / total:>14.0f}")
+
+if __name__ == "__main__":
+    main()
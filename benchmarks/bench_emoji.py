@@ -0,0 +1,49 @@
+"""Emoji shortcode expansion per outgoing message: the str.replace loop vs. the single-pass expander.
+
+The loop is timed over the hand-picked EMOJI_DICT it used to run on, and over
+the full shortcode table it would have to run on now.
+
+Run from the project root:  python benchmarks/bench_emoji.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'client')))
+from emoji_dict import EMOJI_DICT, EMOJI_TABLE, expand_emoji
+
+MESSAGES = {
+    "plain": "see you at the library after lunch, bring the notes",
+    "emoji": "great job :thumbsup: :tada: see you at 5 :)",
+    "colons": "ratio 3:2, times 10:30 and 11:45, note: bring :coffee: <3",
+    "long": "lorem ipsum dolor sit amet :smile: " * 60,
+}
+NUMBER = 200
+
+def replace_loop(table):
+    # The previous send_message: one str.replace per table entry
+    def expand(message):
+        for code, emoji in table.items():
+            message = message.replace(code, emoji)
+        return message
+    return expand
+
+def per_call_us(fn, message):
+    return min(timeit.repeat(lambda: fn(message), number=NUMBER, repeat=3)) / NUMBER * 1e6
+
+def main():
+    loop_small, loop_full = replace_loop(EMOJI_DICT), replace_loop(EMOJI_TABLE)
+    print(f"{len(EMOJI_DICT)} hand-picked entries, {len(EMOJI_TABLE)} in the full table\n")
+    print(f"{'message':<8}{'chars':>7}{'loop (dict)':>14}{'loop (table)':>15}{'expander':>11}   (us/message)")
+
+    for name, message in MESSAGES.items():
+        assert expand_emoji(message) == loop_small(message)  # Same result on the old entries
+        results = (
+            per_call_us(loop_small, message),
+            per_call_us(loop_full, message),
+            per_call_us(expand_emoji, message),
+        )
+        print(f"{name:<8}{len(message):>7}" + "".join(f"{r:>{w}.2f}" for r, w in zip(results, (14, 15, 11))))
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,6 @@
+import os
+import re
+
 EMOJI_DICT = {
     ":smile:": "😄",
     ":laughing:": "😆",
@@ -69,3 +72,78 @@ EMOJI_DICT = {
     "^^'": "😅",
 
 }
+
+EMOJI_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emoji_shortcodes.tsv")
+
+
+def load_emoji_table(path=EMOJI_DATA_FILE):
+    """':shortcode:' -> emoji from a tab separated data file, plus EMOJI_DICT (which wins)."""
+    table = {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                code, _, emoji = line.partition("\t")
+                if emoji:
+                    table[code] = emoji
+    except OSError:
+        pass  # Without the data file only EMOJI_DICT is available
+    table.update(EMOJI_DICT)
+    return table
+
+
+class EmojiExpander:
+    """Replaces shortcodes and emoticons in one left-to-right pass over the text.
+
+    Shortcodes (':name:') are looked up in a dict, so the table can hold
+    thousands of them at no cost per message. Emoticons (':)', '<3', ...) are
+    one precompiled alternation, longest first, so '>:(' wins over ':('.
+    A message without any candidate costs a single regex search.
+    """
+
+    def __init__(self, table):
+        self.shortcodes = {code: emoji for code, emoji in table.items() if is_shortcode(code)}
+        self.emoticons = {code: emoji for code, emoji in table.items() if not is_shortcode(code)}
+        emoticon_alternation = "|".join(re.escape(code) for code in sorted(self.emoticons, key=len, reverse=True))
+        # ':name' followed by ':' is a shortcode candidate; the closing colon is not consumed,
+        # so an unknown ':word:' leaves it free to open the next shortcode
+        self._candidate = re.compile(r":[^:\s]+(?=:)" + (f"|{emoticon_alternation}" if emoticon_alternation else ""))
+        self._emoticon = re.compile(emoticon_alternation) if emoticon_alternation else None
+
+    def __call__(self, text):
+        parts, last, pos = [], 0, 0
+        while True:
+            match = self._candidate.search(text, pos)
+            if match is None:
+                break
+            start, end = match.span()
+            replacement = None
+            if text[start] == ":" and end < len(text) and text[end] == ":":
+                replacement = self.shortcodes.get(text[start:end + 1])
+                if replacement is not None:
+                    end += 1
+            if replacement is None:
+                # Not a known shortcode: an emoticon may still start here (':D' in ':Dog:')
+                emoticon = self._emoticon.match(text, start) if self._emoticon else None
+                if emoticon is None:
+                    pos = start + 1
+                    continue
+                end = emoticon.end()
+                replacement = self.emoticons[emoticon.group()]
+            parts.append(text[last:start])
+            parts.append(replacement)
+            last = pos = end
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return "".join(parts)
+
+
+def is_shortcode(code):
+    return len(code) > 2 and code[0] == ":" and code[-1] == ":" and ":" not in code[1:-1]
+
+
+EMOJI_TABLE = load_emoji_table()
+expand_emoji = EmojiExpander(EMOJI_TABLE)
@@ -4,16 +4,18 @@ import base64
 import threading
 import socketio
 import sys
-import time
 import math
 import hashlib
-from queue import Queue
+from queue import Queue, Empty
+from collections import deque
 
 import tkinter as tk
 from tkinter import filedialog, messagebox, scrolledtext, ttk
 from tkinter.ttk import Progressbar
 from datetime import datetime
-from emoji_dict import EMOJI_DICT
+from emoji_dict import EMOJI_TABLE, expand_emoji
+from upload_window import UploadWindow
+from transfers import TransferManager, UPLOAD, DOWNLOAD, QUEUED, VERIFYING, DONE, FAILED, CANCELLED
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from logs.db_logger import log_event
@@ -22,6 +24,7 @@ from server.crypto_utils import (
     load_rsa_public_key, encrypt_rsa, generate_aes_key,
     encrypt_aes, decrypt_aes
 )
+from server.partial_uploads import RangeFile, range_tree_root
 
 # Load server private key
 public_key = load_rsa_public_key("public_key.pem")
@@ -29,6 +32,20 @@ public_key = load_rsa_public_key("public_key.pem")
 FONT = "Georgia"
 SERVER_API_URL = "http://localhost:8080"
 CHUNK_SIZE = 49152 # 48KB
+GROUP_KEY_EPOCHS = 3 # Recent group keys kept for messages still in flight after a rekey
+CHUNK_RETRIES = 3 # Resends of a single chunk the server rejected before giving up
+RANGE_SIZE = CHUNK_SIZE * 16 # Unit of parallel transfer and of the range hash tree (768KB)
+UPLOAD_STREAMS = 4 # Ranges uploaded concurrently
+DOWNLOAD_STREAMS = 4 # Ranges the server is asked to send concurrently
+HISTORY_PAGE_SIZE = 50 # Older messages fetched each time the chat box is scrolled to the top
+SEARCH_PAGE_SIZE = 20 # Search results fetched per "More results" click
+EMOJI_SEARCH_LIMIT = 100 # Matches listed by the emoji search; the full table has thousands
+PRESENCE_NAMES_SHOWN = 3 # Names spelled out in a join/leave summary before "and N others"
+SCROLLBACK_LINES = 1000 # Lines kept in the chat box; older ones are evicted to the scrollback cache
+SCROLLBACK_SLACK = 100 # Lines allowed over SCROLLBACK_LINES before evicting, so eviction runs in batches
+SCROLLBACK_CACHE = 5000 # Evicted entries kept to restore on scroll-up; older ones are refetched from the server
+UI_FRAME_MS = 16 # The Tk thread applies queued UI updates once per frame (~60 per second)
+UPLOAD_CONFIRM_MS = 2000 # An upload counts as delivered this long after finish_upload unless the server asks for a retry
 
 is_connecting = False
 connection_failed = False
@@ -40,6 +57,44 @@ def center_window(window, width, height):
     y = (screen_height // 2) - (height // 2)
     window.geometry(f'{width}x{height}+{x}+{y - 10}')
 
+def hash_ranges(path, range_size):
+    # SHA-256 of the whole file plus one per range_size bytes, in a single read
+    hash_algo = hashlib.sha256()
+    range_hashes = []
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(range_size), b""):
+            hash_algo.update(block)
+            range_hashes.append(hashlib.sha256(block).hexdigest())
+    return hash_algo.hexdigest(), range_hashes
+
+def summarize_names(names):
+    # "alice", "alice and bob", "alice, bob, carol and 5 others"
+    if len(names) <= PRESENCE_NAMES_SHOWN:
+        return " and ".join([", ".join(names[:-1]), names[-1]]) if len(names) > 1 else names[0]
+    others = len(names) - PRESENCE_NAMES_SHOWN
+    return f"{', '.join(names[:PRESENCE_NAMES_SHOWN])} and {others} other{'s' if others > 1 else ''}"
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+def transfer_status(transfer):
+    # "Waiting...", "1.2 MB/s, 0:14 left", "Verifying..."
+    if transfer.state == QUEUED:
+        return "Waiting..."
+    if transfer.state == VERIFYING:
+        return "Verifying..."
+    rate = transfer.rate()
+    if not rate:
+        return "Starting..."
+    eta = transfer.eta()
+    if eta is None:
+        return f"{format_bytes(rate)}/s"
+    return f"{format_bytes(rate)}/s, {int(eta // 60)}:{int(eta % 60):02d} left"
+
 def setup_window(window, title, width, height):
     window.title(title)
     window.resizable(True, True)  # Allow window to be resizable
@@ -53,17 +108,31 @@ class ChatClientGUI:
 
         self.emoji_window = None
         self.username = None
-        self.active_users = []
+        self.active_users = []   # Join order; the Listbox shows it newest first
+        self.roster_seq = None   # Sequence number of the last roster delta applied
+        self.roster_resyncing = False
+        self.group_keys = {}  # epoch -> group key, only used when the server runs broadcast mode
+        self.message_ids = set()       # Server ids of messages already in the chat box
+        self.oldest_message_id = None  # Older history is fetched before this id
+        self.history_loading = False
+        self.history_exhausted = False
+        self.chat_entries = deque()   # What the chat box shows, oldest first (see chat_entry)
+        self.chat_lines = 0           # Lines those entries take up
+        self.scrollback_cache = deque(maxlen=SCROLLBACK_CACHE)  # Evicted entries, oldest first
+        self.pending_entries = []     # Appended since the last frame, rendered by flush_chat
+        
+        # Tk is only touched from its own thread: Socket.IO and worker threads queue their updates
+        self.ui_queue = Queue()
+        self.Window.after(UI_FRAME_MS, self.pump_ui)
         
         # setup the socket client
         self.sio = socketio.Client()
         self.setup_socketio()
         # self.connect_to_server()
         
-        # set up file transfer
-        self.download_files = {}
-        self.progress_n_index = {}
-        self.upload_confirmation = {}
+        # set up file transfer: progress and state changes are shown with the next UI frame
+        self.transfers = TransferManager(on_progress=lambda transfer: self.ui(self.show_transfer_progress, transfer),
+                                         on_state=lambda transfer: self.ui(self.show_transfer_state, transfer))
         
         self.login_screen()
         self.Window.mainloop()
@@ -91,43 +160,75 @@ class ChatClientGUI:
         @self.sio.event
         def user_joined(data):
             username = data.get("username", "Unknown")
-            usernames = data.get("usernames", [])
-            self.active_users = usernames
+            self.ui(self.apply_roster_update, data)
 
             # Check if chat_box exists
             if not hasattr(self, 'chat_box') or self.chat_box is None: 
                 return
             
-            self.display_system_message(f"{username} has joined the chat.")
-            self.update_user_list(usernames[::-1])
+            self.ui(self.display_system_message, f"{username} has joined the chat.")
 
         @self.sio.event
         def user_left(data):
             username = data.get("username", "Unknown")
-            usernames = data.get("usernames", [])
-            self.active_users = usernames
-            self.update_user_list(usernames[::-1])
-            self.display_system_message(f"{username} has left the chat.")
+            self.ui(self.apply_roster_update, data)
+            self.ui(self.display_system_message, f"{username} has left the chat.")
+
+        @self.sio.event
+        def presence(data):
+            # Batched joins/leaves: one roster update and at most two lines in the chat
+            self.ui(self.apply_roster_update, data)
+            if not hasattr(self, 'chat_box') or self.chat_box is None:
+                return
+            if data.get('added'):
+                self.ui(self.display_system_message, f"{summarize_names(data['added'])} {'has' if len(data['added']) == 1 else 'have'} joined the chat.")
+            if data.get('removed'):
+                self.ui(self.display_system_message, f"{summarize_names(data['removed'])} {'has' if len(data['removed']) == 1 else 'have'} left the chat.")
 
         @self.sio.event
         def disconnect():
             print("Disconnected from server.")
             log_event("client", "disconnect", "Disconnected from server.")
-            self.display_system_message("Disconnected from server. Exitting...")
-            self.Window.attributes("-disabled", True)
-            self.Window.after(5000, self.force_exit)
+            self.ui(self.display_system_message, "Disconnected from server. Exitting...")
+            self.ui(self.Window.attributes, "-disabled", True)
+            self.ui(self.Window.after, 5000, self.force_exit)
+
+        @self.sio.event
+        def join_rejected(data):
+            # Another server of the cluster gave the username away first
+            reason = data.get("reason", "Username is already in use.")
+            log_event("client", "join_rejected", f"Join as {data.get('username')} rejected: {reason}")
+            self.ui(self.display_system_message, f"Could not join: {reason} Please restart and choose another username.")
+            self.ui(self.Window.after, 5000, self.force_exit)
+
+        @self.sio.event
+        def group_key(data):
+            # Server-side broadcast mode: shared key wrapped in our session key
+            try:
+                epoch = data.get("epoch")
+                key_b64 = decrypt_aes(self.session_aes_key, data.get("key", ""))
+                self.group_keys[epoch] = base64.b64decode(key_b64)
+                for old_epoch in sorted(self.group_keys)[:-GROUP_KEY_EPOCHS]:
+                    self.group_keys.pop(old_epoch, None)
+            except Exception as e:
+                log_event("client", "group_key_error", f"Failed to unwrap group key: {e}")
 
         @self.sio.event
         def incoming_global_message(data):
             sender = data.get("sender", "Unknown")
             try:
                 # decrypted = decrypt_message(data.get("message", ""))
-                decrypted = decrypt_aes(self.session_aes_key, data.get("message", ""))
+                if "epoch" in data:
+                    # Broadcast envelope: encrypted once under the group key
+                    decrypted = decrypt_aes(self.group_keys[data["epoch"]], data.get("message", ""))
+                else:
+                    decrypted = decrypt_aes(self.session_aes_key, data.get("message", ""))
 
                 timestamp, message = decrypted.split("|", 1)
-                self.display_message("Global", sender, message, timestamp)
+                self.ui(self.note_message_id, data.get("id"))
+                self.ui(self.display_message, "Global", sender, message, timestamp, data.get("id"))
             except Exception as e:
-                self.display_system_message(f"Failed to decrypt global message from {sender}")
+                self.ui(self.display_system_message, f"Failed to decrypt global message from {sender}")
 
         @self.sio.event
         def incoming_private_message(data):
@@ -136,11 +237,12 @@ class ChatClientGUI:
                 # decrypted = decrypt_message(data.get("message", ""))
                 decrypted = decrypt_aes(self.session_aes_key, data.get("message", ""))
                 timestamp, message = decrypted.split("|", 1)
+                self.ui(self.note_message_id, data.get("id"))
                 # self.display_message("Private", sender, message, timestamp)
-                self.display_message("Private", f"From {sender}", message, timestamp)
+                self.ui(self.display_message, "Private", f"From {sender}", message, timestamp, data.get("id"))
 
             except Exception as e:
-                self.display_system_message(f"Failed to decrypt private message from {sender}")
+                self.ui(self.display_system_message, f"Failed to decrypt private message from {sender}")
         
         @self.sio.event
         def incoming_global_file(data):
@@ -153,7 +255,7 @@ class ChatClientGUI:
                 # self.display_download_button(filename)
                 pass
             else:
-                self.receive_file("Global", f"From {sender}", filename, timestamp)
+                self.ui(self.receive_file, "Global", f"From {sender}", filename, timestamp)
         
         @self.sio.event
         def incoming_private_file(data):
@@ -161,52 +263,50 @@ class ChatClientGUI:
             filename = data.get("filename", "")
             timestamp = data.get("time", "")
             
-            self.receive_file("Private", f"From {sender}", filename, timestamp)
+            self.ui(self.receive_file, "Private", f"From {sender}", filename, timestamp)
         
         @self.sio.event
         def incoming_file_chunk(data):
             chunk_data = data.get("chunk_data")
             filename = data.get("filename", "")
+            offset = data.get("offset") # Chunks from parallel streams arrive out of order
             
-            if chunk_data:
-                self.download_files[filename]['queue'].put(chunk_data) # Append encoded data to queue
+            transfer = self.transfer_for(DOWNLOAD, data)
+            if chunk_data and transfer:
+                transfer.queue.put((offset, chunk_data)) # Append encoded data to queue
                         
         @self.sio.event
         def finish_download(data):
-            time.sleep(0.5)
-            filename = data.get("filename", "")
             server_hash = data.get("hash_file", "")
             
-            if filename in self.download_files:
-                computed_hash = self.download_files[filename]['computed_hash'].hexdigest()
-                saving_path = self.download_files[filename]['path']
-                
-                if computed_hash != server_hash:
-                    messagebox.showerror("Error", f"Failed to download file {filename} from server. Please download again.")
-                    log_event("client", "finish_download_failed", f"Hash mismatch for {filename}")
-                    
-                    # Delete the failed file
-                    if os.path.exists(saving_path):
-                        os.remove(saving_path)
-                        log_event("client", "delete_failed_download_file", f"Deleted corrupt file: {saving_path}")
-                else:
-                    self.download_files[filename]['queue'].put(None)
-                    self.display_system_message(f"File {filename} has been successfully downloaded.")
+            # Queue the hash behind the last chunk; the writer thread verifies once it is on disk
+            transfer = self.transfer_for(DOWNLOAD, data)
+            if transfer:
+                transfer.queue.put({'hash_file': server_hash})
         
         @self.sio.event
         def retry_sending(data):
-            filename = data.get("filename", "")
             sender = data.get("sender", "Unknown")
             
             if sender == self.username:
-                # Cancel success timer if it's still pending
-                if filename in self.upload_confirmation:
-                    self.root.after_cancel(self.upload_confirmation[filename])
-                    self.upload_confirmation.pop(filename, None)
-                
-                # Display the error
-                messagebox.showerror("Error", f"File upload to server failed for '{filename}'. Please try resending the file.")
-                self.error_upload(filename)
+                transfer = self.transfer_for(UPLOAD, data)
+                if transfer:
+                    self.ui(self.upload_failed, transfer)
+    
+    def transfer_for(self, kind, data):
+        # Servers that echo our transfer id name the transfer; older ones only give the filename
+        if data.get("transfer_id") is not None:
+            return self.transfers.get(data["transfer_id"])
+        return self.transfers.find(kind, data.get("filename", ""))
+    
+    def upload_failed(self, transfer):
+        # Cancel success timer if it's still pending
+        if transfer.timer:
+            self.Window.after_cancel(transfer.timer)
+        
+        # Display the error
+        if self.transfers.set_state(transfer, FAILED, "Rejected by the server"):
+            messagebox.showerror("Error", f"File upload to server failed for '{transfer.filename}'. Please try resending the file.")
     
     def connect_to_server(self):
         def connect():
@@ -221,15 +321,17 @@ class ChatClientGUI:
     def update_user_server(self):
         """Update the server with the current username."""
         if self.sio.connected:
-            self.sio.emit('user_joined', {'username': self.username})
+            # Ask for sequence-numbered roster deltas instead of the full list on every change
+            self.sio.emit('user_joined', {'username': self.username, 'roster_deltas': True})
         else:
             messagebox.showerror("Error", "Not connected to server.")
 
     def validate_username(self, username):
         username = username.strip()
 
-        current_users = self.sio.call('get_current_users').get('current_usernames', [])
-        self.active_users = current_users
+        snapshot = self.sio.call('get_current_users')
+        self.active_users = list(snapshot.get('current_usernames', []))
+        self.roster_seq = snapshot.get('seq')
 
         if not self.sio.connected:
             messagebox.showerror("Error", "Not connected to server.")
@@ -338,6 +440,11 @@ class ChatClientGUI:
                         font=(FONT, 14)  
                     )
         self.chat_box.grid(row=1, column=0, columnspan=2, padx=10, pady=5, sticky="nsew")
+        # Reaching the top of the chat box loads the page of history before it
+        self.chat_box.configure(yscrollcommand=self.on_chat_scroll)
+        self.chat_box.tag_config("blue", foreground="#0229A7")
+        self.chat_box.tag_config("orange", foreground="darkorange")
+        self.chat_box.tag_config("gray", foreground="gray")
 
         # Active user list
         self.user_list = tk.Listbox(self.Window, width=28, height=28, font=(FONT, 14), 
@@ -391,6 +498,16 @@ class ChatClientGUI:
         self.emoji_btn = tk.Button(button_frame, text="😊", font=(FONT, 16), command=self.show_emoji_picker)
         self.emoji_btn.pack(side="left")
 
+        # Search over the chat history
+        self.search_var = tk.StringVar()
+        self.search_entry = tk.Entry(button_frame, textvariable=self.search_var, font=(FONT, 12), width=24)
+        self.search_entry.pack(side="left", padx=(20, 5))
+        self.search_entry.bind("<Return>", lambda event: self.search_messages(self.search_var.get()))
+        self.search_btn = tk.Button(button_frame, text="🔍", font=(FONT, 16),
+                                    command=lambda: self.search_messages(self.search_var.get()))
+        self.search_btn.pack(side="left")
+        self.search_window = None
+
         # Suggestion label - moved to row 4 and spans both columns
         self.suggestion_label = tk.Label(
             self.Window,
@@ -409,6 +526,7 @@ class ChatClientGUI:
         self.login.destroy()
         self.setup_chatroom_screen()
         self.update_user_list(self.active_users[::-1])     
+        self.load_history()
 
     def show_emoji_picker(self):
         """Create and show the emoji picker window"""
@@ -537,9 +655,9 @@ class ChatClientGUI:
         results_window.title(f"Search Results for '{query}'")
         results_window.geometry("400x300")
         
-        # Search in EMOJI_DICT (assuming it's {":smile:": "😊", ...})
-        matches = [(code, emoji) for code, emoji in EMOJI_DICT.items() 
-                  if query.lower() in code.lower()]
+        # Search in EMOJI_TABLE ({":smile:": "😄", ...}); only the first matches get a row
+        matches = [(code, emoji) for code, emoji in EMOJI_TABLE.items() 
+                  if query.lower() in code.lower()][:EMOJI_SEARCH_LIMIT]
         
         if not matches:
             tk.Label(results_window, text="No emojis found").pack()
@@ -630,179 +748,292 @@ class ChatClientGUI:
                 messagebox.showerror("Error", "Inappropriate file path")    
             
     def send_file_w_progressbar(self, path, recipient = "Global"):      
+        filename = os.path.basename(path)
+        f_size_b = os.path.getsize(path)
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        
+        transfer = self.transfers.new(UPLOAD, filename, f_size_b)
+        if recipient == "Global":
+            self.ui(self.display_progress_bar, transfer, "Global", self.username, timestamp)
+        else:
+            self.ui(self.display_progress_bar, transfer, "Private", f"To {recipient}", timestamp)
+        
         try:
-            filename = os.path.basename(path)
-            f_size_b = os.path.getsize(path)
-            timestamp = datetime.now().strftime("%H:%M:%S")
+            if not self.transfers.acquire(transfer):
+                return # Cancelled while waiting for a free upload slot
             
-            chunk_num = 0
-            total_chunks = math.ceil(f_size_b/CHUNK_SIZE)
+            window = UploadWindow() # Keeps several chunks in flight, paced by server acks
             
-            # Hashing file
-            hash_algo = hashlib.sha256()
+            # Hash the whole file (and each range) first: the server uses the file hash to
+            # find a partial upload to resume and the range hashes to verify as it goes
+            file_hash, range_hashes = hash_ranges(path, RANGE_SIZE)
             
-            # self.display_system_message(f"[Upload file] Waiting for server confirmation...")
-            if recipient == "Global":
-                self.display_progress_bar("Global", self.username, timestamp, filename)
-            else:
-                self.display_progress_bar("Private", f"To {recipient}", timestamp, filename)
-            
-            self.sio.emit('start_upload', {
+            # Content the server already stores is published without sending a single chunk
+            probe = self.sio.call('check_file', {'file_hash': file_hash})
+            if probe and probe.get('exists'):
+                self.sio.emit('link_file', {
+                              'filename': filename,
+                              'sender': self.username,
+                              'recipient': recipient,
+                              'file_hash': file_hash,
+                              'time': timestamp,
+                              'transfer_id': transfer.id})
+                self.transfers.progress(transfer, f_size_b)
+                self.transfers.set_state(transfer, VERIFYING)
+                return
+
+            # Servers that accept raw bytes say so in the ack; otherwise fall back to base64
+            reply = self.sio.call('start_upload', {
                           'filename': filename,
                           'sender': self.username, 
-                          'recipient': recipient
+                          'recipient': recipient,
+                          'binary': True,
+                          'file_hash': file_hash,
+                          'size': f_size_b,
+                          'range_size': RANGE_SIZE,
+                          'range_hashes': range_hashes,
+                          'range_root': range_tree_root(range_hashes),
+                          'transfer_id': transfer.id
                          })
-            
-            with open(path, "rb") as file:
-                while True:
-                    chunk = file.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    hash_algo.update(chunk)
-
-                    encoded_data = base64.b64encode(chunk).decode()
-                    self.sio.emit('upload_chunk', {
-                                  'filename': filename,
-                                  'recipient': recipient,
-                                  'chunk_data': encoded_data
-                                 })
-                    chunk_num += 1
-                    self.update_progress(filename, chunk_num, total_chunks)
-                    # print(f"[DEBUG] Writing {threading.current_thread().name}, {filename}")
-                    time.sleep(0.05)
-                    
-            time.sleep(0.5)
+            use_binary = bool(reply and reply.get('binary'))
+            offset = reply.get('offset', 0) if reply else 0 # Bytes the server already has
+            # Without per-range verification the server needs chunks in order: use one stream
+            streams = UPLOAD_STREAMS if reply and reply.get('ranges') else 1
+            done_chunks = offset // CHUNK_SIZE
+
+            def send_chunk(seq, chunk_offset, chunk, on_done, attempt=0):
+                chunk_data = chunk if use_binary else base64.b64encode(chunk).decode()
+
+                def on_ack(reply=None):
+                    # Server rejected a corrupted chunk: resend just this one
+                    if (reply and reply.get('ok') is False and not reply.get('resend_range')
+                            and attempt < CHUNK_RETRIES):
+                        send_chunk(seq, chunk_offset, chunk, on_done, attempt + 1)
+                        return
+                    window.on_ack(seq)
+                    on_done(bool(reply and reply.get('resend_range')))
+
+                self.sio.emit('upload_chunk', {
+                              'filename': filename,
+                              'recipient': recipient,
+                              'chunk_data': chunk_data,
+                              'chunk_hash': hashlib.sha256(chunk).hexdigest(),
+                              'seq': seq,
+                              'offset': chunk_offset,
+                              'transfer_id': transfer.id
+                             }, callback=on_ack)
+
+            # Ranges still to send; a range that fails its hash check goes back in the queue
+            ranges = Queue()
+            for index in range(offset // RANGE_SIZE, math.ceil(f_size_b / RANGE_SIZE)):
+                ranges.put(index)
+            range_attempts = {}
+            errors = []
+
+            def stream():
+                try:
+                    with open(path, "rb") as file:
+                        while True:
+                            try:
+                                index = ranges.get_nowait()
+                            except Empty:
+                                break
+                            start = max(index * RANGE_SIZE, offset)
+                            end = min((index + 1) * RANGE_SIZE, f_size_b)
+                            pending = [math.ceil((end - start) / CHUNK_SIZE)]
+                            failed = []
+                            acked = threading.Event()
+
+                            def on_done(range_failed, pending=pending, failed=failed, acked=acked):
+                                if range_failed:
+                                    failed.append(True)
+                                pending[0] -= 1
+                                if pending[0] == 0:
+                                    acked.set()
+
+                            file.seek(start)
+                            for chunk_offset in range(start, end, CHUNK_SIZE):
+                                if transfer.cancelled:
+                                    return
+                                chunk = file.read(CHUNK_SIZE)
+                                seq = window.acquire()
+                                send_chunk(seq, chunk_offset, chunk, on_done)
+                                # Rate-limited by the manager, however fast the acks come in
+                                self.transfers.progress(transfer, min(f_size_b, (done_chunks + window.acked) * CHUNK_SIZE))
+                                # print(f"[DEBUG] Writing {threading.current_thread().name}, {filename}")
+
+                            if not acked.wait(window.ack_timeout):
+                                raise TimeoutError("Server did not acknowledge a range")
+                            if failed:
+                                range_attempts[index] = range_attempts.get(index, 0) + 1
+                                if range_attempts[index] > CHUNK_RETRIES:
+                                    raise IOError(f"Range {index} keeps failing verification")
+                                ranges.put(index)
+                except Exception as e:
+                    errors.append(e)
+
+            workers = [threading.Thread(target=stream, daemon=True) for _ in range(streams)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            if transfer.cancelled:
+                # The server keeps what it has, so sending the file again resumes
+                self.sio.emit('cancel_upload', {'filename': filename, 'recipient': recipient, 'transfer_id': transfer.id})
+                return
+            if errors:
+                raise errors[0]
+
+            # Every chunk is written on the server once all acks are in
+            window.drain()
+            self.transfers.progress(transfer, f_size_b)
             self.sio.emit('finish_upload', {
                           'filename': filename, 
                           'sender': self.username,
                           'recipient': recipient,
-                          'hash_file': hash_algo.hexdigest(),
-                          'time': timestamp})
-            print(hash_algo.hexdigest())
+                          'hash_file': file_hash,
+                          'time': timestamp,
+                          'transfer_id': transfer.id})
+            self.transfers.set_state(transfer, VERIFYING)
+            print(file_hash)
             
         except Exception as e:
-            messagebox.showerror("Error", f"File transfer failed {e}")
+            if self.transfers.set_state(transfer, FAILED, str(e)):
+                self.ui(messagebox.showerror, "Error", f"File transfer failed {e}")
     
-    def error_upload(self, filename):
-        try:
-            bar_info = self.progress_n_index.get(filename)
-            
-            if not bar_info:
-                return
-            
-            self.chat_box.config(state="normal")    
-            progressbar_pos = bar_info["index"]
-            
-            try:
-                bar_info["bar"].destroy() # Remove the progress bar
-                self.chat_box.delete(progressbar_pos) # Delete window element
-                
-                # Insert error text at the same index
-                self.chat_box.insert(progressbar_pos, "❌ Error\n")
-            except Exception as e:
-                print(f"Error {e}")
-                log_event("client", "progress_bar_error", f"Error destroying progress bar for {filename}: {e}")
-            
-            self.chat_box.config(state="disabled")
-            self.chat_box.yview(tk.END)
-            
-            self.progress_n_index.pop(filename, None)
-            
-        except Exception as e:
-            print("Cannot display the upload error.")
-            log_event("client", "error_upload_error", f"Cannot display the upload error for {filename}: {e}") 
+    def display_progress_bar(self, transfer, msg_type, sender, timestamp):
+        tag = {"Global": "blue", "Download": "gray"}.get(msg_type, "orange")
+        formatted = f"({msg_type}) ({sender}) ({timestamp}): {transfer.filename} "
+        
+        # Progress bar at the end of the file transfer announcement; pinned so it is not evicted mid-transfer
+        transfer.entry = self.chat_entry([(formatted, tag)], filename=transfer.filename, transfer_id=transfer.id)
+        self.append_entry(transfer.entry)
+        if transfer.finished:
+            self.show_transfer_state(transfer) # Ended before it was shown
+    
+    def transfer_widget(self, transfer_id):
+        # Progress bar, rate and ETA, and a cancel button for a transfer in progress
+        background = self.chat_box.cget("background")
+        frame = tk.Frame(self.chat_box, bg=background)
+        frame.bar = Progressbar(frame, orient = tk.HORIZONTAL, mode="determinate", maximum=100, length=50)
+        frame.bar.pack(side="left")
+        frame.status = tk.Label(frame, text="Waiting...", fg="gray", bg=background, font=(FONT, 10))
+        frame.status.pack(side="left", padx=5)
+        tk.Button(frame, text="✖", command=lambda: self.cancel_transfer(transfer_id), relief="flat",
+                  bg=background, padx=0, pady=0, font=(FONT, 10)).pack(side="left")
+        return frame
+    
+    def show_transfer_progress(self, transfer):
+        entry = transfer.entry
+        if entry is None or not entry['pinned']:
+            return # Not shown yet, or already finished
+        self.flush_chat() # The progress bar may not be rendered yet
+        percent = transfer.percent()
+        if percent is not None:
+            entry['widget'].bar["value"] = percent
+        entry['widget'].status["text"] = transfer_status(transfer)
     
-    def update_progress(self, filename, chunk_num, total_chunks):
+    def show_transfer_state(self, transfer):
+        if transfer.entry is None or not transfer.entry['pinned']:
+            return # Shown by display_progress_bar once it is on screen
+        if transfer.state == VERIFYING:
+            self.show_transfer_progress(transfer)
+            # Counts as delivered unless the server asks for a retry in the meantime
+            transfer.timer = self.Window.after(UPLOAD_CONFIRM_MS, self.transfers.set_state, transfer, DONE)
+        elif transfer.state == DONE and transfer.kind == UPLOAD:
+            self.end_transfer_entry(transfer, button=True)
+        elif transfer.state == DONE:
+            self.end_transfer_entry(transfer, "✔")
+        elif transfer.state == FAILED:
+            self.end_transfer_entry(transfer, "❌ Error")
+        elif transfer.state == CANCELLED:
+            self.end_transfer_entry(transfer, "✖ Cancelled")
+    
+    def end_transfer_entry(self, transfer, text=None, button=False):
+        """Replace the progress bar with a download button or text; the entry can be evicted from now on."""
+        self.flush_chat() # The progress bar may not be rendered yet
+        entry = transfer.entry
+        self.chat_box.config(state="normal")
         try:
-            bar_info = self.progress_n_index.get(filename)
-            
-            if not bar_info:
-                return
-            
-            percent = math.floor((chunk_num/total_chunks) * 100)
-
-            if percent == 100:
-                self.chat_box.config(state="normal")
-                
-                progressbar_pos = bar_info["index"]
-                
-                def finalize_upload():
-                    # Check if retry was already triggered
-                    if filename not in self.upload_confirmation:
-                        return  # already handled
-
-                    try:
-                        bar_info["bar"].destroy() # Remove the progress bar
-                        self.chat_box.delete(progressbar_pos) # Delete window element
-                    except Exception as e:
-                        print(f"Error {e}")
-                        log_event("client", "progress_bar_error", f"Error destroying progress bar for {filename}: {e}")
-                    
-                    # Insert the download button
-                    download_button = tk.Button(self.chat_box, text = "⬇", command = lambda : self.ask_download(filename), 
-                                        bg="midnight blue", fg="white", relief="flat", width= 2, 
-                                        padx=0, pady=0, font=(FONT, 11))
-                    self.chat_box.window_create(progressbar_pos, window = download_button, pady=3)
-                    
-                    self.chat_box.config(state="disabled")
-                    self.chat_box.yview(tk.END)
-                    
-                    self.progress_n_index.pop(filename, None)
-                    self.upload_confirmation.pop(filename, None)
-                
-                # Only check the first time progress reaches 100% -> only schedule once
-                if filename not in self.upload_confirmation:
-                    self.upload_confirmation[filename] = self.root.after(2000, finalize_upload) # Delay 2s to wait for 'retry_sending' signal from server
+            position = self.chat_box.index(entry['widget']) # Lines above it may have come or gone
+            entry['widget'].destroy()
+            self.chat_box.delete(position) # Delete window element
+            if button:
+                entry['widget'] = self.download_button(transfer.filename)
+                self.chat_box.window_create(position, window=entry['widget'], pady=3)
             else:
-                bar_info["bar"]["value"] = percent
-            
+                self.chat_box.insert(position, text)
+                entry['segments'].append((text, None))
+                entry.update(file=None, widget=None)
         except Exception as e:
-            print(f"Cannot upload the progress bar of {filename}")
-            log_event("client", "progress_bar_update_error", f"Cannot update progress bar for {filename}: {e}")
-    
-    def display_progress_bar(self, msg_type, sender, timestamp, filename):
-        self.chat_box.config(state="normal")
-        tag = "blue" if msg_type == "Global" else "orange"
-        formatted = f"({msg_type}) ({sender}) ({timestamp}): {filename} "
-        self.chat_box.insert(tk.END, formatted, tag)
-        
-        # Add progress bar at the end of the file uploading announcement
-        bar = Progressbar(self.chat_box, orient = tk.HORIZONTAL, mode="determinate", maximum=100, length=50)
-        self.chat_box.window_create(tk.END, window=bar, pady=3)  
-
-        progressbar_pos = self.chat_box.index(bar)      
-        self.chat_box.insert(tk.END, "\n")
-        
-        self.chat_box.tag_config("blue", foreground="midnight blue")
-        self.chat_box.tag_config("orange", foreground="darkorange")
-        
-        # Store the position of the progress bar for later replacing with the download button
-        self.progress_n_index[filename] = {"index": progressbar_pos, 'bar': bar}
-        
+            print(f"Error {e}")
+            log_event("client", "progress_bar_error", f"Error replacing progress bar for {transfer.filename}: {e}")
+        entry.update(pinned=False, transfer=None)
         self.chat_box.config(state="disabled")
-        self.chat_box.yview(tk.END)
     
-    def save_file_stream(self, filename):
-        file_path = self.download_files[filename]['path']
-        queue = self.download_files[filename]['queue']
-        computed_hash = self.download_files[filename]['computed_hash']
+    def cancel_transfer(self, transfer_id):
+        transfer = self.transfers.cancel(transfer_id)
+        if transfer and transfer.kind == DOWNLOAD:
+            transfer.queue.put(None) # Wakes the writer thread, which keeps the partial file for a resume
+    
+    def save_file_stream(self, transfer):
+        if not self.transfers.acquire(transfer):
+            return # Cancelled while waiting for a free download slot
+        filename = transfer.filename
         
+        # An interrupted earlier download leaves <save_path>.part and its state: resume from it
+        part = RangeFile(transfer.path + ".part", transfer.path + ".part.json")
         try:
-            with open(file_path, "wb") as f:
-                while True:
-                    chunk = queue.get()
-                    if chunk is None:  # Poison pill
-                        break
-                    
-                    decoded_chunk = base64.b64decode(chunk.encode())
-                    
-                    f.write(decoded_chunk)
-                    computed_hash.update(decoded_chunk)
+            offset = part.open(resume=True)
+            # Servers that know about transfer ids answer with the file size, for progress and ETA
+            reply = self.sio.call('download_request', {'filename': filename, 'binary': True, 'offset': offset,
+                                                       'streams': DOWNLOAD_STREAMS, 'transfer_id': transfer.id})
+            transfer.total = reply.get('size') if isinstance(reply, dict) else None
+            done = offset
+            self.transfers.progress(transfer, done)
+            
+            while True:
+                item = transfer.queue.get()
+                if item is None:  # Poison pill: cancelled
+                    part.close()  # Keep what we have for a later resume
+                    self.sio.emit('cancel_download', {'filename': filename, 'transfer_id': transfer.id})
+                    break
+
+                if isinstance(item, dict):
+                    # finish_download marker: every chunk before it is on disk
+                    self.verify_download(transfer, part, item.get('hash_file', ''))
+                    break
+                
+                offset, chunk = item
+                # Raw bytes from binary-capable servers, base64 text from older ones
+                if isinstance(chunk, str):
+                    chunk = base64.b64decode(chunk.encode())
+                
+                # Positional write; the hash follows the contiguous prefix
+                part.write(chunk, offset)
+                done += len(chunk)
+                self.transfers.progress(transfer, done)
         except Exception as e:
-            messagebox.showerror("Error", "Failed to write chunk when downloading.")
+            part.close()
+            if self.transfers.set_state(transfer, FAILED, str(e)):
+                self.ui(messagebox.showerror, "Error", "Failed to write chunk when downloading.")
             log_event("client", "save_file_stream_failed", f"Failed to write chunk when downloading {filename}: {e}")
-        finally:
-            self.download_files.pop(filename)
+
+    def verify_download(self, transfer, part, server_hash):
+        filename = transfer.filename
+        if part.chunks or part.hexdigest() != server_hash:
+            self.transfers.set_state(transfer, FAILED, "Hash mismatch")
+            self.ui(messagebox.showerror, "Error", f"Failed to download file {filename} from server. Please download again.")
+            log_event("client", "finish_download_failed", f"Hash mismatch for {filename}")
+            
+            # Delete the failed file so the next attempt starts from scratch
+            part.discard()
+            log_event("client", "delete_failed_download_file", f"Deleted corrupt file: {part.data_path}")
+            return
+
+        part.complete(transfer.path)
+        self.transfers.set_state(transfer, DONE)
+        self.ui(self.display_system_message, f"File {filename} has been successfully downloaded.")
     
     def ask_download(self, filename):
         if messagebox.askyesno("Download", f"Do you want to download {filename}?"):
@@ -812,37 +1043,23 @@ class ChatClientGUI:
             if save_path:
                 if not save_path.lower().endswith(extension.lower()):
                     save_path += extension  # auto-append if user forgot
-                    
-                q = Queue()
-                hash_algo_download = hashlib.sha256()
                 
-                self.download_files[filename] = {
-                    'queue': q,
-                    'path': save_path,
-                    'thread': threading.Thread(target=self.save_file_stream, args=(filename,), daemon=True),
-                    'computed_hash': hash_algo_download
-                }
-
-                self.download_files[filename]['thread'].start()
-                
-                self.sio.emit('download_request', {'filename': filename})
+                # Opening the partial file and asking the server happen on the writer thread
+                transfer = self.transfers.new(DOWNLOAD, filename)
+                transfer.path = save_path
+                transfer.queue = Queue()
+                self.display_progress_bar(transfer, "Download", self.username, datetime.now().strftime("%H:%M:%S"))
+                threading.Thread(target=self.save_file_stream, args=(transfer,), daemon=True).start()
     
     def receive_file(self, msg_type, sender, filename, timestamp):
-        self.chat_box.config(state="normal")
         tag = "blue" if msg_type == "Global" else "orange"
         formatted = f"({msg_type}) ({sender}) ({timestamp}): {filename} "
-        self.chat_box.insert(tk.END, formatted, tag)
-        
-        download_button = tk.Button(self.chat_box, text = "⬇", command = lambda : self.ask_download(filename), 
-                                    bg="midnight blue", fg="white", relief="flat", width= 2, 
-                                    padx=0, pady=0, font=(FONT, 11))
-        self.chat_box.window_create(tk.END, window = download_button, pady=3)
-        self.chat_box.insert(tk.END, "\n")
-        
-        self.chat_box.tag_config("blue", foreground="midnight blue")
-        self.chat_box.tag_config("orange", foreground="darkorange")
-        self.chat_box.config(state="disabled")
-        self.chat_box.yview(tk.END)
+        self.append_entry(self.chat_entry([(formatted, tag)], filename=filename))
+    
+    def download_button(self, filename):
+        return tk.Button(self.chat_box, text = "⬇", command = lambda : self.ask_download(filename), 
+                         bg="midnight blue", fg="white", relief="flat", width= 2, 
+                         padx=0, pady=0, font=(FONT, 11))
     
     def check_for_slash_command(self, event):
         """Check if user typed '/' and show suggestion"""
@@ -859,9 +1076,8 @@ class ChatClientGUI:
         if raw_msg.strip() == "":
             return
 
-        # Replace emoji codes with actual emojis
-        for code, emoji in EMOJI_DICT.items():
-            raw_msg = raw_msg.replace(code, emoji)
+        # Replace emoji codes with actual emojis, in one pass
+        raw_msg = expand_emoji(raw_msg)
 
         timestamp = datetime.now().strftime("%H:%M:%S")
 
@@ -910,18 +1126,11 @@ class ChatClientGUI:
 
         self.entry_var.set("")
 
-    def display_message(self, msg_type, sender, message, timestamp):
-        self.chat_box.config(state="normal")
+    def display_message(self, msg_type, sender, message, timestamp, message_id=None):
         tag = "blue" if msg_type == "Global" else "orange"
-        # Insert colored metadata
+        # Colored metadata, then the message content in default color (black)
         metadata = f"({msg_type}) ({sender}) ({timestamp}): "
-        self.chat_box.insert(tk.END, metadata, tag)
-        # Insert message content in default color (black)
-        self.chat_box.insert(tk.END, f"{message}\n")
-        self.chat_box.tag_config("blue", foreground="#0229A7")
-        self.chat_box.tag_config("orange", foreground="darkorange")
-        self.chat_box.config(state="disabled")
-        self.chat_box.yview(tk.END)
+        self.append_entry(self.chat_entry([(metadata, tag), (message, None)], message_id=message_id))
 
     def display_system_message(self, message):
         if not hasattr(self, 'chat_box'):
@@ -929,13 +1138,8 @@ class ChatClientGUI:
             log_event("client", "display_system_message_error", "Chat box not initialized.")
             return
         
-        self.chat_box.config(state="normal")
-        
-        formatted = f"(System) ({datetime.now().strftime('%H:%M:%S')}): {message} \n"
-        self.chat_box.insert(tk.END, formatted, "gray")
-        self.chat_box.tag_config("gray", foreground="gray")
-        self.chat_box.config(state="disabled")
-        self.chat_box.yview(tk.END)
+        formatted = f"(System) ({datetime.now().strftime('%H:%M:%S')}): {message} "
+        self.append_entry(self.chat_entry([(formatted, "gray")]))
 
     def private_sending_box(self, recipient):
         self.private_box = tk.Toplevel()
@@ -1016,6 +1220,325 @@ class ChatClientGUI:
             
             self.private_sending_box(username)
 
+    # --- History ---
+    def note_message_id(self, message_id):
+        if message_id is None:
+            return
+        self.message_ids.add(message_id)
+        if self.oldest_message_id is None or message_id < self.oldest_message_id:
+            self.oldest_message_id = message_id
+
+    def on_chat_scroll(self, first, last):
+        self.chat_box.vbar.set(first, last)
+        if float(first) <= 0.0:
+            if self.scrollback_cache:
+                self.restore_scrollback()
+            else:
+                self.load_history()
+
+    def load_history(self):
+        """Fetch the page of messages before the oldest one shown, off the Tk thread."""
+        if self.history_loading or self.history_exhausted or not self.sio.connected:
+            return
+        self.history_loading = True
+        before_id = self.oldest_message_id
+
+        def fetch():
+            try:
+                page = self.sio.call('fetch_history', {'before_id': before_id, 'limit': HISTORY_PAGE_SIZE})
+            except Exception as e:
+                print(f"Failed to load history: {e}")
+                log_event("client", "fetch_history_error", f"Failed to load history: {e}")
+                page = {'messages': [], 'has_more': False}  # e.g. a server without history; stop asking
+            self.ui(self.show_history, page)
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def show_history(self, page):
+        self.history_loading = False
+        if not page:
+            return
+        if not page.get('has_more'):
+            self.history_exhausted = True
+
+        entries = []
+        for row in page.get('messages', []):
+            message_id = row.get('id')
+            if message_id in self.message_ids:
+                continue  # Already shown live
+            try:
+                timestamp, message = decrypt_aes(self.session_aes_key, row.get('message', '')).split("|", 1)
+            except Exception as e:
+                log_event("client", "fetch_history_error", f"Failed to decrypt message {message_id}: {e}")
+                continue
+            self.note_message_id(message_id)
+
+            if row.get('channel') == 'private':
+                msg_type, tag = "Private", "orange"
+                sender = f"To {row.get('recipient')}" if row.get('sender') == self.username else f"From {row.get('sender')}"
+            else:
+                msg_type, tag, sender = "Global", "blue", row.get('sender')
+            entries.append(self.chat_entry([(f"({msg_type}) ({sender}) ({timestamp}): ", tag), (message, None)],
+                                           message_id=message_id))
+        # Rows arrive newest first
+        entries.reverse()
+        self.prepend_entries(entries)
+
+    # --- Scrollback ---
+    def chat_entry(self, segments, filename=None, message_id=None, transfer_id=None):
+        """One message of the chat box: (text, tag) runs, then a file button (or progress bar) if any, then a newline.
+
+        Entries outlive their lines in the chat box: evicted ones wait in the
+        scrollback cache and are rendered again when the user scrolls back up.
+        """
+        lines = sum(text.count("\n") for text, _ in segments) + 1
+        # A transfer in progress pins its entry: it is never evicted while its progress bar is live
+        return {'segments': segments, 'file': filename, 'id': message_id, 'lines': lines,
+                'widget': None, 'pinned': transfer_id is not None, 'transfer': transfer_id}
+
+    def render_entry(self, entry, index):
+        for text, tag in entry['segments']:
+            self.chat_box.insert(index, text, tag or ())
+        if entry['file'] is not None:
+            if entry['pinned']:
+                entry['widget'] = self.transfer_widget(entry['transfer'])
+            else:
+                entry['widget'] = self.download_button(entry['file'])
+            self.chat_box.window_create(index, window=entry['widget'], pady=3)
+        self.chat_box.insert(index, "\n")
+
+    def append_entry(self, entry):
+        # Rendered with everything else appended this frame
+        self.pending_entries.append(entry)
+
+    def flush_chat(self):
+        """Render the entries appended since the last frame: one insert pass, one trim, one scroll."""
+        if not self.pending_entries or getattr(self, 'chat_box', None) is None:
+            return
+        entries, self.pending_entries = self.pending_entries, []
+        self.chat_box.config(state="normal")
+        for entry in entries:
+            self.render_entry(entry, tk.END)
+            self.chat_lines += entry['lines']
+        self.chat_entries.extend(entries)
+        self.trim_scrollback()
+        self.chat_box.config(state="disabled")
+        self.chat_box.yview(tk.END)
+
+    def prepend_entries(self, entries):
+        # entries oldest first; a right-gravity mark at the top keeps them in that order
+        if not entries:
+            return
+        self.chat_box.config(state="normal")
+        self.chat_box.mark_set("scrollback", "1.0")
+        self.chat_box.mark_gravity("scrollback", tk.RIGHT)
+        for entry in entries:
+            self.render_entry(entry, "scrollback")
+        self.chat_box.mark_unset("scrollback")
+        self.chat_box.config(state="disabled")
+
+        inserted = sum(entry['lines'] for entry in entries)
+        self.chat_entries.extendleft(reversed(entries))
+        self.chat_lines += inserted
+        # Keep the line that was at the top in view instead of jumping
+        self.chat_box.yview(f"{inserted + 1}.0")
+
+    def trim_scrollback(self):
+        """Evict the oldest entries once the chat box is SCROLLBACK_SLACK lines over its cap."""
+        if self.chat_lines <= SCROLLBACK_LINES + SCROLLBACK_SLACK:
+            return
+        evicted, lines = [], 0
+        while self.chat_entries and self.chat_lines - lines > SCROLLBACK_LINES:
+            if self.chat_entries[0]['pinned']:
+                break  # An upload in progress keeps its line, and so everything after it
+            entry = self.chat_entries.popleft()
+            evicted.append(entry)
+            lines += entry['lines']
+        if not evicted:
+            return
+
+        self.chat_box.delete("1.0", f"{lines + 1}.0")
+        self.chat_lines -= lines
+        for entry in evicted:
+            if entry['widget'] is not None:
+                entry['widget'].destroy()
+                entry['widget'] = None
+            if len(self.scrollback_cache) == self.scrollback_cache.maxlen:
+                self.forget_entry(self.scrollback_cache[0])
+            self.scrollback_cache.append(entry)
+
+    def forget_entry(self, entry):
+        # Falls out of the cache: a message the server has is fetched again when scrolled back to
+        if entry['id'] is None:
+            return
+        self.message_ids.discard(entry['id'])
+        self.oldest_message_id = entry['id'] + 1
+        self.history_exhausted = False
+
+    def restore_scrollback(self):
+        if self.history_loading:
+            return
+        self.history_loading = True
+        self.Window.after_idle(self.show_scrollback)  # Not from inside the scroll callback
+
+    def show_scrollback(self):
+        self.history_loading = False
+        entries = []
+        while self.scrollback_cache and len(entries) < HISTORY_PAGE_SIZE:
+            entries.append(self.scrollback_cache.pop())
+        entries.reverse()
+        self.prepend_entries(entries)
+
+    # --- Search ---
+    def search_messages(self, query, offset=0):
+        query = query.strip()
+        if not query or not self.sio.connected:
+            return
+
+        def fetch():
+            try:
+                result = self.sio.call('search_messages', {'query': query, 'offset': offset, 'limit': SEARCH_PAGE_SIZE})
+            except Exception as e:
+                print(f"Search failed: {e}")
+                log_event("client", "search_messages_error", f"Search failed: {e}")
+                result = {'messages': [], 'has_more': False}
+            self.ui(self.show_search_results, query, offset, result)
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def show_search_results(self, query, offset, result):
+        if offset == 0 or not (self.search_window and self.search_window.winfo_exists()):
+            if self.search_window and self.search_window.winfo_exists():
+                self.search_window.destroy()
+            self.search_window = tk.Toplevel(self.Window)
+            self.search_window.title(f"Search Results for '{query}'")
+            self.search_window.geometry("600x400")
+            self.search_results = scrolledtext.ScrolledText(self.search_window, state="disabled", font=(FONT, 12))
+            self.search_results.pack(fill="both", expand=True)
+            self.search_results.tag_config("blue", foreground="#0229A7")
+            self.search_results.tag_config("orange", foreground="darkorange")
+            self.search_results.tag_config("gray", foreground="gray")
+            self.search_more_btn = None
+
+        box = self.search_results
+        box.config(state="normal")
+        if self.search_more_btn:
+            box.delete(box.index(self.search_more_btn))  # Results continue where the button was
+            self.search_more_btn.destroy()
+            self.search_more_btn = None
+        messages = result.get('messages', [])
+        if offset == 0 and not messages:
+            box.insert(tk.END, "No messages found\n", "gray")
+
+        for row in messages:
+            try:
+                message = decrypt_aes(self.session_aes_key, row.get('message', '')).split("|", 1)[-1]
+            except Exception as e:
+                log_event("client", "search_messages_error", f"Failed to decrypt message {row.get('id')}: {e}")
+                continue
+            when = datetime.fromtimestamp(row.get('timestamp', 0)).strftime("%Y-%m-%d %H:%M")
+            if row.get('channel') == 'private':
+                sender = f"To {row.get('recipient')}" if row.get('sender') == self.username else f"From {row.get('sender')}"
+                box.insert(tk.END, f"(Private) ({sender}) ({when}): ", "orange")
+            else:
+                box.insert(tk.END, f"(Global) ({row.get('sender')}) ({when}): ", "blue")
+            box.insert(tk.END, f"{message}\n")
+
+        if result.get('has_more'):
+            next_offset = offset + SEARCH_PAGE_SIZE
+            self.search_more_btn = tk.Button(box, text="More results",
+                                             command=lambda: self.search_messages(query, next_offset))
+            box.window_create(tk.END, window=self.search_more_btn, pady=3)
+        box.config(state="disabled")
+
+    # --- UI queue ---
+    def ui(self, func, *args):
+        """Run func(*args) on the Tk thread with the next frame. Safe to call from any thread."""
+        self.ui_queue.put((func, args))
+
+    def pump_ui(self):
+        # Next frame first, so a dialog opened below does not stall the updates behind it
+        self.Window.after(UI_FRAME_MS, self.pump_ui)
+        for _ in range(self.ui_queue.qsize()):  # Only what was queued before this frame
+            try:
+                func, args = self.ui_queue.get_nowait()
+            except Empty:
+                break  # Drained by a nested frame
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"UI update failed: {e}")
+                log_event("client", "ui_update_error", f"{getattr(func, '__name__', func)} failed: {e}")
+        self.flush_chat()
+
+    # --- Roster ---
+    def apply_roster_update(self, data):
+        """Apply a user_joined/user_left update to active_users and the user list."""
+        if 'usernames' in data:
+            # Full roster (server without delta support)
+            self.active_users = list(data['usernames'])
+            self.update_user_list(self.active_users[::-1])
+            return
+
+        seq = data.get('seq')
+        if seq is None:
+            return  # Not a roster change
+        if self.roster_seq is not None and seq <= self.roster_seq:
+            return  # Already part of the snapshot we hold
+        if self.roster_seq is None or seq != self.roster_seq + 1:
+            # Missed an update: fetch a full snapshot instead of guessing
+            self.resync_roster()
+            return
+
+        self.roster_seq = seq
+        for username in data.get('removed', []):
+            self.remove_user_row(username)
+        for username in data.get('added', []):
+            self.add_user_row(username)
+
+    def resync_roster(self):
+        if self.roster_resyncing:
+            return
+        self.roster_resyncing = True
+
+        def fetch():
+            # Only the call runs here; the roster state belongs to the Tk thread
+            try:
+                snapshot = self.sio.call('get_current_users')
+            except Exception as e:
+                print(f"Roster resync failed: {e}")
+                log_event("client", "roster_resync_failed", f"Roster resync failed: {e}")
+                snapshot = None
+            self.ui(self.apply_roster_snapshot, snapshot)
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def apply_roster_snapshot(self, snapshot):
+        """Replace the roster with a full snapshot from get_current_users (None if the fetch failed)."""
+        self.roster_resyncing = False
+        if snapshot is None:
+            return
+        self.active_users = list(snapshot.get('current_usernames', []))
+        self.roster_seq = snapshot.get('seq')
+        self.update_user_list(self.active_users[::-1])
+        log_event("client", "roster_resync", f"Roster resynced at seq {self.roster_seq}")
+
+    def user_list_ready(self):
+        return getattr(self, 'user_list', None) is not None
+
+    def add_user_row(self, username):
+        if username in self.active_users:
+            return
+        self.active_users.append(username)
+        if self.user_list_ready():
+            self.user_list.insert(0, f"👤 {username}")  # Newest first
+
+    def remove_user_row(self, username):
+        if username not in self.active_users:
+            return
+        index = self.active_users.index(username)
+        del self.active_users[index]
+        if self.user_list_ready():
+            # Rows are in reverse join order
+            self.user_list.delete(len(self.active_users) - index)
+
     def update_user_list(self, users):
         if (not hasattr(self, 'user_list') or 
             self.user_list is None or 
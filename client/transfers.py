@@ -0,0 +1,174 @@
+import math
+import time
+import itertools
+import threading
+from collections import deque
+
+MAX_UPLOADS = 2            # Uploads sending at once; later ones wait in QUEUED
+MAX_DOWNLOADS = 3          # Downloads receiving at once
+PROGRESS_INTERVAL = 0.25   # Seconds between progress reports of one transfer (4 per second)
+RATE_WINDOW = 3.0          # Seconds of progress the throughput, and so the ETA, is averaged over
+
+UPLOAD, DOWNLOAD = "upload", "download"
+
+# Transfer states
+QUEUED = "queued"          # Waiting for a free slot
+ACTIVE = "active"          # Sending or receiving chunks
+VERIFYING = "verifying"    # Every byte sent; waiting for the server to confirm the upload
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+TRANSITIONS = {
+    QUEUED: (ACTIVE, FAILED, CANCELLED),
+    ACTIVE: (VERIFYING, DONE, FAILED, CANCELLED),
+    VERIFYING: (DONE, FAILED),   # The bytes are out; too late to cancel
+}                                # DONE, FAILED and CANCELLED are final
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class Transfer:
+    """One upload or download, known by its id rather than by its filename."""
+
+    def __init__(self, transfer_id, kind, filename, total=None):
+        self.id = transfer_id
+        self.kind = kind
+        self.filename = filename
+        self.total = total        # Bytes; None until known
+        self.done = 0             # Bytes acknowledged (upload) or written (download)
+        self.state = QUEUED
+        self.error = None
+        self.cancel_event = threading.Event()
+
+        # Owned by the GUI
+        self.entry = None         # Chat box entry showing the transfer
+        self.path = None          # Downloads: where the file is saved
+        self.queue = None         # Downloads: chunks waiting for the writer thread
+        self.timer = None         # Uploads: pending confirmation timeout
+
+        self._samples = deque()   # (time, done) over the last RATE_WINDOW seconds
+        self._reported = 0.0      # When progress was last reported
+        self._has_slot = False
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    def percent(self):
+        if not self.total:
+            return None
+        return min(100, math.floor(self.done * 100 / self.total))
+
+    def rate(self):
+        """Bytes per second over the last RATE_WINDOW seconds."""
+        if len(self._samples) < 2:
+            return 0.0
+        (first_time, first_done), (last_time, last_done) = self._samples[0], self._samples[-1]
+        return (last_done - first_done) / (last_time - first_time) if last_time > first_time else 0.0
+
+    def eta(self):
+        """Seconds left at the current rate, or None while that is unknown."""
+        rate = self.rate()
+        if not self.total or not rate:
+            return None
+        return max(0.0, (self.total - self.done) / rate)
+
+    def _sample(self, now):
+        self._samples.append((now, self.done))
+        while len(self._samples) > 2 and now - self._samples[0][0] > RATE_WINDOW:
+            self._samples.popleft()
+
+
+class TransferManager:
+    """Every file transfer of the client, each with its own id and state machine.
+
+    Workers report progress as often as they like: on_progress is called at
+    most every `progress_interval` seconds per transfer (and always at 100%),
+    on_state on every state change, both on the reporting thread. Only
+    `max_uploads` uploads and `max_downloads` downloads are ACTIVE at once;
+    the others wait in acquire(). Cancelling a transfer wakes it from there,
+    frees its slot and leaves the worker to stop at its next check of
+    `transfer.cancelled`.
+    """
+
+    def __init__(self, on_progress=None, on_state=None, max_uploads=MAX_UPLOADS,
+                 max_downloads=MAX_DOWNLOADS, progress_interval=PROGRESS_INTERVAL):
+        self.on_progress = on_progress
+        self.on_state = on_state
+        self.progress_interval = progress_interval
+        self.limits = {UPLOAD: max_uploads, DOWNLOAD: max_downloads}
+        self.active = {UPLOAD: 0, DOWNLOAD: 0}
+        self.transfers = {}    # id -> Transfer, until it is finished
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    def new(self, kind, filename, total=None):
+        with self._cond:
+            transfer = Transfer(next(self._ids), kind, filename, total)
+            self.transfers[transfer.id] = transfer
+        return transfer
+
+    def get(self, transfer_id):
+        return self.transfers.get(transfer_id)
+
+    def find(self, kind, filename):
+        """Oldest unfinished transfer of filename, for servers that do not echo transfer ids."""
+        with self._cond:
+            return next((transfer for transfer in self.transfers.values()
+                         if transfer.kind == kind and transfer.filename == filename), None)
+
+    def acquire(self, transfer):
+        """Wait for a free slot and make the transfer ACTIVE. False if it was cancelled first."""
+        with self._cond:
+            self._cond.wait_for(lambda: transfer.cancelled or self.active[transfer.kind] < self.limits[transfer.kind])
+            if transfer.cancelled:
+                return False
+            self.active[transfer.kind] += 1
+            transfer._has_slot = True
+        if not self.set_state(transfer, ACTIVE):
+            return False
+        transfer._sample(time.monotonic())
+        return True
+
+    def set_state(self, transfer, state, error=None):
+        """Move the transfer to state if the state machine allows it. Returns whether it did."""
+        with self._cond:
+            if state not in TRANSITIONS.get(transfer.state, ()):
+                return False
+            transfer.state = state
+            transfer.error = error
+            if state != ACTIVE and transfer._has_slot:
+                # Confirming an upload takes no bandwidth, so it already makes room for the next
+                transfer._has_slot = False
+                self.active[transfer.kind] -= 1
+                self._cond.notify_all()
+            if state in FINISHED:
+                self.transfers.pop(transfer.id, None)
+        if self.on_state:
+            self.on_state(transfer)
+        return True
+
+    def progress(self, transfer, done):
+        """Record that done bytes are through; reported if PROGRESS_INTERVAL has passed."""
+        transfer.done = done
+        now = time.monotonic()
+        if now - transfer._reported < self.progress_interval and done != transfer.total:
+            return
+        transfer._reported = now
+        transfer._sample(now)
+        if self.on_progress and transfer.state == ACTIVE:
+            self.on_progress(transfer)
+
+    def cancel(self, transfer_id):
+        """Cancel an unfinished transfer. Returns it, or None if there is nothing to cancel."""
+        transfer = self.get(transfer_id)
+        if transfer is None or CANCELLED not in TRANSITIONS.get(transfer.state, ()):
+            return None
+        with self._cond:
+            transfer.cancel_event.set()
+            self._cond.notify_all()
+        return transfer if self.set_state(transfer, CANCELLED) else None
@@ -0,0 +1,72 @@
+import threading
+import time
+
+# Window sizing (in chunks)
+INITIAL_WINDOW = 4
+MIN_WINDOW = 1
+MAX_WINDOW = 64
+SLOW_START_LIMIT = 16   # Double per round trip below this, then grow by one per round trip
+RTT_BLOAT = 3.0         # Ack slower than this many times the best RTT -> server is falling behind
+ACK_TIMEOUT = 15.0      # Give up if nothing is acknowledged for this long
+
+
+class UploadWindow:
+    """Credit-based flow control for file uploads.
+
+    The sender calls acquire() before emitting a chunk and the server's ack for
+    that chunk calls on_ack(). At most `size` chunks are unacknowledged at once.
+    The window grows while acks come back quickly and halves when ack latency
+    balloons, so uploads run at link speed without flooding the server.
+    """
+
+    def __init__(self, initial=INITIAL_WINDOW, minimum=MIN_WINDOW, maximum=MAX_WINDOW,
+                 ack_timeout=ACK_TIMEOUT):
+        self.size = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.ack_timeout = ack_timeout
+
+        self.acked = 0
+        self.in_flight = {}      # seq -> send time
+        self.min_rtt = None
+        self._last_decrease = 0  # No further decrease until chunks sent after it are acked
+        self._next_seq = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for room in the window and return the sequence number to send."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self.in_flight) < int(self.size), self.ack_timeout):
+                raise TimeoutError("Server stopped acknowledging chunks")
+            seq = self._next_seq
+            self._next_seq += 1
+            self.in_flight[seq] = time.monotonic()
+            return seq
+
+    def on_ack(self, seq):
+        with self._cond:
+            sent_at = self.in_flight.pop(seq, None)
+            if sent_at is None:
+                return
+            self.acked += 1
+
+            rtt = time.monotonic() - sent_at
+            if self.min_rtt is None or rtt < self.min_rtt:
+                self.min_rtt = rtt
+
+            if rtt > self.min_rtt * RTT_BLOAT and seq >= self._last_decrease:
+                # Multiplicative decrease, at most once per window of chunks
+                self.size = max(self.minimum, self.size / 2)
+                self._last_decrease = self._next_seq
+            elif self.size < SLOW_START_LIMIT:
+                self.size = min(self.maximum, self.size + 1)
+            else:
+                self.size = min(self.maximum, self.size + 1 / self.size)
+
+            self._cond.notify_all()
+
+    def drain(self):
+        """Wait until every chunk sent so far has been acknowledged."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self.in_flight, self.ack_timeout):
+                raise TimeoutError("Server did not acknowledge the last chunks")
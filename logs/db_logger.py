@@ -1,39 +1,581 @@
 import sqlite3
-from datetime import datetime
+from collections import deque
+from datetime import datetime, timedelta
+import socketserver
 import threading
+import socket
+import shutil
+import atexit
+import queue
+import gzip
+import json
+import time
 import os
+import re
 
-log_lock = threading.Lock()
+# Logs go to one database per day (partition) in LOG_DIR
+LOG_DIR = os.path.abspath(os.path.dirname(__file__))
+# Single database used before partitioning; still read, never written
+DB_PATH = os.path.join(LOG_DIR, "chat_logs.db")
 
-# Set shared DB file path (relative to project root or use absolute path)
-DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "chat_logs.db"))
+# Partitioning
+ROTATE_BYTES = 256 * 1024 * 1024   # Start another partition for the day past this size
+COMPRESS_AFTER_DAYS = 2            # Partitions older than this are gzipped
+RETENTION_DAYS = 30                # ... and deleted after this many days
 
-# Establish connection
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-cursor = conn.cursor()
+# Live feed (see start_log_stream); view_logs -f subscribes to it
+LOG_SOCKET = os.path.join(LOG_DIR, "chat_logs.sock")
+RING_SIZE = 10000            # Recent rows kept in memory for subscribers catching up
+SUBSCRIBER_QUEUE = 10000     # Rows waiting for one slow subscriber before it starts missing some
+KEEPALIVE_INTERVAL = 1.0     # Seconds of silence before an empty line checks the subscriber is still there
 
-# Create table if it doesn't exist
-cursor.execute("""
+PARTITION_NAME = re.compile(r"^chat_logs-(\d{8})-(\d{3})\.db(\.gz)?$")
+
+# Background writer tuning
+BATCH_SIZE = 256        # Wake the writer once this many rows are pending
+FLUSH_INTERVAL = 0.5    # ... or after this many seconds, whichever comes first
+MAX_QUEUE = 10000       # Rows buffered in memory before the drop policy kicks in
+DROP_POLICY = "block"   # When full: 'block' the caller, 'drop_newest' or 'drop_oldest'
+
+DROP_POLICIES = ("block", "drop_newest", "drop_oldest")
+
+SCHEMA_VERSION = 2  # 1: free-text logs table with a formatted timestamp
+
+SCHEMA = ("""
+CREATE TABLE IF NOT EXISTS log_events (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE     -- e.g. 'connect', 'global_msg'
+)""", """
 CREATE TABLE IF NOT EXISTS logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    role TEXT NOT NULL,         -- 'client' or 'server'
-    source TEXT NOT NULL,       -- e.g., username or SID
-    event TEXT NOT NULL,        -- event message
-    timestamp TEXT NOT NULL     -- when the event occurred
-)
-""")
-conn.commit()
-
-def log_event(role, source, event):
-    """Thread-safe log insertion"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with log_lock:
-        cursor.execute(
-            "INSERT INTO logs (role, source, event, timestamp) VALUES (?, ?, ?, ?)",
-            (role, source, event, timestamp)
-        )
-        conn.commit()
+    id INTEGER PRIMARY KEY,
+    ts INTEGER NOT NULL,          -- epoch milliseconds
+    source TEXT NOT NULL,         -- 'client' or 'server'
+    event INTEGER NOT NULL REFERENCES log_events (id),
+    sid TEXT,                     -- Socket.IO session, when known
+    username TEXT,                -- when known
+    message TEXT NOT NULL
+)""",
+"CREATE INDEX IF NOT EXISTS idx_logs_event_ts ON logs (event, ts)",
+"CREATE INDEX IF NOT EXISTS idx_logs_source_ts ON logs (source, ts)",
+"CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs (ts, event)",  # Covers per-event counts over a time range
+"CREATE INDEX IF NOT EXISTS idx_logs_sid_ts ON logs (sid, ts) WHERE sid IS NOT NULL",
+"CREATE INDEX IF NOT EXISTS idx_logs_username_ts ON logs (username, ts) WHERE username IS NOT NULL", """
+CREATE VIEW IF NOT EXISTS log_entries AS
+    SELECT logs.id, logs.ts, logs.source, log_events.name AS event, logs.sid, logs.username, logs.message
+    FROM logs JOIN log_events ON log_events.id = logs.event""")
 
-def close_logger():
-    with log_lock:
+def open_log_db(db_path=DB_PATH):
+    """Open the log database in WAL mode, creating or migrating the schema as needed."""
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        conn.execute("BEGIN IMMEDIATE")  # One process migrates; the others wait, then see version 2
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                migrate_v1(conn)
+                for statement in SCHEMA:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    conn.isolation_level = ""  # Back to implicit transactions for the callers
+    return conn
+
+def open_log_db_readonly(db_path):
+    """Read-only connection for viewers: never creates, migrates or writes anything."""
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+
+def migrate_v1(conn):
+    """Move rows of the free-text table (role, source, event, timestamp) into the new schema."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(logs)")]
+    if "timestamp" not in columns:
+        return
+    conn.execute("ALTER TABLE logs RENAME TO logs_v1")
+    for statement in SCHEMA:
+        conn.execute(statement)
+    # v1 'source' held the kind of event and 'event' the text; timestamps were local time
+    conn.execute("INSERT OR IGNORE INTO log_events (name) SELECT DISTINCT source FROM logs_v1")
+    conn.execute("""
+    INSERT INTO logs (id, ts, source, event, sid, username, message)
+    SELECT logs_v1.id, CAST(strftime('%s', logs_v1.timestamp, 'utc') AS INTEGER) * 1000,
+           logs_v1.role, log_events.id, NULL, NULL, logs_v1.event
+    FROM logs_v1 JOIN log_events ON log_events.name = logs_v1.source
+    ORDER BY logs_v1.id
+    """)
+    conn.execute("DROP TABLE logs_v1")
+
+# --- Partitions ---
+class LogPartition:
+    """One log database file: chat_logs-YYYYMMDD-NNN.db, gzipped (.gz) once cold.
+
+    A partition only holds rows logged on its day (local time); the legacy
+    chat_logs.db has no day and may hold anything.
+    """
+
+    def __init__(self, path, day=None, seq=0, compressed=False):
+        self.path = path
+        self.day = day            # datetime at local midnight, None for the legacy database
+        self.seq = seq
+        self.compressed = compressed
+
+    def overlaps(self, since=None, until=None):
+        """Whether rows between since and until (epoch ms, either may be None) can be in here."""
+        if self.day is None:
+            return True
+        start = int(self.day.timestamp() * 1000)
+        end = int((self.day + timedelta(days=1)).timestamp() * 1000)
+        return (since is None or end > since) and (until is None or start < until)
+
+    def __repr__(self):
+        return f"LogPartition({os.path.basename(self.path)!r})"
+
+def partition_path(day, seq, log_dir=LOG_DIR):
+    return os.path.join(log_dir, f"chat_logs-{day:%Y%m%d}-{seq:03d}.db")
+
+def list_partitions(log_dir=LOG_DIR):
+    """Every log partition in log_dir, oldest first (the legacy database before all others)."""
+    partitions = []
+    legacy = os.path.join(log_dir, os.path.basename(DB_PATH))
+    if os.path.exists(legacy):
+        partitions.append(LogPartition(legacy))
+    dated = []
+    for name in os.listdir(log_dir):
+        match = PARTITION_NAME.match(name)
+        if match:
+            dated.append(LogPartition(os.path.join(log_dir, name), datetime.strptime(match.group(1), "%Y%m%d"),
+                                      int(match.group(2)), bool(match.group(3))))
+    return partitions + sorted(dated, key=lambda partition: (partition.day, partition.seq))
+
+def current_partition_path(log_dir=LOG_DIR, rotate_bytes=ROTATE_BYTES):
+    """Partition to write to now: today's newest, or the next one if that is full."""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    seqs = [partition.seq for partition in list_partitions(log_dir) if partition.day == today]
+    seq = max(seqs, default=0)
+    path = partition_path(today, seq, log_dir)
+    if os.path.exists(path + ".gz") or (os.path.exists(path) and os.path.getsize(path) >= rotate_bytes):
+        path = partition_path(today, seq + 1, log_dir)
+    return path
+
+def compress_partition(path):
+    """Gzip a cold partition in place of the database file."""
+    if os.path.exists(path + "-wal"):
+        return False  # Still open somewhere
+    tmp_path = path + ".gz.tmp"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp_path, path + ".gz")
+    os.remove(path)
+    return True
+
+def migrate_legacy_db(log_dir=LOG_DIR):
+    """Bring the legacy chat_logs.db to the current schema in place. Returns whether it migrated.
+
+    It stays the undated partition: its rows span many days, so it cannot
+    become one of the daily ones.
+    """
+    legacy = os.path.join(log_dir, os.path.basename(DB_PATH))
+    if not os.path.exists(legacy):
+        return False
+    conn = open_log_db_readonly(legacy)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return False
+    finally:
+        conn.close()
+    conn = open_log_db(legacy)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # Leave a self-contained file for the viewers
+    finally:
         conn.close()
+    return True
+
+def maintain_partitions(log_dir=LOG_DIR, compress_after_days=COMPRESS_AFTER_DAYS,
+                        retention_days=RETENTION_DAYS, active_path=None):
+    """Migrate the legacy database, delete partitions past retention and compress cold ones.
+
+    Returns (deleted, compressed).
+    """
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    deleted = compressed = 0
+    try:
+        if migrate_legacy_db(log_dir):
+            print(f"[db_logger] Migrated {os.path.join(log_dir, os.path.basename(DB_PATH))} "
+                  "to the current log schema")
+    except sqlite3.Error as e:
+        print(f"[db_logger] Failed to migrate the legacy log database: {e}")
+    for partition in list_partitions(log_dir):
+        if partition.day is None or partition.path == active_path:
+            continue
+        try:
+            if retention_days is not None and partition.day < today - timedelta(days=retention_days):
+                for path in (partition.path, partition.path + "-wal", partition.path + "-shm"):
+                    if os.path.exists(path):
+                        os.remove(path)
+                deleted += 1
+            elif (not partition.compressed and compress_after_days is not None
+                  and partition.day < today - timedelta(days=compress_after_days)):
+                compressed += compress_partition(partition.path)
+        except OSError as e:
+            # Another process may be doing the same; the next rotation retries
+            print(f"[db_logger] Failed to maintain {partition.path}: {e}")
+    return deleted, compressed
+
+class BatchLogWriter:
+    """Buffers log rows in memory and writes them from a background thread.
+
+    Rows are flushed with one executemany() per transaction when BATCH_SIZE rows
+    are pending or FLUSH_INTERVAL has passed, so callers never wait on disk.
+    Event names are turned into log_events ids here, on the writer thread.
+
+    Without a db_path the writer rotates through daily partitions in log_dir
+    (and starts another one for the day past rotate_bytes); after each
+    rotation a helper thread compresses and expires old partitions.
+    """
+
+    def __init__(self, db_path=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 max_queue=MAX_QUEUE, drop_policy=DROP_POLICY, log_dir=LOG_DIR, rotate_bytes=ROTATE_BYTES):
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+
+        self.db_path = db_path
+        self.log_dir = log_dir
+        self.rotate_bytes = rotate_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+
+        self.dropped = 0         # Rows discarded by the drop policy
+        self.written = 0         # Rows committed to disk
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._flush_requested = 0  # Incremented by flush(), acknowledged by the writer
+        self._flush_done = 0
+        self._closing = False
+
+        self._open(db_path or current_partition_path(log_dir, rotate_bytes))
+        if not db_path:
+            self._start_maintenance()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        """Queue one (ts, source, event, sid, username, message) row. Returns False if it was dropped."""
+        with self._cond:
+            if self._closing:
+                return False
+
+            if len(self._pending) >= self.max_queue:
+                if self.drop_policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                elif self.drop_policy == "drop_oldest":
+                    self._pending.popleft()
+                    self.dropped += 1
+                else:
+                    # Back-pressure: wait for the writer to make room
+                    while len(self._pending) >= self.max_queue and not self._closing:
+                        self._cond.wait()
+
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """Block until every row queued before this call is committed."""
+        with self._cond:
+            self._flush_requested += 1
+            target = self._flush_requested
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: self._flush_done >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._conn.close()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while (len(self._pending) < self.batch_size and not self._closing
+                       and self._flush_done >= self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = list(self._pending)
+                self._pending.clear()
+                flush_target = self._flush_requested
+                closing = self._closing
+                self._cond.notify_all()  # Wake producers blocked on a full queue
+
+            if batch:
+                if self._should_rotate():
+                    self._rotate()
+                self._write(batch)
+
+            with self._cond:
+                self._flush_done = flush_target
+                self._cond.notify_all()
+
+            if closing:
+                return
+
+    # --- Partitions (writer thread) ---
+    def _open(self, path):
+        self.path = path
+        self._conn = open_log_db(path)
+        self._event_ids = dict(self._conn.execute("SELECT name, id FROM log_events"))  # Per database
+        self._day = datetime.now().date()
+
+    def _should_rotate(self):
+        if self.db_path:
+            return False
+        if datetime.now().date() != self._day:
+            return True
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return True  # Deleted under us
+        if os.path.exists(self.path + "-wal"):
+            size += os.path.getsize(self.path + "-wal")  # Rows not yet checkpointed
+        return size >= self.rotate_bytes
+
+    def _rotate(self):
+        self._conn.close()
+        self._open(current_partition_path(self.log_dir, self.rotate_bytes))
+        self._start_maintenance()
+
+    def _start_maintenance(self):
+        # Compression can take a while; the writer keeps writing meanwhile
+        threading.Thread(target=maintain_partitions, kwargs={'log_dir': self.log_dir, 'active_path': self.path},
+                         name="log-maintenance", daemon=True).start()
+
+    def _event_id(self, name):
+        event_id = self._event_ids.get(name)
+        if event_id is None:
+            self._conn.execute("INSERT OR IGNORE INTO log_events (name) VALUES (?)", (name,))
+            event_id = self._conn.execute("SELECT id FROM log_events WHERE name = ?", (name,)).fetchone()[0]
+            self._event_ids[name] = event_id
+        return event_id
+
+    def _write(self, batch):
+        try:
+            with self._conn:
+                rows = [(ts, source, self._event_id(event), sid, username, message)
+                        for ts, source, event, sid, username, message in batch]
+                self._conn.executemany(
+                    "INSERT INTO logs (ts, source, event, sid, username, message) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+            self.written += len(batch)
+        except sqlite3.Error as e:
+            self._event_ids = {}  # Ids from a rolled-back transaction may not exist
+            self.dropped += len(batch)
+            print(f"[db_logger] Failed to write {len(batch)} log rows: {e}")
+
+# --- Live feed ---
+ROW_FIELDS = ("ts", "source", "event", "sid", "username", "message")
+
+class LogSubscription:
+    """One subscriber: the rows it asked for, queued until its connection sends them."""
+
+    def __init__(self, filters):
+        self.events = set(filters.get("events") or ())
+        self.source = filters.get("source")
+        self.sid = filters.get("sid")
+        self.username = filters.get("username")
+        self.grep = filters.get("grep")
+        self.queue = queue.Queue(SUBSCRIBER_QUEUE)
+        self.missed = 0
+
+    def matches(self, row):
+        ts, source, event, sid, username, message = row
+        return ((not self.events or event in self.events)
+                and (self.source is None or source == self.source)
+                and (self.sid is None or sid == self.sid)
+                and (self.username is None or username == self.username)
+                and (self.grep is None or self.grep in message))
+
+    def offer(self, row):
+        if self.matches(row):
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                self.missed += 1
+
+class LogStream:
+    """Ring buffer of the newest rows, pushed to subscribers the moment they are logged."""
+
+    def __init__(self, size=RING_SIZE):
+        self._ring = deque(maxlen=size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, row):
+        with self._lock:
+            self._ring.append(row)
+            for subscription in self._subscribers:
+                subscription.offer(row)
+
+    def subscribe(self, filters, since_ts=None):
+        """Start a subscription, first replaying buffered rows from since_ts (epoch ms) on.
+
+        Rows at since_ts itself are replayed too: others may share that
+        millisecond with the last row the subscriber has, which it skips.
+        """
+        subscription = LogSubscription(filters)
+        with self._lock:
+            for row in self._ring:
+                if since_ts is None or row[0] >= since_ts:
+                    subscription.offer(row)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+class _LogStreamHandler(socketserver.StreamRequestHandler):
+    # Request: one JSON line {"filters": {...}, "since_ts": ms}; reply: one JSON row per line
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline() or b"{}")
+        except ValueError:
+            return
+        subscription = self.server.stream.subscribe(request.get("filters") or {}, request.get("since_ts"))
+        try:
+            while True:
+                try:
+                    row = subscription.queue.get(timeout=KEEPALIVE_INTERVAL)
+                    line = json.dumps(dict(zip(ROW_FIELDS, row))) + "\n"
+                except queue.Empty:
+                    line = "\n"  # Fails once the viewer has gone
+                self.wfile.write(line.encode())
+        except OSError:
+            pass
+        finally:
+            self.server.stream.unsubscribe(subscription)
+
+class LogStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, stream):
+        self.stream = stream
+        super().__init__(path, _LogStreamHandler)
+        os.chmod(path, 0o600)  # Logs are for the server's own user only
+
+def subscribe_log_stream(filters=None, since_ts=None, path=LOG_SOCKET):
+    """Connect to a running server's live feed. Yields row dicts until the server goes away.
+
+    Raises OSError straight away when nothing is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall((json.dumps({"filters": filters or {}, "since_ts": since_ts}) + "\n").encode())
+
+    def rows():
+        with sock, sock.makefile("rb") as lines:
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+    return rows()
+
+# Shared writer, started on first use so importing this module stays cheap
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BatchLogWriter()
+    return _writer
+
+def set_drop_policy(policy):
+    """Change what the shared writer does when its queue is full.
+
+    Servers running on an event loop (asyncio, or an unpatched eventlet hub)
+    must not use 'block', since a full queue would stall every connection.
+    """
+    if policy not in DROP_POLICIES:
+        raise ValueError(f"Unknown drop policy: {policy}")
+    writer = get_writer()
+    with writer._cond:
+        writer.drop_policy = policy
+
+# Live feed, only in processes that call start_log_stream()
+_stream = None
+_stream_server = None
+
+def start_log_stream(path=LOG_SOCKET):
+    """Serve this process's log rows live on a Unix socket. Returns False if that is not possible."""
+    global _stream, _stream_server
+    if _stream_server is not None:
+        return True
+    if not hasattr(socket, "AF_UNIX"):
+        return False
+    if os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(path)
+            print(f"[db_logger] Another process is streaming logs on {path}")
+            return False
+        except OSError:
+            os.remove(path)  # Left behind by a server that did not shut down cleanly
+    stream = LogStream()
+    try:
+        _stream_server = LogStreamServer(path, stream)
+    except OSError as e:
+        print(f"[db_logger] Cannot stream logs on {path}: {e}")
+        return False
+    _stream = stream
+    threading.Thread(target=_stream_server.serve_forever, name="log-stream", daemon=True).start()
+    return True
+
+def stop_log_stream():
+    global _stream, _stream_server
+    if _stream_server is not None:
+        _stream_server.shutdown()
+        _stream_server.server_close()
+        try:
+            os.remove(_stream_server.server_address)
+        except OSError:
+            pass
+    _stream = _stream_server = None
+
+def log_event(source, event, message, sid=None, username=None):
+    """Thread-safe, non-blocking log insertion"""
+    row = (time.time_ns() // 1_000_000, source, event, sid, username, message)
+    if _stream is not None:
+        _stream.publish(row)
+    return get_writer().put(row)
+
+def flush(timeout=None):
+    if _writer is not None:
+        return _writer.flush(timeout)
+    return True
+
+def close_logger():
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+
+# Drain anything still buffered when the process exits, and remove the feed's socket
+atexit.register(close_logger)
+atexit.register(stop_log_stream)
@@ -1,27 +1,267 @@
+import re
 import time
 import os
-from db_logger import cursor, conn  # Ensure conn is imported too
+import gzip
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from db_logger import (open_log_db_readonly, list_partitions, subscribe_log_stream,
+                       LOG_DIR, LOG_SOCKET, SCHEMA_VERSION, ROW_FIELDS)
+
+DEFAULT_LIMIT = 50        # Rows shown before following / when not following
+FOLLOW_INTERVAL = 0.5     # Seconds between checks for new rows in follow mode
+COUNTS_DEFAULT_SINCE = "1h"  # Aggregation window when --since is not given
+FEED_SOURCE = "server"    # Only the server process runs the live feed; clients' rows come from the database
+
+RELATIVE_TIME = re.compile(r"^(\d+)([smhd])$")
+TIME_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
 
 def clear_terminal():
     os.system('cls' if os.name == 'nt' else 'clear')
 
-def tail_logs(interval=2):
-    last_seen_id = 0
-    while True:
-        cursor.execute("SELECT * FROM logs WHERE id > ? ORDER BY timestamp ASC", (last_seen_id,))
-        new_rows = cursor.fetchall()
-        if new_rows:
-            for row in new_rows:
-                print(row)
-            last_seen_id = new_rows[-1][0]  # Update to last seen ID
-        time.sleep(interval)
+def parse_time(value):
+    """'15m', '2h', '7d' (ago) or a local 'YYYY-MM-DD[ HH:MM[:SS]]' -> epoch milliseconds."""
+    match = RELATIVE_TIME.match(value)
+    if match:
+        moment = datetime.now() - timedelta(**{TIME_UNITS[match.group(2)]: int(match.group(1))})
+    else:
+        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+            try:
+                moment = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise argparse.ArgumentTypeError(f"Invalid time: {value}")
+    return int(moment.timestamp() * 1000)
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts / 1000).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def format_row(row):
+    row_id, ts, source, event, sid, username, message = row
+    who = " ".join(part for part in (username, sid) if part)
+    return f"{row_id or '':>8} {format_ts(ts)} {source:<6} {event:<24} {who:<32} {message}"
+
+def build_filters(conn, args):
+    """WHERE clause and parameters for the command line filters.
+
+    Event names are turned into ids first, so the (event, ts) index does the work.
+    """
+    clauses, params = [], []
+    if args.event:
+        marks = ", ".join("?" * len(args.event))
+        ids = [row[0] for row in conn.execute(f"SELECT id FROM log_events WHERE name IN ({marks})", args.event)]
+        clauses.append(f"logs.event IN ({', '.join('?' * len(ids))})" if ids else "0")
+        params.extend(ids)
+    for column, value in (("source", args.source), ("sid", args.sid), ("username", args.user)):
+        if value:
+            clauses.append(f"logs.{column} = ?")
+            params.append(value)
+    if args.since is not None:
+        clauses.append("logs.ts >= ?")
+        params.append(args.since)
+    if args.until is not None:
+        clauses.append("logs.ts < ?")
+        params.append(args.until)
+    if args.grep:
+        clauses.append("logs.message LIKE ?")
+        params.append(f"%{args.grep}%")
+    return " AND ".join(clauses) or "1", params
+
+# --- Partitions ---
+@contextmanager
+def read_partition(partition):
+    """Read-only connection to one partition, or None if it still has the old schema.
+
+    Gzipped partitions are unpacked to a temporary file first.
+    """
+    if not partition.compressed:
+        conn = open_log_db_readonly(partition.path)
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                print(f"(Skipping {os.path.basename(partition.path)}: old log format, "
+                      "migrated by the logger when the server next starts)")
+                yield None
+            else:
+                yield conn
+        finally:
+            conn.close()
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".db")
+    try:
+        with os.fdopen(fd, "wb") as dst, gzip.open(partition.path, "rb") as src:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    finally:
+        os.remove(tmp_path)
+
+def partitions_for(args):
+    # Only partitions whose day can hold rows in the requested time range
+    return [partition for partition in list_partitions(args.log_dir) if partition.overlaps(args.since, args.until)]
+
+# --- Queries ---
+def show_rows(args):
+    # Newest partitions and rows first until the limit is reached, printed oldest first.
+    # Returns the newest timestamp shown and a Counter of the rows shown at it.
+    rows = []
+    for partition in reversed(partitions_for(args)):
+        with read_partition(partition) as conn:
+            if conn is None:
+                continue
+            where, params = build_filters(conn, args)
+            rows.extend(conn.execute(f"""
+                SELECT logs.id, logs.ts, logs.source, log_events.name, logs.sid, logs.username, logs.message
+                FROM logs JOIN log_events ON log_events.id = logs.event
+                WHERE {where} ORDER BY logs.ts DESC, logs.id DESC LIMIT ?""",
+                params + [args.limit - len(rows)]).fetchall())
+        if len(rows) >= args.limit:
+            break
+    for row in reversed(rows):
+        print(format_row(row))
+    newest = max((row[1] for row in rows), default=None)
+    return newest, Counter(row[1:] for row in rows if row[1] == newest)
+
+def follow_rows(args, shown=(None, None)):
+    """Print new rows as they are logged.
+
+    The server's rows come from its live feed if it has one, within
+    milliseconds; rows of other processes (the clients) are still read from
+    the database meanwhile.
+    """
+    since_ts, boundary = shown
+    boundary = Counter(boundary or ())
+    filters = {"events": args.event, "source": args.source, "sid": args.sid,
+               "username": args.user, "grep": args.grep}
+    try:
+        rows = subscribe_log_stream(filters, since_ts, args.socket)
+    except OSError:
+        print("(No live feed from a running server; watching the database instead)")
+        return poll_rows(args)
+
+    stop = threading.Event()
+    others = None
+    if args.source != FEED_SOURCE:
+        others = threading.Thread(target=poll_rows, args=(args,), daemon=True,
+                                  kwargs={"skip_source": FEED_SOURCE, "stop": stop})
+        others.start()
+    try:
+        for row in rows:
+            row = tuple(row[field] for field in ROW_FIELDS)
+            if row[0] == since_ts and boundary[row]:
+                boundary[row] -= 1  # Already printed from the database
+                continue
+            print(format_row((None,) + row))
+    finally:
+        stop.set()
+        if others is not None:
+            others.join()
+    print("(Live feed closed; watching the database instead)")
+    poll_rows(args)
+
+def poll_rows(args, interval=FOLLOW_INTERVAL, skip_source=None, stop=None):
+    """Print rows of the newest partition as they arrive, moving on when the logger rotates.
+
+    Rows from skip_source are left out; returns once stop is set.
+    """
+    partition = conn = None
+    last_id = 0
+    try:
+        while stop is None or not stop.is_set():
+            live = [p for p in list_partitions(args.log_dir) if not p.compressed]
+            if live and (partition is None or live[-1].path != partition.path):
+                if conn is not None:
+                    print_new_rows(conn, args, last_id, skip_source)  # Whatever was written before the switch
+                    conn.close()
+                    last_id = 0
+                else:
+                    # Starting out: everything up to now was shown by show_rows
+                    last_id = None
+                partition = live[-1]
+                conn = open_log_db_readonly(partition.path)
+                if last_id is None:
+                    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM logs").fetchone()[0]
+            if conn is not None:
+                last_id = print_new_rows(conn, args, last_id, skip_source)
+            if stop is None:
+                time.sleep(interval)
+            elif stop.wait(interval):
+                break
+    finally:
+        if conn is not None:
+            conn.close()
+
+def print_new_rows(conn, args, last_id, skip_source=None):
+    where, params = build_filters(conn, args)
+    if skip_source:
+        where += " AND logs.source != ?"
+        params.append(skip_source)
+    rows = conn.execute(f"""
+        SELECT logs.id, logs.ts, logs.source, log_events.name, logs.sid, logs.username, logs.message
+        FROM logs JOIN log_events ON log_events.id = logs.event
+        WHERE logs.id > ? AND {where} ORDER BY logs.id""", [last_id] + params).fetchall()
+    for row in rows:
+        print(format_row(row))
+    return rows[-1][0] if rows else last_id
+
+def show_counts(args):
+    """Rows per event per time bucket (seconds), oldest bucket first, summed over partitions."""
+    counts = Counter()
+    for partition in partitions_for(args):
+        with read_partition(partition) as conn:
+            if conn is None:
+                continue
+            where, params = build_filters(conn, args)
+            for bucket_index, event, count in conn.execute(f"""
+                SELECT counts.bucket, log_events.name, counts.n FROM (
+                    SELECT logs.ts / ? AS bucket, logs.event AS event, COUNT(*) AS n
+                    FROM logs WHERE {where} GROUP BY bucket, logs.event) AS counts
+                JOIN log_events ON log_events.id = counts.event""", [args.bucket * 1000] + params):
+                counts[bucket_index, event] += count
+    for (bucket_index, event), count in sorted(counts.items()):
+        print(f"{format_ts(bucket_index * args.bucket * 1000)[:-4]}  {event:<24} {count:>8}")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Query the chat server's logs.")
+    parser.add_argument("-e", "--event", action="append", help="Only this event (repeatable), e.g. global_msg")
+    parser.add_argument("-s", "--source", choices=("client", "server"), help="Only client or server rows")
+    parser.add_argument("--sid", help="Only rows for this Socket.IO session")
+    parser.add_argument("-u", "--user", help="Only rows for this username")
+    parser.add_argument("--since", type=parse_time, help="From this time: '15m', '2h', '7d' or 'YYYY-MM-DD[ HH:MM]'")
+    parser.add_argument("--until", type=parse_time, help="Up to this time, same formats as --since")
+    parser.add_argument("--grep", help="Only rows whose message contains this text")
+    parser.add_argument("-n", "--limit", type=int, default=DEFAULT_LIMIT, help="Rows to show (newest)")
+    parser.add_argument("-f", "--follow", action="store_true", help="Keep printing new rows as they are logged")
+    parser.add_argument("--counts", action="store_true", help="Count rows per event per --bucket instead")
+    parser.add_argument("--bucket", type=int, default=60, help="Aggregation bucket in seconds (default: 60)")
+    parser.add_argument("--log-dir", default=LOG_DIR, help="Directory holding the log partitions")
+    parser.add_argument("--socket", default=LOG_SOCKET, help="Live feed of a running server (used by --follow)")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    clear_terminal()
-    print("📜 Live log viewer started. Press Ctrl+C to exit.\n")
+    args = parse_args()
+    if args.counts and args.since is None:
+        args.since = parse_time(COUNTS_DEFAULT_SINCE)  # Never aggregate the whole history by accident
+
+    # Read-only connections: only the logger's writer thread ever writes
     try:
-        tail_logs()
+        if args.counts:
+            show_counts(args)
+        elif args.follow:
+            clear_terminal()
+            print("📜 Live log viewer started. Press Ctrl+C to exit.\n")
+            follow_rows(args, show_rows(args))
+        else:
+            show_rows(args)
     except KeyboardInterrupt:
         print("\nExiting viewer...")
-    finally:
-        conn.close()
@@ -0,0 +1,741 @@
+import os
+import sys
+import json
+import base64
+import asyncio
+import hashlib
+import socketio
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+
+from crypto_utils import is_legacy_ciphertext, forget_aes_key
+from crypto_pool import AsyncCryptoPool
+from cluster import AsyncBusManager
+from message_bus import connect_bus
+from outbound import AsyncOutboundScheduler
+from message_store import (GLOBAL_CHANNEL, PRIVATE_CHANNEL, HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX,
+                           SEARCH_PAGE_SIZE)
+from partial_uploads import PartialUpload, range_tree_root
+from server import (ChatServer, INDEX_HTML, UPLOAD_FOLDER, CHUNK_SIZE, RANGE_CHUNKS,
+                    MAX_DOWNLOAD_STREAMS, HOST, PORT, BUS_URL, BLOB_GC_INTERVAL, page_arg)
+from logs.db_logger import log_event, close_logger
+
+FILE_IO_WORKERS = 8               # Threads doing disk reads/writes for transfers
+
+
+# --- Blocking work, run on the file I/O pool ---
+def _open_upload(upload_id, filename, size, range_size, range_hashes, resume):
+    upload = PartialUpload(UPLOAD_FOLDER, upload_id, filename, size, range_size, range_hashes)
+    return upload, upload.open(resume=resume)
+
+def _store_chunk(upload, chunk, offset, chunk_hash):
+    # Returns 'ok', 'bad_chunk' (resend this chunk) or 'bad_range' (resend its range)
+    if chunk_hash and hashlib.sha256(chunk).hexdigest() != chunk_hash:
+        return 'bad_chunk'
+    return 'ok' if upload.write(chunk, offset) else 'bad_range'
+
+def _read_at(f, start, length):
+    f.seek(start)
+    return f.read(length)
+
+
+class AsyncChatServer(ChatServer):
+    """The chat server on asyncio: socketio.AsyncServer behind an ASGI app.
+
+    Handlers mirror ChatServer's; crypto runs on AsyncCryptoPool and transfer
+    disk I/O on a thread pool, so the loop itself only moves frames.
+    """
+
+    crypto_pool_class = AsyncCryptoPool
+    outbound_class = AsyncOutboundScheduler
+
+    def __init__(self, *args, **kwargs):
+        self.io_pool = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix="file-io")
+        self.upload_locks = {}   # Same keys as upload_files; writes to one upload are serialized
+        super().__init__(*args, **kwargs)
+
+    def connect_bus(self, bus_url):
+        # Plain blocking client; every call below goes through run_io
+        return connect_bus(bus_url)
+
+    def setup_transport(self):
+        manager = AsyncBusManager(self.bus) if self.bus else None
+        self.sio = socketio.AsyncServer(async_mode='asgi', client_manager=manager)
+        self.app = socketio.ASGIApp(self.sio, other_asgi_app=self.landing_page,
+                                    on_startup=self.on_startup)
+
+    def start_relay(self):
+        pass  # Needs the running loop; started from on_startup
+
+    def start_blob_gc(self):
+        pass  # Needs the running loop; started from on_startup
+
+    def in_order(self, handler):
+        @wraps(handler)
+        async def ordered(sid, data):
+            lock = self.message_locks.setdefault(sid, asyncio.Lock())
+            async with lock:
+                return await handler(sid, data)
+        return ordered
+
+    async def on_startup(self):
+        if self.cluster:
+            self.sio.start_background_task(self.relay_loop)
+        self.sio.start_background_task(self.blob_gc_loop)
+
+    async def blob_gc_loop(self):
+        while True:
+            await self.run_io(self.collect_blobs)
+            await self.sio.sleep(BLOB_GC_INTERVAL)
+
+    async def broadcast(self, event, data):
+        self.outbound.send_all(self.local_sids(), event, data)
+        if self.cluster:
+            await self.run_io(partial(self.cluster.send, None, 'broadcast', event=event, data=data))
+
+    async def roster(self):
+        if self.cluster:
+            return await self.run_io(self.cluster.usernames)
+        return self.users.usernames()
+
+    async def roster_seq(self):
+        if self.cluster:
+            return await self.run_io(self.cluster.roster_seq)
+        return self._roster_seq
+
+    async def next_roster_seq(self):
+        if self.cluster:
+            return await self.run_io(self.cluster.next_roster_seq)
+        self._roster_seq += 1
+        return self._roster_seq
+
+    async def flush_presence(self):
+        await self.sio.sleep(self.presence.window)
+        added, removed = self.presence.take()
+        if not added and not removed:
+            return
+        update = {'seq': await self.next_roster_seq(), 'added': added, 'removed': removed,
+                  'usernames': await self.roster()}
+        log_event("server", "presence", f"Joined: {', '.join(added) or '-'}; Left: {', '.join(removed) or '-'}")
+
+        self.outbound.send_presence(self.local_sids(), update)
+        if self.cluster:
+            await self.run_io(partial(self.cluster.send, None, 'presence', update=update))
+
+    def setup_routes(self):
+        if self.http_downloads:
+            print("[ASGI] HTTP downloads are only served in eventlet mode")
+            log_event("server", "http_downloads", "HTTP downloads are only served in eventlet mode")
+
+    async def landing_page(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        content_type = b'text/html; charset=utf-8'
+        if scope['path'] == '/':
+            status, body = 200, INDEX_HTML.encode()
+        elif scope['path'] == '/metrics':
+            status, body, content_type = 200, json.dumps(self.outbound.metrics()).encode(), b'application/json'
+        else:
+            status, body = 404, b"Not Found"
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type)]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def run_io(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.io_pool, fn, *args)
+
+    def register_events(self):
+        # --- Connection lifecycle ---
+        @self.sio.event
+        async def connect(sid, environ):
+            self.outbound.open(sid)
+            print(f"Client connected: {sid}")
+            log_event("server", "connect", f"Client {sid} connected.", sid=sid)
+
+        @self.sio.event
+        async def disconnect(sid):
+            # Handle disconnect: remove user and notify others
+            user = self.users.remove(sid)
+            username = user.username if user else None
+            self.aes_keys.pop(sid, None)
+            if user and self.cluster:
+                await self.run_io(self.cluster.release, user.username, sid)
+
+            if user and user.aes_key:
+                forget_aes_key(user.aes_key)
+            self.outbound.close(sid)
+            self.message_locks.pop(sid, None)
+
+            # Keep unfinished uploads on disk so the client can resume them later
+            for key in [key for key in self.upload_files if key[0] == sid]:
+                upload = self.upload_files.pop(key)
+                async with self.upload_locks.pop(key):
+                    await self.run_io(upload.close)
+
+            if user:
+                await self.rekey_group()
+
+            if username:
+                print(f"User {username} disconnected ({sid})")
+                self.presence_changed(username, joined=False)
+            else:
+                print(f"Client disconnected: {sid}")
+                log_event("server", "disconnect", f"Client disconnected: {sid}", sid=sid)
+
+        # --- Key exchange and user join/leave ---
+        @self.sio.event
+        async def exchange_key(sid, data):
+            # Decrypt and store AES key sent by client
+            encrypted_aes_b64 = data.get('encrypted_aes')
+            encrypted_aes = base64.b64decode(encrypted_aes_b64.encode())
+            try:
+                aes_key = await self.crypto.decrypt_rsa(encrypted_aes)
+                self.aes_keys[sid] = aes_key
+                print(f"[Key Exchange] AES key received for client {sid}")
+                log_event("server", "exchange_key", f"[Key Exchange] AES key received for client {sid}", sid=sid)
+            except Exception as e:
+                print(f"[Key Exchange] Failed: {e}")
+                log_event("server", "exchange_key_failed", f"[Key Exchange] Failed: {e}", sid=sid)
+
+        @self.sio.event
+        async def user_joined(sid, data):
+            # Finalize user join by binding username with sid and AES key
+            username = data.get('username', 'Unknown')
+            aes_key = self.aes_keys.pop(sid, None)
+            if data.get('roster_deltas'):
+                self.outbound.use_roster_deltas(sid)
+            if self.cluster and not await self.run_io(self.cluster.claim, username, sid):
+                print(f"Username {username} is already in use on another node")
+                log_event("server", "user_joined", f"Username '{username}' already claimed on another node (SID: {sid})",
+                          sid=sid, username=username)
+                self.aes_keys[sid] = aes_key  # The client may join again under another name
+                self.outbound.send(sid, 'join_rejected', {'username': username, 'reason': 'Username is already in use.'})
+                return
+            session = self.users.add(sid, username, aes_key)
+            print(f"User {username} joined with session ID {sid}")
+            await self.send_group_key(session)
+            self.presence_changed(username, joined=True)
+
+        @self.sio.event
+        async def user_left(sid, data):
+            # Remove user from list on leave event
+            username = data.get('username', 'Unknown')
+            user = self.users.remove(sid)
+            if user and self.cluster:
+                await self.run_io(self.cluster.release, user.username, sid)
+            if user:
+                await self.rekey_group()
+                self.presence_changed(user.username, joined=False)
+            print(f"User {username} left with session ID {sid}")
+            self.aes_keys.pop(sid, None)
+
+        # --- Messaging ---
+        @self.sio.event
+        @self.in_order
+        async def global_message(sid, data):
+            # Receive AES-encrypted global message, decrypt, re-encrypt for each user
+            sender = data.get('sender', 'Anonymous')
+            ciphertext = data.get('message', '')
+            sender_entry = self.users.get_by_sid(sid)
+
+            if not sender_entry:
+                print("Sender not found.")
+                log_event("server", "global_msg", "Sender not found.", sid=sid)
+                return
+            sender = sender_entry.username  # Never the name the client claims
+
+            try:
+                plaintext = await self.crypto.decrypt_aes(sender_entry.aes_key, ciphertext)
+                sender_entry.legacy_cbc = is_legacy_ciphertext(ciphertext)
+                print(f"[GLOBAL] From {sender}: {ciphertext}")
+                log_event("server", "global_msg", f"[GLOBAL] From {sender}: {ciphertext}", sid=sid, username=sender)
+            except Exception as e:
+                print(f"Failed to decrypt sender's message: {e}")
+                log_event("server", "global_msg", f"Failed to decrypt sender's message: {e}", sid=sid, username=sender)
+                return
+
+            message_id = await self.record_message(GLOBAL_CHANNEL, sender, None, plaintext=plaintext)
+            await self.deliver_global(sender, plaintext, message_id)
+            if self.cluster:
+                try:
+                    relayed = await self.crypto.encrypt_aes(self.cluster.key, plaintext)
+                    await self.run_io(partial(self.cluster.send, None, 'global_message', sender=sender,
+                                              message=relayed, id=message_id))
+                except Exception as e:
+                    print(f"Failed to relay global message: {e}")
+                    log_event("server", "global_msg", f"Failed to relay global message: {e}", sid=sid, username=sender)
+
+        @self.sio.event
+        @self.in_order
+        async def private_message(sid, data):
+            # Receive AES-encrypted private message, re-encrypt for specific recipient
+            recipient_name = data.get('recipient', '')
+            ciphertext = data.get('message', '')
+            sender = data.get('sender', 'Anonymous')
+
+            sender_entry = self.users.get_by_sid(sid)
+            recipient_entry = self.users.get_by_username(recipient_name)
+            location = None
+            if not recipient_entry and self.cluster:
+                location = await self.run_io(self.cluster.locate, recipient_name)
+
+            if not sender_entry or not (recipient_entry or location):
+                print("Sender or recipient not found.")
+                log_event("server", "private_msg", "Sender or recipient not found.", sid=sid, username=sender)
+                return
+            sender = sender_entry.username  # Never the name the client claims
+
+            try:
+                sender_entry.legacy_cbc = is_legacy_ciphertext(ciphertext)
+                print(f"[PRIVATE] From {sender} to {recipient_name}: {ciphertext}")
+                log_event("server", "private_msg", f"[PRIVATE] From {sender} to {recipient_name}: {ciphertext}", sid=sid, username=sender)
+                message_id = await self.record_message(PRIVATE_CHANNEL, sender, recipient_name,
+                                                       ciphertext=ciphertext, aes_key=sender_entry.aes_key)
+                if not recipient_entry:
+                    relayed = await self.crypto.reencrypt(sender_entry.aes_key, ciphertext, self.cluster.key)
+                    await self.run_io(partial(self.cluster.send, location[0], 'private_message', sender=sender,
+                                              recipient=recipient_name, message=relayed, id=message_id))
+                    return
+                re_encrypted = await self.crypto.reencrypt(sender_entry.aes_key, ciphertext,
+                                                           recipient_entry.aes_key, recipient_entry.legacy_cbc)
+                self.outbound.send(recipient_entry.sid, 'incoming_private_message',
+                                   {'message': re_encrypted, 'sender': sender, 'id': message_id})
+            except Exception as e:
+                print(f"Failed private message forwarding: {e}")
+                log_event("server", "private_msg", f"Failed private message forwarding: {e}", sid=sid, username=sender)
+
+        # --- User info ---
+        @self.sio.event
+        async def get_current_users(sid):
+            # Return current list of usernames
+            seq = await self.roster_seq()
+            return {'current_usernames': await self.roster(), 'seq': seq}
+
+        @self.sio.event
+        async def fetch_history(sid, data=None):
+            user = self.users.get_by_sid(sid)
+            if not user:
+                return {'messages': [], 'has_more': False}
+            data = data or {}
+            limit = page_arg(data.get('limit'), HISTORY_PAGE_SIZE, 1, HISTORY_PAGE_MAX)
+            try:
+                rows, has_more = await self.run_io(self.history.page, user.username, data.get('before_id'), limit)
+                results = await self.crypto.reencrypt_many([(self.history.key, row['message'], user.aes_key,
+                                                             user.legacy_cbc) for row in rows])
+            except Exception as e:
+                print(f"Failed to load history for {user.username}: {e}")
+                log_event("server", "fetch_history_failed", f"Failed to load history for {user.username}: {e}",
+                          sid=sid, username=user.username)
+                return {'messages': [], 'has_more': False}
+
+            messages = []
+            for row, message in zip(rows, results):
+                if isinstance(message, Exception):
+                    log_event("server", "fetch_history_failed", f"Failed to re-encrypt message {row['id']}: {message}",
+                              sid=sid, username=user.username)
+                    continue
+                messages.append(dict(row, message=message))
+            return {'messages': messages, 'has_more': has_more}
+
+        @self.sio.event
+        async def search_messages(sid, data=None):
+            # Ranked matches among global messages and the caller's own private ones
+            user = self.users.get_by_sid(sid)
+            data = data or {}
+            query = data.get('query', '')
+            if not user or not query:
+                return {'messages': [], 'has_more': False}
+            limit = page_arg(data.get('limit'), SEARCH_PAGE_SIZE, 1, HISTORY_PAGE_MAX)
+            offset = page_arg(data.get('offset'), 0, 0, sys.maxsize)
+            try:
+                rows, has_more = await self.run_io(self.history.search, user.username, query, offset, limit)
+                results = await self.crypto.reencrypt_many([(self.history.key, row['message'], user.aes_key,
+                                                             user.legacy_cbc) for row in rows])
+            except Exception as e:
+                print(f"Search failed for {user.username}: {e}")
+                log_event("server", "search_failed", f"Search failed for {user.username}: {e}", sid=sid, username=user.username)
+                return {'messages': [], 'has_more': False}
+
+            messages = [dict(row, message=message) for row, message in zip(rows, results)
+                        if not isinstance(message, Exception)]
+            return {'messages': messages, 'has_more': has_more}
+
+        # --- File transfer: Public & Private ---
+        @self.sio.event
+        async def start_upload(sid, data):
+            filename = data.get('filename', '')
+            sender = data.get('sender', 'Anonymous')
+            recipient = data.get('recipient', 'Global')
+            file_hash = data.get('file_hash')
+            size = data.get('size')
+            range_size = data.get('range_size')
+            range_hashes = data.get('range_hashes')
+            transfer_id = data.get('transfer_id')
+
+            if not recipient:
+                print("Recipient not found.")
+                log_event("server", "start_upload", "Recipient not found.", sid=sid, username=sender)
+                return
+
+            upload_id = self.upload_id_for(sid, filename, recipient, file_hash)
+            if upload_id is None:
+                print("Sender not found.")
+                log_event("server", "start_upload", "Sender not found.", sid=sid, username=sender)
+                return
+
+            if range_hashes and range_tree_root(range_hashes) != data.get('range_root'):
+                log_event("server", "start_upload", f"Ignoring inconsistent range hashes for {filename}")
+                range_hashes = None
+
+            try:
+                # Resuming rehashes the partial file, so this runs off the loop
+                upload, offset = await self.run_io(_open_upload, upload_id, filename, size,
+                                                   range_size, range_hashes, bool(file_hash))
+                key = (sid, filename, recipient, transfer_id)
+                self.upload_files[key] = upload
+                self.upload_locks[key] = asyncio.Lock()
+
+                if offset:
+                    print(f"[Upload from {sender} to Server] Resume: {filename} at byte {offset}")
+                    log_event("server", "start_upload", f"Resume upload: {filename} from {sender} to {recipient} at byte {offset}",
+                              sid=sid, username=sender)
+                else:
+                    print(f"[Upload from {sender} to Server] Start: {filename}")
+                    log_event("server", "start_upload", f"Start upload: {filename} from {sender} to {recipient}", sid=sid, username=sender)
+
+                return {'binary': True, 'offset': offset, 'ranges': bool(upload.range_size)}
+            except Exception as e:
+                print(f"[start_upload] Failed to create file: {e}")
+                log_event("server", "start_upload", f"Failed to create file: {e}")
+
+        @self.sio.event
+        async def upload_chunk(sid, data):
+            chunk = data.get('chunk_data', None)
+            if isinstance(chunk, str):
+                chunk = base64.b64decode(chunk)
+            filename = data.get('filename', '')
+            recipient = data.get('recipient', 'Global')
+            seq = data.get('seq')
+            offset = data.get('offset')
+            chunk_hash = data.get('chunk_hash')
+
+            key = (sid, filename, recipient, data.get('transfer_id'))
+            upload = self.upload_files.get(key)
+            if not upload:
+                return
+
+            try:
+                # Chunks of one upload are handled concurrently; their writes are not
+                async with self.upload_locks[key]:
+                    status = await self.run_io(_store_chunk, upload, chunk, offset, chunk_hash)
+
+                if status == 'bad_chunk':
+                    log_event("server", "upload_chunk_failed", f"Chunk hash mismatch for {filename} at byte {offset}")
+                    return {'seq': seq, 'ok': False}
+                if status == 'bad_range':
+                    log_event("server", "upload_chunk_failed", f"Range hash mismatch for {filename} at byte {offset}")
+                    return {'seq': seq, 'ok': False, 'resend_range': True}
+                return {'seq': seq, 'ok': True}
+            except Exception as e:
+                print(f"[upload_chunk] Failed to write chunk")
+                log_event("server", "upload_chunk_failed", f"Failed to write chunk for {filename}: {e}")
+                return {'seq': seq, 'ok': False}
+
+        @self.sio.event
+        async def finish_upload(sid, data):
+            filename = data.get('filename', '')
+            sender = data.get('sender', 'Anonymous')
+            recipient = data.get('recipient', 'Global')
+            client_hash = data.get('hash_file', '')
+            timestamp = data.get('time', '')
+
+            key = (sid, filename, recipient, data.get('transfer_id'))
+            upload = self.upload_files.get(key)
+            if not upload:
+                return
+
+            try:
+                async with self.upload_locks[key]:
+                    computed_hash = upload.hexdigest()
+
+                    if computed_hash != client_hash:
+                        print(f"[finish_upload] Hash mismatch: expected {client_hash}, got {computed_hash}")
+                        log_event("server", "finish_upload_failed", f"Hash mismatch for {filename}")
+
+                        await self.run_io(upload.discard)
+                        print(f"[finish_upload] Deleted corrupt file: {upload.data_path}")
+                        log_event("server", "delete_failed_upload_file", f"Deleted corrupt file: {upload.data_path}")
+
+                        await self.sio.emit('retry_sending', {
+                            'filename': filename,
+                            'sender': sender,
+                            'transfer_id': data.get('transfer_id')
+                        })
+                        return
+
+                    await self.run_io(upload.complete, self.files.blob_path(computed_hash))
+
+                # The index is only touched from the loop
+                stored_name = self.files.link(filename, computed_hash)
+                self.grant_blob(sid, computed_hash, recipient)
+                print(f"[Upload from {sender} to Server] Finished upload {filename}")
+                log_event("server", "finish_upload", f"Finished upload: {filename} from {sender} to {recipient} at {timestamp}",
+                          sid=sid, username=sender)
+
+                await self.announce_file(stored_name, sender, recipient, timestamp)
+
+            except Exception as e:
+                print(f"[finish_upload] Failed to finalize file")
+                log_event("server", "finish_upload_failed", f"Failed to finalize file {filename}: {e}")
+            finally:
+                self.upload_files.pop(key, None)
+                self.upload_locks.pop(key, None)
+
+        @self.sio.event
+        async def cancel_upload(sid, data):
+            key = (sid, data.get('filename', ''), data.get('recipient', 'Global'), data.get('transfer_id'))
+            upload = self.upload_files.pop(key, None)
+            if upload:
+                async with self.upload_locks.pop(key):
+                    await self.run_io(upload.close)
+                log_event("server", "cancel_upload", f"Upload cancelled: {key[1]}", sid=sid)
+
+        # --- Deduplication: skip uploading content the server already has ---
+        @self.sio.event
+        async def check_file(sid, data):
+            return {'exists': self.may_link(sid, data.get('file_hash', ''))}
+
+        @self.sio.event
+        async def link_file(sid, data):
+            filename = data.get('filename', '')
+            sender = data.get('sender', 'Anonymous')
+            recipient = data.get('recipient', 'Global')
+            file_hash = data.get('file_hash', '')
+            timestamp = data.get('time', '')
+
+            if not self.may_link(sid, file_hash):
+                print(f"[link_file] Unknown blob for {filename}")
+                log_event("server", "link_file_failed", f"Unknown blob {file_hash} for {filename}")
+                self.outbound.send(sid, 'retry_sending', {'filename': filename, 'sender': sender,
+                                                          'transfer_id': data.get('transfer_id')})
+                return
+
+            try:
+                stored_name = self.files.link(filename, file_hash)
+                self.grant_blob(sid, file_hash, recipient)
+                print(f"[Upload from {sender} to Server] Deduplicated {filename}")
+                log_event("server", "link_file", f"Linked existing blob: {filename} from {sender} to {recipient} at {timestamp}",
+                          sid=sid, username=sender)
+                await self.announce_file(stored_name, sender, recipient, timestamp)
+            except Exception as e:
+                print(f"[link_file] Failed to link file")
+                log_event("server", "link_file_failed", f"Failed to link file {filename}: {e}")
+
+        # --- Request download file ---
+        @self.sio.event
+        async def download_request(sid, data):
+            filename = data.get('filename', '')
+            binary = data.get('binary', False)
+            offset = data.get('offset', 0)
+            streams = data.get('streams', 1)
+            transfer_id = data.get('transfer_id')
+            path = self.resolve_file(filename)
+
+            if not path:
+                print(f"[download_request] File not found: {filename}")
+                log_event("server", "download_request_failed", f"File not found: {filename}")
+                return
+
+            size = os.path.getsize(path)
+            if not isinstance(offset, int) or not 0 <= offset <= size:
+                offset = 0
+            if not isinstance(streams, int) or streams < 1:
+                streams = 1
+            streams = min(streams, MAX_DOWNLOAD_STREAMS)
+
+            print(f"Start to downloading {filename}")
+            running = [streams]
+            range_bytes = CHUNK_SIZE * RANGE_CHUNKS
+            cancelled = asyncio.Event()
+            if transfer_id is not None:
+                self.download_cancels[(sid, transfer_id)] = cancelled
+
+            # Stream i reads every streams-th range off the loop, then emits its chunks
+            async def send_chunks(stream):
+                try:
+                    with open(path, 'rb') as f:
+                        size = os.fstat(f.fileno()).st_size
+                        for start in range(offset + stream * range_bytes, size, range_bytes * streams):
+                            data = await self.run_io(_read_at, f, start, range_bytes)
+                            for i in range(0, len(data), CHUNK_SIZE):
+                                chunk = data[i:i + CHUNK_SIZE]
+                                if not await self.outbound.wait_for_room(sid) or cancelled.is_set():
+                                    return
+                                chunk_data = chunk if binary else base64.b64encode(chunk).decode()
+                                self.outbound.send(sid, 'incoming_file_chunk', {
+                                        'chunk_data': chunk_data,
+                                        'filename': filename,
+                                        'offset': start + i,
+                                        'transfer_id': transfer_id})
+                except Exception as e:
+                    print(f"[send_chunks] Failed to send file: {e}")
+                    log_event("server", "send_chunks_failed", f"Failed to send file {filename}: {e}")
+                finally:
+                    running[0] -= 1
+                    if running[0] == 0:
+                        self.download_cancels.pop((sid, transfer_id), None)
+                    if running[0] == 0 and not cancelled.is_set():
+                        digest = await self.run_io(self.file_digest, filename, path)
+                        self.outbound.send(sid, 'finish_download', {'filename': filename, 'hash_file': digest,
+                                                                    'transfer_id': transfer_id})
+
+            for stream in range(streams):
+                self.sio.start_background_task(send_chunks, stream)
+            return {'size': size}
+
+        @self.sio.event
+        async def cancel_download(sid, data):
+            cancelled = self.download_cancels.get((sid, data.get('transfer_id')))
+            if cancelled:
+                cancelled.set()
+                log_event("server", "cancel_download", f"Download cancelled: {data.get('filename', '')}", sid=sid)
+
+    # --- File notifications ---
+    async def announce_file(self, filename, sender, recipient, timestamp):
+        announcement = {'filename': filename, 'sender': sender, 'time': timestamp}
+        if recipient == "Global":
+            await self.broadcast('incoming_global_file', announcement)
+        else:
+            recipient_entry = self.users.get_by_username(recipient)
+            if recipient_entry:
+                self.outbound.send(recipient_entry.sid, 'incoming_private_file', announcement)
+            else:
+                node_id, recipient_sid = await self.run_io(self.cluster.locate, recipient)
+                await self.run_io(partial(self.cluster.send, node_id, 'direct', sid=recipient_sid,
+                                          event='incoming_private_file', data=announcement))
+
+    # --- History ---
+    async def record_message(self, channel, sender, recipient, plaintext=None, ciphertext=None, aes_key=None):
+        try:
+            if plaintext is None:
+                plaintext = await self.crypto.decrypt_aes(aes_key, ciphertext)
+            body = await self.crypto.encrypt_aes(self.history.key, plaintext)
+            text = plaintext.split("|", 1)[-1]
+            return await self.run_io(self.history.add, channel, sender, recipient, body, text)
+        except Exception as e:
+            print(f"Failed to store message from {sender}: {e}")
+            log_event("server", "history_failed", f"Failed to store message from {sender}: {e}", username=sender)
+            return None
+
+    # --- Global delivery (this node's users) ---
+    async def deliver_global(self, sender, plaintext, message_id=None):
+        if self.group_key:
+            # Broadcast mode: one encryption, the same envelope queued for every session
+            try:
+                # Snapshot the epoch: a rekey may happen while the worker encrypts
+                epoch, group_key = self.group_key.epoch, self.group_key.key
+                message = await self.crypto.encrypt_aes(group_key, plaintext)
+                self.outbound.send_all(self.local_sids(), 'incoming_global_message',
+                                       {'epoch': epoch, 'message': message, 'sender': sender, 'id': message_id})
+            except Exception as e:
+                print(f"Failed to broadcast global message: {e}")
+                log_event("server", "global_msg", f"Failed to broadcast global message: {e}")
+            return
+
+        users = list(self.users)
+        results = await self.crypto.encrypt_many([(user.aes_key, plaintext, user.legacy_cbc) for user in users])
+        for user, re_encrypted in zip(users, results):
+            try:
+                if isinstance(re_encrypted, Exception):
+                    raise re_encrypted
+                self.outbound.send(user.sid, 'incoming_global_message',
+                                   {'message': re_encrypted, 'sender': sender, 'id': message_id})
+            except Exception as e:
+                print(f"Failed to re-encrypt for {user.username}: {e}")
+                log_event("server", "global_msg", f"Failed to re-encrypt for {user.username}: {e}", sid=user.sid, username=user.username)
+
+    # --- Cluster relay ---
+    async def relay_loop(self):
+        # The bus subscription blocks, so each message is fetched on the default executor
+        loop = asyncio.get_running_loop()
+        messages = self.cluster.messages()
+        while True:
+            item = await loop.run_in_executor(None, next, messages, None)
+            if item is None:
+                return
+            await self.handle_relay(*item)
+
+    async def handle_relay(self, kind, fields):
+        try:
+            if kind == 'presence':
+                self.outbound.send_presence(self.local_sids(), fields['update'])
+                return
+            if kind == 'broadcast':
+                self.outbound.send_all(self.local_sids(), fields['event'], fields['data'])
+                return
+            if kind == 'direct':
+                self.outbound.send(fields['sid'], fields['event'], fields['data'])
+                return
+            plaintext = await self.crypto.decrypt_aes(self.cluster.key, fields['message'])
+            if kind == 'global_message':
+                await self.deliver_global(fields['sender'], plaintext, fields.get('id'))
+            elif kind == 'private_message':
+                recipient_entry = self.users.get_by_username(fields['recipient'])
+                if not recipient_entry:
+                    log_event("server", "private_msg", f"Relayed message for unknown user {fields['recipient']}")
+                    return
+                re_encrypted = await self.crypto.encrypt_aes(recipient_entry.aes_key, plaintext, recipient_entry.legacy_cbc)
+                self.outbound.send(recipient_entry.sid, 'incoming_private_message',
+                                   {'message': re_encrypted, 'sender': fields['sender'], 'id': fields.get('id')})
+        except Exception as e:
+            print(f"[Cluster] Failed to handle relayed {kind}: {e}")
+            log_event("server", "cluster_relay_failed", f"Failed to handle relayed {kind}: {e}")
+
+    # --- Group key (broadcast mode) ---
+    async def send_group_key(self, session):
+        if not self.group_key or not session.aes_key:
+            return
+        try:
+            epoch = self.group_key.epoch
+            wrapped = await self.crypto.encrypt_aes(session.aes_key, self.group_key.key_b64(), session.legacy_cbc)
+            self.outbound.send(session.sid, 'group_key', {'epoch': epoch, 'key': wrapped})
+        except Exception as e:
+            print(f"[Group Key] Failed to send key to {session.username}: {e}")
+            log_event("server", "group_key_failed", f"Failed to send group key to {session.username}: {e}")
+
+    async def rekey_group(self):
+        if not self.group_key:
+            return
+        self.group_key.rotate()
+        epoch, key_b64 = self.group_key.epoch, self.group_key.key_b64()
+        log_event("server", "group_key", f"Group key rotated to epoch {epoch}")
+
+        sessions = [session for session in self.users if session.aes_key]
+        results = await self.crypto.encrypt_many([(session.aes_key, key_b64, session.legacy_cbc) for session in sessions])
+        for session, wrapped in zip(sessions, results):
+            if isinstance(wrapped, Exception):
+                print(f"[Group Key] Failed to send key to {session.username}: {wrapped}")
+                log_event("server", "group_key_failed", f"Failed to send group key to {session.username}: {wrapped}")
+                continue
+            self.outbound.send(session.sid, 'group_key', {'epoch': epoch, 'key': wrapped})
+
+    def close(self):
+        self.crypto.close()
+        self.io_pool.shutdown()
+        self.history.close()
+
+
+def serve(host=HOST, port=PORT, bus_url=BUS_URL):
+    import uvicorn
+
+    server = AsyncChatServer(bus_url=bus_url)
+    try:
+        uvicorn.run(server.app, host=host, port=port)
+    finally:
+        server.close()
+        close_logger()  # Drain buffered log rows before exiting
+
+
+# --- Entry Point ---
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,167 @@
+import os
+import re
+import json
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-node only
+    fcntl = None
+
+BLOB_DIR = "blobs"           # Under UPLOAD_FOLDER: blobs/<first 2 hex>/<sha256>
+INDEX_FILE = "index.json"    # Under UPLOAD_FOLDER: filename -> sha256
+LOCK_FILE = "index.lock"     # Serializes index updates between server processes
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+GC_GRACE = 600               # Seconds a new blob is spared: it may be stored but not linked yet
+
+
+class BlobStore:
+    """Content-addressed file store with a filename index.
+
+    Each distinct file is kept once, named by its SHA-256. Filenames shown in
+    the chat map to a digest and are never removed, since chat messages are
+    not; collect_garbage() removes blobs no name refers to, i.e. uploads that
+    were stored but failed to link.
+
+    Several server processes may share one root (e.g. over NFS): index updates
+    are read-modify-write under a file lock, and lookups reload the index when
+    another process has changed it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.blob_dir = os.path.join(root, BLOB_DIR)
+        self.index_path = os.path.join(root, INDEX_FILE)
+        self.lock_path = os.path.join(root, LOCK_FILE)
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+        self.names = {}   # filename -> digest
+        self.refs = {}    # digest -> number of filenames pointing at it
+        self._index_mtime = None
+        self._load()
+
+    # --- Blobs ---
+    def blob_path(self, digest):
+        if not DIGEST_RE.match(digest or ""):
+            raise ValueError(f"Invalid digest: {digest!r}")
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def has(self, digest):
+        try:
+            return os.path.exists(self.blob_path(digest))
+        except ValueError:
+            return False
+
+    # --- Names ---
+    def link(self, filename, digest):
+        """Point a filename at a blob and return the name it was stored under.
+
+        A name already used for different content gets a " (n)" suffix instead
+        of replacing the earlier file.
+        """
+        with self._locked():
+            self._load()
+            stored_name = filename
+            stem, ext = os.path.splitext(filename)
+            n = 1
+            while stored_name in self.names and self.names[stored_name] != digest:
+                stored_name = f"{stem} ({n}){ext}"
+                n += 1
+
+            if stored_name not in self.names:
+                self.names[stored_name] = digest
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+                self._save()
+        return stored_name
+
+    def digest_for(self, filename):
+        self._refresh()
+        return self.names.get(filename)
+
+    def path_for(self, filename):
+        self._refresh()
+        digest = self.names.get(filename)
+        return self.blob_path(digest) if digest else None
+
+    def collect_garbage(self, grace=GC_GRACE):
+        """Delete blobs no filename refers to, if older than grace seconds. Returns how many were removed.
+
+        Meant for a worker thread: it reads the index into a local copy and
+        leaves self.names alone. The blob walk runs without the index lock;
+        the lock is only held to confirm and delete the candidates.
+        """
+        cutoff = time.time() - grace
+        referenced = set(self._read_index()[1].values())
+        candidates = []
+        for prefix in os.listdir(self.blob_dir):
+            prefix_dir = os.path.join(self.blob_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in os.listdir(prefix_dir):
+                path = os.path.join(prefix_dir, digest)
+                if digest not in referenced and os.stat(path).st_ctime < cutoff:
+                    candidates.append((digest, path))
+        if not candidates:
+            return 0
+
+        removed = 0
+        with self._locked():
+            referenced = set(self._read_index()[1].values())
+            for digest, path in candidates:
+                try:
+                    # Linked, or stored again by a new upload, since the walk
+                    if digest in referenced or os.stat(path).st_ctime >= cutoff:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    # --- Index persistence ---
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # Pick up names linked by other server processes
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._index_mtime:
+            self._load()
+
+    def _read_index(self):
+        """(mtime_ns, names) of the index on disk; (None, {}) if there is none yet."""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+            with open(self.index_path) as f:
+                return mtime, json.load(f)
+        except FileNotFoundError:
+            return None, {}
+
+    def _load(self):
+        try:
+            self._index_mtime, self.names = self._read_index()
+        except (OSError, ValueError):
+            self.names = {}
+        self.refs = {}
+        for digest in self.names.values():
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.names, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
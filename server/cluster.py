@@ -0,0 +1,124 @@
+import json
+import uuid
+import asyncio
+import hashlib
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager  # Not exported by the package in 5.x
+
+# Scale-out: several chat server processes (on one machine or many) behind a
+# load balancer with sticky sessions, sharing one message bus and one
+# UPLOAD_FOLDER. Session keys never leave the node a user is connected to;
+# messages crossing nodes are re-encrypted under a cluster key.
+SOCKETIO_CHANNEL = "chat:socketio"
+NODES_CHANNEL = "chat:nodes"         # Relays for every node
+NODE_CHANNEL = "chat:node:{}"        # Relays for one node
+ROSTER_COUNTER = "roster_seq"
+
+
+class Cluster:
+    """This node's view of the cluster: the shared user directory and the
+    node-to-node relay used for messages that need re-encryption elsewhere.
+
+    The relay key is derived from the RSA private key, which every node of a
+    deployment already shares (clients encrypt to its public key).
+    """
+
+    def __init__(self, bus, private_key_path):
+        self.bus = bus
+        self.node_id = uuid.uuid4().hex[:12]
+        with open(private_key_path, 'rb') as f:
+            self.key = hashlib.sha256(b"chat-cluster-relay:" + f.read()).digest()
+
+    # --- Shared user directory ---
+    def claim(self, username, sid):
+        """Reserve a username for a user on this node. False if another node has it."""
+        return self.bus.claim(username, f"{self.node_id} {sid}")
+
+    def release(self, username, sid):
+        self.bus.release(username, f"{self.node_id} {sid}")
+
+    def locate(self, username):
+        # (node_id, sid) of a user anywhere in the cluster, or None
+        owner = self.bus.lookup(username)
+        return tuple(owner.split(" ", 1)) if owner else None
+
+    def usernames(self):
+        return tuple(self.bus.names())
+
+    def next_roster_seq(self):
+        return self.bus.incr(ROSTER_COUNTER)
+
+    def roster_seq(self):
+        return self.bus.counter(ROSTER_COUNTER)
+
+    # --- Relay ---
+    def send(self, node_id, kind, **fields):
+        # node_id None: every other node
+        channel = NODES_CHANNEL if node_id is None else NODE_CHANNEL.format(node_id)
+        self.bus.publish(channel, json.dumps(dict(fields, kind=kind, origin=self.node_id)).encode())
+
+    def messages(self):
+        """Yield (kind, fields) for relays addressed to this node, forever."""
+        for _, body in self.bus.subscribe([NODES_CHANNEL, NODE_CHANNEL.format(self.node_id)]):
+            try:
+                message = json.loads(body)
+            except ValueError:
+                continue
+            if message.get('origin') != self.node_id:
+                yield message.pop('kind', None), message
+
+
+# --- socketio client managers on top of a bus ---
+# Bus messages are JSON, never pickles: anything that can reach the broker can
+# publish, and must not be able to run code on the nodes.
+def _decode(manager, body):
+    try:
+        message = manager.json.loads(body)
+    except ValueError:
+        return None
+    return message if isinstance(message, dict) else None
+
+
+class BusManager(socketio.PubSubManager):
+    """Lets several socketio.Server processes share rooms and broadcasts."""
+
+    name = 'chatbus'
+
+    def __init__(self, bus, channel=SOCKETIO_CHANNEL, write_only=False):
+        self.bus = bus
+        super().__init__(channel=channel, write_only=write_only)
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, self.json.dumps(data).encode())
+
+    def _listen(self):
+        # Yield decoded dicts, so the base class never tries to unpickle a body
+        for _, body in self.bus.subscribe([self.channel]):
+            message = _decode(self, body)
+            if message is not None:
+                yield message
+
+
+class AsyncBusManager(AsyncPubSubManager):
+    """BusManager for socketio.AsyncServer; bus calls run on executor threads."""
+
+    name = 'asyncchatbus'
+
+    def __init__(self, bus, channel=SOCKETIO_CHANNEL, write_only=False):
+        self.bus = bus
+        super().__init__(channel=channel, write_only=write_only)
+
+    async def _publish(self, data):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.bus.publish, self.channel, self.json.dumps(data).encode())
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        messages = self.bus.subscribe([self.channel])
+        while True:
+            item = await loop.run_in_executor(None, next, messages, None)
+            if item is None:
+                return
+            message = _decode(self, item[1])
+            if message is not None:
+                yield message
@@ -0,0 +1,150 @@
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from crypto_utils import encrypt_aes, decrypt_aes, decrypt_rsa, load_rsa_private_key
+
+# Where CPU-bound crypto runs:
+#   'inline'  - on the calling (green) thread, as before
+#   'tpool'   - eventlet's native thread pool; the hub keeps serving other sockets
+#   'process' - a process pool, for multi-core throughput (waited on via tpool)
+CRYPTO_BACKEND = "tpool"
+CRYPTO_WORKERS = os.cpu_count() or 2
+ENCRYPT_BATCH = 64  # Re-encryptions handed to a worker per dispatch
+
+# --- Jobs (top-level so the process backend can pickle them) ---
+_worker_private_key = None
+
+def _decrypt_rsa_job(private_key_path, ciphertext):
+    # Each worker process loads the private key once
+    global _worker_private_key
+    if _worker_private_key is None:
+        _worker_private_key = load_rsa_private_key(private_key_path)
+    return decrypt_rsa(_worker_private_key, ciphertext)
+
+def _encrypt_batch_job(jobs):
+    results = []
+    for aes_key, plaintext, legacy in jobs:
+        try:
+            results.append(encrypt_aes(aes_key, plaintext, legacy))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def _reencrypt_job(src_key, ciphertext, dst_key, legacy):
+    return encrypt_aes(dst_key, decrypt_aes(src_key, ciphertext), legacy)
+
+def _reencrypt_batch_job(jobs):
+    results = []
+    for src_key, ciphertext, dst_key, legacy in jobs:
+        try:
+            results.append(_reencrypt_job(src_key, ciphertext, dst_key, legacy))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+class CryptoPool:
+    """Runs the server's CPU-bound crypto off the event loop.
+
+    Handlers call the methods below as if they were plain functions; with the
+    'tpool' or 'process' backend only the calling green thread waits, so
+    heartbeats and other users' deliveries keep flowing.
+    """
+
+    def __init__(self, private_key_path, backend=CRYPTO_BACKEND, workers=CRYPTO_WORKERS):
+        self.backend = backend
+        self.private_key_path = private_key_path
+        self.private_key = load_rsa_private_key(private_key_path)
+        self._processes = None
+
+        if backend == "process":
+            self._processes = ProcessPoolExecutor(max_workers=workers)
+        elif backend == "tpool":
+            os.environ.setdefault("EVENTLET_THREADPOOL_SIZE", str(workers))
+        elif backend != "inline":
+            raise ValueError(f"Unknown crypto backend: {backend}")
+
+    def run(self, fn, *args):
+        if self.backend == "inline":
+            return fn(*args)
+
+        from eventlet import tpool
+        if self.backend == "tpool":
+            return tpool.execute(fn, *args)
+        # Block a native thread, not the hub, while the process works
+        return tpool.execute(self._processes.submit(fn, *args).result)
+
+    # --- Operations used by the handlers ---
+    def decrypt_rsa(self, ciphertext):
+        if self._processes:
+            return self.run(_decrypt_rsa_job, self.private_key_path, ciphertext)
+        return self.run(decrypt_rsa, self.private_key, ciphertext)
+
+    def decrypt_aes(self, aes_key, ciphertext):
+        return self.run(decrypt_aes, aes_key, ciphertext)
+
+    def encrypt_aes(self, aes_key, plaintext, legacy=False):
+        return self.run(encrypt_aes, aes_key, plaintext, legacy)
+
+    def reencrypt(self, src_key, ciphertext, dst_key, legacy=False):
+        # Private messages: decrypt and re-encrypt in a single dispatch
+        return self.run(_reencrypt_job, src_key, ciphertext, dst_key, legacy)
+
+    def encrypt_many(self, jobs):
+        """Encrypt [(aes_key, plaintext, legacy), ...] in batches.
+
+        Returns one ciphertext per job, or the exception raised for that job.
+        """
+        results = []
+        for start in range(0, len(jobs), ENCRYPT_BATCH):
+            results.extend(self.run(_encrypt_batch_job, jobs[start:start + ENCRYPT_BATCH]))
+        return results
+
+    def reencrypt_many(self, jobs):
+        """Re-encrypt [(src_key, ciphertext, dst_key, legacy), ...] in batches, as encrypt_many."""
+        results = []
+        for start in range(0, len(jobs), ENCRYPT_BATCH):
+            results.extend(self.run(_reencrypt_batch_job, jobs[start:start + ENCRYPT_BATCH]))
+        return results
+
+    def close(self):
+        if self._processes:
+            self._processes.shutdown()
+
+
+class AsyncCryptoPool(CryptoPool):
+    """CryptoPool for the asyncio server: every operation returns an awaitable.
+
+    'tpool' maps to a plain thread pool here, since there is no eventlet hub.
+    """
+
+    def __init__(self, private_key_path, backend=CRYPTO_BACKEND, workers=CRYPTO_WORKERS):
+        super().__init__(private_key_path, backend, workers)
+        self._threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="crypto") \
+            if backend == "tpool" else None
+
+    async def run(self, fn, *args):
+        if self.backend == "inline":
+            return fn(*args)
+        executor = self._processes or self._threads
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def encrypt_many(self, jobs):
+        return await self._run_batches(_encrypt_batch_job, jobs)
+
+    async def reencrypt_many(self, jobs):
+        return await self._run_batches(_reencrypt_batch_job, jobs)
+
+    async def _run_batches(self, batch_job, jobs):
+        # Batches run concurrently on the pool instead of one after another
+        batches = [jobs[start:start + ENCRYPT_BATCH] for start in range(0, len(jobs), ENCRYPT_BATCH)]
+        results = []
+        for batch_results in await asyncio.gather(*(self.run(batch_job, batch) for batch in batches)):
+            results.extend(batch_results)
+        return results
+
+    def close(self):
+        super().close()
+        if self._threads:
+            self._threads.shutdown()
@@ -1,15 +1,67 @@
 import os, base64
+import threading
+from collections import OrderedDict
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding, serialization, hashes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa, padding as rsa_padding
 
 # AES part
 
+# Ciphertext envelopes:
+#   "g1:" + base64(nonce[12] + ciphertext + tag[16])   AES-256-GCM (current)
+#   base64(iv[16] + ciphertext)                         AES-256-CBC + PKCS7 (legacy, no prefix)
+# Base64 never contains ':', so the prefix cannot collide with a legacy message.
+GCM_PREFIX = "g1:"
+NONCE_SIZE = 12  # Random 96-bit nonces: fine well past 2^32 messages per key
+AEAD_CACHE_SIZE = 4096
+
+# session key -> AESGCM, reused for every message under that key; least recently used first.
+# Crypto runs on pool threads, so every access holds the lock.
+_aead_cache = OrderedDict()
+_aead_lock = threading.Lock()
+
 def generate_aes_key():
     return os.urandom(32)  # 256-bit random key
 
-def encrypt_aes(aes_key, message: str) -> str:
+def _aesgcm(aes_key: bytes) -> AESGCM:
+    with _aead_lock:
+        aead = _aead_cache.get(aes_key)
+        if aead is not None:
+            _aead_cache.move_to_end(aes_key)
+            return aead
+    aead = AESGCM(aes_key)  # Built outside the lock; a racing thread may build its own, which is harmless
+    with _aead_lock:
+        aead = _aead_cache.setdefault(aes_key, aead)
+        _aead_cache.move_to_end(aes_key)
+        while len(_aead_cache) > AEAD_CACHE_SIZE:
+            _aead_cache.popitem(last=False)  # Evict the least recently used key
+    return aead
+
+def forget_aes_key(aes_key):
+    # Drop the cached cipher once a session (or group key epoch) is over
+    with _aead_lock:
+        _aead_cache.pop(aes_key, None)
+
+def is_legacy_ciphertext(ciphertext_b64: str) -> bool:
+    return not ciphertext_b64.startswith(GCM_PREFIX)
+
+def encrypt_aes(aes_key, message: str, legacy: bool = False) -> str:
+    if legacy:
+        return encrypt_aes_cbc(aes_key, message)
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = _aesgcm(aes_key).encrypt(nonce, message.encode(), None)
+    return GCM_PREFIX + base64.b64encode(nonce + ciphertext).decode()
+
+def decrypt_aes(aes_key, ciphertext_b64: str) -> str:
+    if is_legacy_ciphertext(ciphertext_b64):
+        return decrypt_aes_cbc(aes_key, ciphertext_b64)
+    data = base64.b64decode(ciphertext_b64[len(GCM_PREFIX):].encode())
+    # Raises cryptography.exceptions.InvalidTag if the message was tampered with
+    return _aesgcm(aes_key).decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None).decode()
+
+def encrypt_aes_cbc(aes_key, message: str) -> str:
     iv = os.urandom(16)
     padder = padding.PKCS7(128).padder()
     padded_data = padder.update(message.encode()) + padder.finalize()
@@ -20,7 +72,7 @@ def encrypt_aes(aes_key, message: str) -> str:
 
     return base64.b64encode(iv + ciphertext).decode()
 
-def decrypt_aes(aes_key, ciphertext_b64: str) -> str:
+def decrypt_aes_cbc(aes_key, ciphertext_b64: str) -> str:
     data = base64.b64decode(ciphertext_b64.encode())
     iv = data[:16]
     ciphertext = data[16:]
@@ -0,0 +1,53 @@
+import os
+import mmap
+import hashlib
+
+HASH_READ_SIZE = 1024 * 1024
+
+
+class DownloadEngine:
+    """Serves stored files to downloaders.
+
+    Digests of files outside the blob store (whose index already names them)
+    are cached per (path, size, mtime) so a popular file is hashed at most
+    once, and chunks are sliced out of a memory-mapped view instead of being
+    read into fresh buffers.
+    """
+
+    def __init__(self):
+        self._digests = {}  # (path, size, mtime_ns) -> sha256 hex digest
+
+    def digest(self, path):
+        key = self._key(path)
+        digest = self._digests.get(key)
+        if digest is None:
+            hash_algo = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(HASH_READ_SIZE), b''):
+                    hash_algo.update(block)
+            digest = hash_algo.hexdigest()
+            self._digests[key] = digest
+        return digest
+
+    def iter_chunks(self, path, chunk_size, offset=0):
+        """Yield (position, memoryview) slices of the file from `offset` onwards."""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return  # mmap cannot map an empty file
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for position in range(offset, size, chunk_size):
+                        chunk = view[position:position + chunk_size]
+                        try:
+                            yield position, chunk
+                        finally:
+                            chunk.release()
+                finally:
+                    view.release()
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,24 @@
+import base64
+from crypto_utils import generate_aes_key, forget_aes_key
+
+
+class GroupKey:
+    """Rotating AES key shared by all joined users for global broadcasts.
+
+    The key is handed to each user wrapped in their own session key, and is
+    replaced (new epoch) whenever somebody leaves so they cannot read later
+    messages.
+    """
+
+    def __init__(self):
+        self.epoch = 0
+        self.key = generate_aes_key()
+
+    def rotate(self):
+        forget_aes_key(self.key)
+        self.epoch += 1
+        self.key = generate_aes_key()
+
+    def key_b64(self):
+        # What gets wrapped in each user's session key for the 'group_key' event
+        return base64.b64encode(self.key).decode()
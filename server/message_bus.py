@@ -0,0 +1,298 @@
+import sys
+import json
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from urllib.parse import urlparse
+
+# Shared by every chat server process of one deployment:
+#   - a pub/sub channel per socketio client manager and per node relay
+#   - a directory of claimed names (username -> owner), used for uniqueness and routing
+#   - named counters (e.g. the roster sequence number)
+#
+# Two implementations: the in-repo broker below (tcp://host:port), meant for
+# tests and single-machine setups, and Redis (redis://...) for real clusters.
+BROKER_HOST = "localhost"
+BROKER_PORT = 6380
+REDIS_DIRECTORY = "chat:users"
+REDIS_COUNTER = "chat:counter:{}"
+
+_FRAME_HEAD = struct.Struct("!II")  # header length, body length
+
+
+# --- Wire format: [header len][body len][JSON header][raw body] ---
+def send_frame(sock, header, body=b""):
+    head = json.dumps(header).encode()
+    sock.sendall(_FRAME_HEAD.pack(len(head), len(body)) + head + body)
+
+def recv_frame(sock):
+    """Return (header, body), or (None, None) once the peer has closed."""
+    prefix = _recv_exact(sock, _FRAME_HEAD.size)
+    if prefix is None:
+        return None, None
+    head_len, body_len = _FRAME_HEAD.unpack(prefix)
+    head = _recv_exact(sock, head_len)
+    body = _recv_exact(sock, body_len) if body_len else b""
+    if head is None or body is None:
+        return None, None
+    return json.loads(head), body
+
+def _recv_exact(sock, length):
+    buf = bytearray()
+    while len(buf) < length:
+        data = sock.recv(length - len(buf))
+        if not data:
+            return None
+        buf += data
+    return bytes(buf)
+
+
+# --- In-repo broker ---
+class _Subscriber:
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()  # Several publishers may write to one subscriber
+
+    def deliver(self, channel, body):
+        try:
+            with self.lock:
+                send_frame(self.sock, {'op': 'msg', 'channel': channel}, body)
+        except OSError:
+            pass  # Its own handler thread notices the broken connection
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server
+        subscriber = _Subscriber(self.request)
+        channels = set()
+        claims = {}  # name -> owner, released when this connection goes away
+        try:
+            while True:
+                header, body = recv_frame(self.request)
+                if header is None:
+                    return
+                op = header.get('op')
+                if op == 'pub':
+                    broker.publish(header['channel'], body)
+                elif op == 'sub':
+                    channels.update(header['channels'])
+                    broker.subscribe(header['channels'], subscriber)
+                else:
+                    value = broker.directory_op(op, header.get('name'), header.get('owner'))
+                    if op == 'claim' and value:
+                        claims[header['name']] = header['owner']
+                    elif op == 'release':
+                        claims.pop(header['name'], None)
+                    send_frame(self.request, {'op': 'reply', 'value': value})
+        except (OSError, ValueError, KeyError):
+            return
+        finally:
+            broker.unsubscribe(channels, subscriber)
+            for name, owner in claims.items():
+                broker.directory_op('release', name, owner)
+
+
+class BusBroker(socketserver.ThreadingTCPServer):
+    """Minimal pub/sub + name directory server, one thread per connection.
+
+    Names claimed over a connection are released when it closes, so a crashed
+    node does not keep its users' names reserved.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=(BROKER_HOST, BROKER_PORT)):
+        super().__init__(address, _BrokerHandler)
+        self.lock = threading.Lock()
+        self.channels = {}    # channel -> set of _Subscriber
+        self.directory = {}   # name -> owner, in claim order
+        self.counters = {}    # name -> int
+
+    def subscribe(self, channels, subscriber):
+        with self.lock:
+            for channel in channels:
+                self.channels.setdefault(channel, set()).add(subscriber)
+
+    def unsubscribe(self, channels, subscriber):
+        with self.lock:
+            for channel in channels:
+                self.channels.get(channel, set()).discard(subscriber)
+
+    def publish(self, channel, body):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscriber in subscribers:
+            subscriber.deliver(channel, body)
+
+    def directory_op(self, op, name, owner):
+        with self.lock:
+            if op == 'claim':
+                if name not in self.directory:
+                    self.directory[name] = owner
+                return self.directory[name] == owner
+            if op == 'release':
+                if self.directory.get(name) == owner:
+                    del self.directory[name]
+                    return True
+                return False
+            if op == 'get':
+                return self.directory.get(name)
+            if op == 'names':
+                return list(self.directory)
+            if op == 'incr':
+                self.counters[name] = self.counters.get(name, 0) + 1
+                return self.counters[name]
+            if op == 'counter':
+                return self.counters.get(name, 0)
+        raise ValueError(f"Unknown broker op: {op}")
+
+
+# --- Bus clients ---
+class BrokerBus:
+    """Client of BusBroker. With green=True it uses eventlet's cooperative
+    sockets, so it can be used from an unpatched eventlet server."""
+
+    def __init__(self, host=BROKER_HOST, port=BROKER_PORT, green=False):
+        if green:
+            from eventlet.green import socket as socket_module
+            from eventlet.semaphore import Semaphore as Lock
+        else:
+            socket_module, Lock = socket, threading.Lock
+        self._socket = socket_module
+        self.address = (host, port)
+        self._lock = Lock()
+        self._conn = self._socket.create_connection(self.address)  # Requests and publishes
+
+    def _request(self, op, name=None, owner=None):
+        with self._lock:
+            send_frame(self._conn, {'op': op, 'name': name, 'owner': owner})
+            header, _ = recv_frame(self._conn)
+        if header is None:
+            raise ConnectionError("Message broker closed the connection")
+        return header.get('value')
+
+    def publish(self, channel, body):
+        with self._lock:
+            send_frame(self._conn, {'op': 'pub', 'channel': channel}, body)
+
+    def subscribe(self, channels):
+        """Yield (channel, body) for every message published on `channels`."""
+        conn = self._socket.create_connection(self.address)
+        try:
+            send_frame(conn, {'op': 'sub', 'channels': list(channels)})
+            while True:
+                header, body = recv_frame(conn)
+                if header is None:
+                    return
+                yield header['channel'], body
+        finally:
+            conn.close()
+
+    # --- Name directory ---
+    def claim(self, name, owner):
+        return self._request('claim', name, owner)
+
+    def release(self, name, owner):
+        return self._request('release', name, owner)
+
+    def lookup(self, name):
+        return self._request('get', name)
+
+    def names(self):
+        return self._request('names')
+
+    # --- Counters ---
+    def incr(self, name):
+        return self._request('incr', name)
+
+    def counter(self, name):
+        return self._request('counter', name)
+
+    def close(self):
+        self._conn.close()
+
+
+class RedisBus:
+    """Redis pub/sub + a hash as the name directory (needs the redis package).
+
+    Unlike BusBroker, Redis does not know when a node dies, so a crashed
+    node's names stay claimed until released by hand.
+    """
+
+    _RELEASE = ("if redis.call('hget', KEYS[1], ARGV[1]) == ARGV[2] then "
+                "return redis.call('hdel', KEYS[1], ARGV[1]) end return 0")
+
+    def __init__(self, url, green=False):
+        if green:
+            import eventlet
+            redis = eventlet.import_patched('redis')
+        else:
+            import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, body):
+        self._redis.publish(channel, body)
+
+    def subscribe(self, channels):
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(*channels)
+        try:
+            for message in pubsub.listen():
+                channel = message['channel']
+                yield channel.decode() if isinstance(channel, bytes) else channel, message['data']
+        finally:
+            pubsub.close()
+
+    def claim(self, name, owner):
+        if self._redis.hsetnx(REDIS_DIRECTORY, name, owner):
+            return True
+        return self.lookup(name) == owner
+
+    def release(self, name, owner):
+        return bool(self._redis.eval(self._RELEASE, 1, REDIS_DIRECTORY, name, owner))
+
+    def lookup(self, name):
+        value = self._redis.hget(REDIS_DIRECTORY, name)
+        return value.decode() if value is not None else None
+
+    def names(self):
+        return [name.decode() for name in self._redis.hkeys(REDIS_DIRECTORY)]
+
+    def incr(self, name):
+        return self._redis.incr(REDIS_COUNTER.format(name))
+
+    def counter(self, name):
+        return int(self._redis.get(REDIS_COUNTER.format(name)) or 0)
+
+    def close(self):
+        self._redis.close()
+
+
+def connect_bus(url, green=False):
+    """Open a bus from a URL: tcp://host:port (BusBroker) or redis://..."""
+    parsed = urlparse(url)
+    if parsed.scheme == "tcp":
+        return BrokerBus(parsed.hostname or BROKER_HOST, parsed.port or BROKER_PORT, green=green)
+    if parsed.scheme in ("redis", "rediss"):
+        return RedisBus(url, green=green)
+    raise ValueError(f"Unsupported bus URL: {url}")
+
+
+# --- Entry Point: run the in-repo broker ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pub/sub broker for multi-process chat servers")
+    parser.add_argument('--host', default=BROKER_HOST,
+                        help="The broker has no authentication: bind it only to interfaces of trusted hosts")
+    parser.add_argument('--port', type=int, default=BROKER_PORT)
+    args = parser.parse_args()
+
+    with BusBroker((args.host, args.port)) as broker:
+        print(f"Message broker listening on {args.host}:{args.port}")
+        try:
+            broker.serve_forever()
+        except KeyboardInterrupt:
+            sys.exit(0)
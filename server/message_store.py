@@ -0,0 +1,138 @@
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+
+GLOBAL_CHANNEL = "global"
+PRIVATE_CHANNEL = "private"
+
+HISTORY_PAGE_SIZE = 50   # Messages per fetch_history page unless the client asks for fewer
+HISTORY_PAGE_MAX = 200   # Upper bound on what one fetch_history call may ask for
+MAX_MESSAGE_ID = 2 ** 63 - 1  # SQLite rowid limit: "before" this means the newest page
+
+SEARCH_PAGE_SIZE = 20      # Results per search_messages page
+SEARCH_CANDIDATES = 2000   # Newest visible matches that get ranked; bounds the cost of common words
+
+
+class MessageStore:
+    """Persistent chat history in SQLite (WAL), paged newest first by message id.
+
+    Bodies are stored encrypted under a key derived from the server's RSA
+    private key, so every node of a deployment can read the same file, and
+    are re-encrypted under the requesting user's session key on the way out.
+
+    Search uses a contentless FTS5 index keyed by message id: it holds the
+    words of each message (not the text itself), written in the same
+    transaction as the message.
+    """
+
+    def __init__(self, db_path, private_key_path):
+        with open(private_key_path, 'rb') as f:
+            self.key = hashlib.sha256(b"chat-history:" + f.read()).digest()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,      -- 'global' or 'private'
+            sender TEXT NOT NULL,
+            recipient TEXT,             -- NULL for global messages
+            body TEXT NOT NULL,         -- encrypted under self.key
+            timestamp REAL NOT NULL     -- epoch seconds
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages (channel, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_recipient ON messages (channel, recipient, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages (channel, sender, id);
+        CREATE INDEX IF NOT EXISTS idx_messages_time ON messages (timestamp);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='', tokenize='unicode61 remove_diacritics 2'
+        );
+        """)
+        self._conn.commit()
+
+    def add(self, channel, sender, recipient, body, text=None):
+        """Store one message (body already encrypted under self.key) and index its text. Returns its id."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO messages (channel, sender, recipient, body, timestamp) VALUES (?, ?, ?, ?, ?)",
+                (channel, sender, recipient, body, time.time()))
+            if text:
+                self._conn.execute("INSERT INTO messages_fts (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
+        return cursor.lastrowid
+
+    def page(self, username, before_id=None, limit=HISTORY_PAGE_SIZE):
+        """Messages visible to username with id < before_id, newest first.
+
+        Returns (rows, has_more). Each branch of the union walks its own index
+        backwards from before_id, so a page costs O(limit) however long the
+        history is.
+        """
+        if before_id is None:
+            before_id = MAX_MESSAGE_ID
+        with self._lock:
+            rows = self._conn.execute("""
+            SELECT * FROM (SELECT id, channel, sender, recipient, body, timestamp FROM messages
+                           WHERE channel = ? AND id < ? ORDER BY id DESC LIMIT ?)
+            UNION
+            SELECT * FROM (SELECT id, channel, sender, recipient, body, timestamp FROM messages
+                           WHERE channel = ? AND recipient = ? AND id < ? ORDER BY id DESC LIMIT ?)
+            UNION
+            SELECT * FROM (SELECT id, channel, sender, recipient, body, timestamp FROM messages
+                           WHERE channel = ? AND sender = ? AND id < ? ORDER BY id DESC LIMIT ?)
+            ORDER BY id DESC LIMIT ?
+            """, (GLOBAL_CHANNEL, before_id, limit + 1,
+                  PRIVATE_CHANNEL, username, before_id, limit + 1,
+                  PRIVATE_CHANNEL, username, before_id, limit + 1,
+                  limit + 1)).fetchall()
+
+        messages = [{'id': row[0], 'channel': row[1], 'sender': row[2], 'recipient': row[3],
+                     'message': row[4], 'timestamp': row[5]} for row in rows[:limit]]
+        return messages, len(rows) > limit
+
+    def search(self, username, query, offset=0, limit=SEARCH_PAGE_SIZE):
+        """Best matches for query among the messages visible to username.
+
+        Returns (rows, has_more), rows ranked by BM25 and carrying a 'score'
+        (lower is better). Only the SEARCH_CANDIDATES newest matches are
+        ranked: FTS5 walks its postings newest first and stops there, so a
+        word found in half of a million messages costs no more than a rare one.
+        """
+        match = fts_query(query)
+        if not match:
+            return [], False
+        with self._lock:
+            rows = self._conn.execute("""
+            SELECT id, channel, sender, recipient, body, timestamp, score FROM (
+                SELECT m.id, m.channel, m.sender, m.recipient, m.body, m.timestamp,
+                       bm25(messages_fts) AS score
+                FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                  AND (m.channel = ? OR m.recipient = ? OR m.sender = ?)
+                ORDER BY messages_fts.rowid DESC LIMIT ?)
+            ORDER BY score, id DESC LIMIT ? OFFSET ?
+            """, (match, GLOBAL_CHANNEL, username, username, SEARCH_CANDIDATES,
+                  limit + 1, offset)).fetchall()
+
+        messages = [{'id': row[0], 'channel': row[1], 'sender': row[2], 'recipient': row[3],
+                     'message': row[4], 'timestamp': row[5], 'score': row[6]} for row in rows[:limit]]
+        return messages, len(rows) > limit
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def fts_query(query):
+    """Turn free text into an FTS5 query in which every word must match.
+
+    Words are quoted so user input can never be FTS5 syntax. No prefix
+    matching: prefix doclists are built in full, which on common prefixes
+    costs far more than the whole search is allowed to take.
+    """
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words)
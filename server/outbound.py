@@ -0,0 +1,301 @@
+import time
+from collections import deque
+
+# Priority classes, highest first
+CONTROL, CHAT, FILE = 0, 1, 2
+CLASS_NAMES = ("control", "chat", "file")
+
+EVENT_PRIORITY = {
+    'user_joined': CONTROL,
+    'user_left': CONTROL,
+    'group_key': CONTROL,
+    'presence': CONTROL,
+    'incoming_file_chunk': FILE,
+    'finish_download': FILE,   # Must stay behind the chunks it completes
+}                              # Everything else is CHAT
+PRESENCE_EVENTS = ('user_joined', 'user_left')
+
+# Limits per session
+MAX_QUEUED = {CONTROL: 1000, CHAT: 2000}  # Messages waiting before the consumer counts as too slow
+MAX_FILE_BYTES = 4 * 1024 * 1024           # Queued chunk bytes before the download waits
+TRANSPORT_HIGH_WATER = 16                  # Messages sent but not yet acknowledged before we hold back
+ACK_TIMEOUT = 10.0                         # Seconds without an ack before unacknowledged messages are written off
+POLL_INTERVAL = 0.005                      # First wait when holding back; doubles on every check after it
+MAX_POLL_INTERVAL = 0.1                    # Longest wait between checks
+SLOW_CONSUMER_POLICY = "disconnect"        # Over MAX_QUEUED: 'disconnect' the client or 'drop_oldest'
+
+SLOW_CONSUMER_POLICIES = ("disconnect", "drop_oldest")
+
+
+class SessionQueue:
+    """Pending outbound messages of one session, one FIFO per priority class.
+
+    For clients that take the full roster with every presence update, those
+    updates coalesce: a newer join/leave for the same username takes the place
+    of the pending one, and a join followed by a leave cancels out. Clients
+    using roster deltas get every update, since each one carries a sequence
+    number they check for gaps.
+    """
+
+    def __init__(self):
+        self.queues = (deque(), deque(), deque())
+        self.file_bytes = 0
+        self.presence = {}     # username -> pending presence entry
+        self.pumping = False
+        self.closed = False
+        self.roster_deltas = False   # Client applies 'added'/'removed' instead of 'usernames'
+        self.in_flight = 0           # Emitted messages the client has not acknowledged yet
+        self.last_progress = 0.0     # When in_flight last went up from 0 or down
+
+    def window_open(self):
+        """Whether another message may go out, judged by the client's acks."""
+        if self.in_flight < TRANSPORT_HIGH_WATER:
+            return True
+        if time.monotonic() - self.last_progress > ACK_TIMEOUT:
+            self.in_flight = 0   # Acks lost (e.g. a handler that raised); do not stall the session
+            return True
+        return False
+
+    def emitted(self):
+        if not self.in_flight:
+            self.last_progress = time.monotonic()
+        self.in_flight += 1
+
+    def ack(self, *args):
+        # Socket.IO ack callback; clients answer every event sent with one
+        if self.in_flight:
+            self.in_flight -= 1
+        self.last_progress = time.monotonic()
+
+    def push(self, event, data, priority):
+        """Queue one message. Returns (coalesced, over_limit)."""
+        if event in PRESENCE_EVENTS and not self.roster_deltas:
+            username = data.get('username')
+            pending = self.presence.get(username)
+            if pending is not None:
+                if pending[0] == 'user_joined' and event == 'user_left':
+                    pending[0] = None   # Never announced, so nothing to take back
+                    del self.presence[username]
+                else:
+                    pending[0], pending[1] = event, data
+                return True, False
+
+        entry = [event, data]
+        self.queues[priority].append(entry)
+        if event in PRESENCE_EVENTS and not self.roster_deltas:
+            self.presence[data.get('username')] = entry
+        if priority == FILE:
+            self.file_bytes += _payload_size(data)
+        return False, priority in MAX_QUEUED and len(self.queues[priority]) > MAX_QUEUED[priority]
+
+    def pop(self):
+        for priority, queue in enumerate(self.queues):
+            while queue:
+                entry = queue.popleft()
+                event, data = entry
+                if event is None:
+                    continue  # Cancelled by coalescing
+                if event in PRESENCE_EVENTS and self.presence.get(data.get('username')) is entry:
+                    del self.presence[data.get('username')]
+                if priority == FILE:
+                    self.file_bytes -= _payload_size(data)
+                return event, data
+        return None
+
+    def drop_oldest(self, priority):
+        queue = self.queues[priority]
+        while queue:
+            entry = queue.popleft()
+            if entry[0] in PRESENCE_EVENTS and self.presence.get(entry[1].get('username')) is entry:
+                del self.presence[entry[1].get('username')]
+            if entry[0] is not None:
+                return True
+        return False
+
+    def depths(self):
+        depths = {name: len(queue) for name, queue in zip(CLASS_NAMES, self.queues)}
+        depths['file_bytes'] = self.file_bytes
+        return depths
+
+
+def backoff():
+    """Waits between checks of a condition: POLL_INTERVAL, doubling up to MAX_POLL_INTERVAL."""
+    delay = POLL_INTERVAL
+    while True:
+        yield delay
+        delay = min(delay * 2, MAX_POLL_INTERVAL)
+
+def _payload_size(data):
+    chunk = data.get('chunk_data') if isinstance(data, dict) else None
+    return len(chunk) if chunk else 0
+
+
+class OutboundScheduler:
+    """Per-session outbound queues in front of Socket.IO.
+
+    Every message for a session waits here and is handed to Socket.IO by that
+    session's pump only while few of the messages already sent are still
+    unacknowledged by the client, so control traffic overtakes chat, chat
+    overtakes file chunks, and one slow client only ever backs up its own
+    queues. While it holds back, the pump checks again after exponentially
+    growing waits.
+    """
+
+    def __init__(self, sio, policy=SLOW_CONSUMER_POLICY):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.sio = sio
+        self.policy = policy
+        self.sessions = {}          # sid -> SessionQueue
+        self.latest_roster = None   # Substituted into presence updates as they go out
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.slow_consumers = 0
+
+    # --- Sessions ---
+    def open(self, sid):
+        self.sessions.setdefault(sid, SessionQueue())
+
+    def close(self, sid):
+        queue = self.sessions.pop(sid, None)
+        if queue:
+            queue.closed = True
+
+    def use_roster_deltas(self, sid):
+        queue = self.sessions.get(sid)
+        if queue:
+            queue.roster_deltas = True
+
+    # --- Producers ---
+    def send(self, sid, event, data):
+        queue = self.sessions.get(sid)
+        if queue is None:
+            return  # Not connected (any more)
+
+        priority = EVENT_PRIORITY.get(event, CHAT)
+        if event in PRESENCE_EVENTS and 'usernames' in data:
+            self.latest_roster = data['usernames']
+        coalesced, over_limit = queue.push(event, data, priority)
+        if coalesced:
+            self.coalesced += 1
+        if over_limit:
+            self._slow_consumer(sid, queue, priority)
+
+        if not queue.pumping and not queue.closed:
+            queue.pumping = True
+            self.sio.start_background_task(self._pump, sid, queue)
+
+    def send_all(self, sids, event, data):
+        for sid in sids:
+            self.send(sid, event, data)
+
+    def send_presence(self, sids, update):
+        """Hand one batched presence update to every session in the form it understands."""
+        delta = {key: value for key, value in update.items() if key != 'usernames'}
+        for sid in sids:
+            queue = self.sessions.get(sid)
+            if queue is None:
+                continue
+            if queue.roster_deltas:
+                self.send(sid, 'presence', delta)
+                continue
+            # Full-roster clients: one join/leave per name, as before
+            for username in update['added']:
+                self.send(sid, 'user_joined', {'username': username, 'usernames': update['usernames']})
+            for username in update['removed']:
+                self.send(sid, 'user_left', {'username': username, 'usernames': update['usernames']})
+
+    def has_room(self, sid):
+        queue = self.sessions.get(sid)
+        return queue is None or queue.file_bytes < MAX_FILE_BYTES
+
+    def wait_for_room(self, sid):
+        """Hold a file sender until the session's chunk queue drains. False once the session is gone."""
+        for delay in backoff():
+            if self.has_room(sid):
+                break
+            self.sio.sleep(delay)
+        return sid in self.sessions
+
+    # --- Metrics ---
+    def metrics(self):
+        return {
+            'sessions': len(self.sessions),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'slow_consumers': self.slow_consumers,
+            'queues': {sid: dict(queue.depths(), in_flight=queue.in_flight)
+                       for sid, queue in list(self.sessions.items())},
+        }
+
+    # --- Pump ---
+    def _pump(self, sid, queue):
+        try:
+            delays = backoff()
+            while not queue.closed:
+                if not queue.window_open():
+                    self.sio.sleep(next(delays))
+                    continue
+                delays = backoff()
+                item = queue.pop()
+                if item is None:
+                    break
+                queue.emitted()
+                self.sio.emit(item[0], self._outgoing(queue, *item), room=sid, ignore_queue=True,
+                              callback=queue.ack)
+                self.sent += 1
+        finally:
+            queue.pumping = False
+
+    def _outgoing(self, queue, event, data):
+        if event not in PRESENCE_EVENTS:
+            return data
+        # A full-roster update always carries the newest roster, however long it waited
+        if self.latest_roster is not None:
+            return dict(data, usernames=self.latest_roster)
+        return data
+
+    def _slow_consumer(self, sid, queue, priority):
+        if self.policy == "drop_oldest":
+            if queue.drop_oldest(priority):
+                self.dropped += 1
+            return
+        self.slow_consumers += 1
+        queue.closed = True
+        self.sessions.pop(sid, None)
+        self._disconnect(sid)
+
+    def _disconnect(self, sid):
+        self.sio.start_background_task(self.sio.disconnect, sid)
+
+
+class AsyncOutboundScheduler(OutboundScheduler):
+    """OutboundScheduler for socketio.AsyncServer."""
+
+    async def wait_for_room(self, sid):
+        for delay in backoff():
+            if self.has_room(sid):
+                break
+            await self.sio.sleep(delay)
+        return sid in self.sessions
+
+    async def _pump(self, sid, queue):
+        try:
+            delays = backoff()
+            while not queue.closed:
+                if not queue.window_open():
+                    await self.sio.sleep(next(delays))
+                    continue
+                delays = backoff()
+                item = queue.pop()
+                if item is None:
+                    break
+                queue.emitted()
+                await self.sio.emit(item[0], self._outgoing(queue, *item), room=sid, ignore_queue=True,
+                                    callback=queue.ack)
+                self.sent += 1
+        finally:
+            queue.pumping = False
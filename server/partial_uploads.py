@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+
+PARTIAL_DIR = ".partial"     # Under UPLOAD_FOLDER: <upload_id>.part + <upload_id>.json
+SAVE_STATE_EVERY = 16        # Persist the confirmed offset every N chunks
+HASH_READ_SIZE = 1024 * 1024
+
+
+def range_tree_root(range_hashes):
+    # Root of the two-level hash tree: SHA-256 over the concatenated range digests
+    return hashlib.sha256(b"".join(bytes.fromhex(h) for h in range_hashes)).hexdigest()
+
+
+class RangeFile:
+    """A file assembled from chunks that may arrive out of order.
+
+    Chunks are written at their byte offset. `offset` is the contiguous prefix
+    that has been hashed (and, with a range tree, verified); it is persisted
+    next to the data so an interrupted transfer can resume from it.
+
+    With `range_hashes` (one SHA-256 per `range_size` bytes) every range is
+    checked as soon as its last chunk lands, so corruption is caught and
+    re-requested per range instead of at the very end. `range_size` must be a
+    multiple of the chunk size.
+    """
+
+    def __init__(self, data_path, state_path, size=None, range_size=None, range_hashes=None, meta=None):
+        self.data_path = data_path
+        self.state_path = state_path
+        self.size = size
+        self.meta = meta or {}   # Extra fields saved with the state
+
+        use_ranges = bool(range_hashes and range_size and size is not None)
+        self.range_size = range_size if use_ranges else None
+        self.range_hashes = range_hashes if use_ranges else []
+
+        self.offset = 0          # Bytes hashed contiguously from the start
+        self.chunks = {}         # offset -> length of chunks on disk past self.offset
+        self.range_bytes = {}    # range index -> bytes received so far
+        self.verified = {}       # range index -> verified data (or None) not yet reached by the prefix
+        self.hash = hashlib.sha256()
+        self.file = None
+        self._append_at = 0      # Where chunks without an offset go
+        self._unsaved = 0
+
+    def open(self, resume=True):
+        """Open the data file and return the offset the sender should continue from."""
+        if resume:
+            state = self._load_state()
+            if state and state.get('size') == self.size and os.path.exists(self.data_path):
+                self.offset = min(state.get('offset', 0), os.path.getsize(self.data_path))
+
+        self.file = open(self.data_path, 'r+b' if self.offset else 'w+b')
+        if self.offset:
+            # Drop anything past the last confirmed offset and rebuild the running hash
+            self.file.truncate(self.offset)
+            remaining = self.offset
+            while remaining:
+                block = self.file.read(min(HASH_READ_SIZE, remaining))
+                if not block:
+                    break
+                self.hash.update(block)
+                remaining -= len(block)
+        self._append_at = self.offset
+
+        self.save_state()
+        return self.offset
+
+    def write(self, chunk, offset=None):
+        """Store one chunk at its offset.
+
+        Returns False when the chunk completed a range whose hash did not match;
+        that range is forgotten and has to be sent again.
+        """
+        # Chunks without an offset (old peers) are appended as they come
+        if offset is None:
+            offset = self._append_at
+        if not chunk or offset < self.offset or offset in self.chunks:
+            return True  # Empty or already written (retransmission)
+
+        self.file.seek(offset)
+        self.file.write(chunk)
+        self.chunks[offset] = len(chunk)
+        self._append_at = max(self._append_at, offset + len(chunk))
+
+        ok = True
+        if self.range_size:
+            index = offset // self.range_size
+            if offset % self.range_size + len(chunk) > self.range_size:
+                # Chunk straddles two ranges: the sender's layout is unusable, verify at the end only
+                self.range_size = None
+            else:
+                self.range_bytes[index] = self.range_bytes.get(index, 0) + len(chunk)
+                if self.range_bytes[index] >= self._range_length(index):
+                    ok = self._verify_range(index)
+
+        self._advance(offset, chunk)
+
+        self._unsaved += 1
+        if self._unsaved >= SAVE_STATE_EVERY:
+            self.save_state()
+        return ok
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def save_state(self):
+        if self.file:
+            self.file.flush()
+        state = dict(self.meta, size=self.size, offset=self.offset)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+        self._unsaved = 0
+
+    def close(self):
+        # Interrupted: keep data and state so the transfer can resume
+        if self.file:
+            self.save_state()
+            self.file.close()
+            self.file = None
+
+    def complete(self, dest_path):
+        self.file.close()
+        self.file = None
+        os.makedirs(os.path.dirname(os.path.abspath(dest_path)), exist_ok=True)
+        os.replace(self.data_path, dest_path)
+        self._remove(self.state_path)
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self._remove(self.data_path)
+        self._remove(self.state_path)
+
+    # --- Range tree ---
+    def _range_length(self, index):
+        return min(self.range_size, self.size - index * self.range_size)
+
+    def _verify_range(self, index):
+        start = index * self.range_size
+        length = self._range_length(index)
+        data = self._read(start, length)
+
+        if index < len(self.range_hashes) and hashlib.sha256(data).hexdigest() == self.range_hashes[index]:
+            # Keep the bytes only if the prefix hash is about to consume them
+            self.verified[index] = data if start == self.offset else None
+            return True
+
+        # Bad range: forget its chunks so the retransmission is accepted
+        for chunk_offset in [o for o in self.chunks if start <= o < start + length]:
+            del self.chunks[chunk_offset]
+        self.range_bytes.pop(index, None)
+        return False
+
+    def _advance(self, offset, chunk):
+        # Extend the hashed prefix over whatever is now contiguous
+        while True:
+            if self.range_size:
+                index = self.offset // self.range_size
+                if index not in self.verified:
+                    break
+                data = self.verified.pop(index)
+                length = self._range_length(index)
+                if data is None:
+                    data = self._read(self.offset, length)
+                end = self.offset + length
+                for chunk_offset in [o for o in self.chunks if o < end]:
+                    del self.chunks[chunk_offset]
+                self.range_bytes.pop(index, None)
+            else:
+                length = self.chunks.pop(self.offset, None)
+                if length is None:
+                    break
+                # In-order chunks are hashed straight from memory
+                data = chunk if self.offset == offset else self._read(self.offset, length)
+
+            self.hash.update(data)
+            self.offset += length
+
+    def _read(self, start, length):
+        self.file.flush()
+        self.file.seek(start)
+        return self.file.read(length)
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _remove(path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class PartialUpload(RangeFile):
+    """An upload in progress, kept under UPLOAD_FOLDER/.partial so it can resume."""
+
+    def __init__(self, upload_folder, upload_id, filename, size=None, range_size=None, range_hashes=None):
+        folder = os.path.join(upload_folder, PARTIAL_DIR)
+        os.makedirs(folder, exist_ok=True)
+
+        self.upload_id = upload_id
+        self.filename = filename
+        super().__init__(os.path.join(folder, f"{upload_id}.part"),
+                         os.path.join(folder, f"{upload_id}.json"),
+                         size, range_size, range_hashes, meta={'filename': filename})
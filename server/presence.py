@@ -0,0 +1,28 @@
+PRESENCE_WINDOW = 0.2  # Seconds of joins/leaves folded into one presence update
+
+
+class PresenceBatcher:
+    """Collects joins and leaves and hands over only their net effect.
+
+    The first change after a flush opens a window; everything recorded until
+    it closes goes out as one update. A user who drops and reconnects inside
+    the window (or joins and leaves again) produces no update at all.
+    """
+
+    def __init__(self, window=PRESENCE_WINDOW):
+        self.window = window
+        self._pending = {}  # username -> (present before the window, present now)
+
+    def record(self, username, joined):
+        """Note a join (joined=True) or leave. Returns True when this opens a new window."""
+        opens_window = not self._pending
+        before = self._pending[username][0] if username in self._pending else not joined
+        self._pending[username] = (before, joined)
+        return opens_window
+
+    def take(self):
+        """Return (added, removed) for the window that just closed and start afresh."""
+        pending, self._pending = self._pending, {}
+        added = [name for name, (before, now) in pending.items() if now and not before]
+        removed = [name for name, (before, now) in pending.items() if before and not now]
+        return added, removed
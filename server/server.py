@@ -4,77 +4,259 @@ import os
 import base64
 import eventlet
 import hashlib
+import threading
+import argparse
+from functools import wraps
 
-from flask import Flask, render_template_string
-from crypto_utils import load_rsa_private_key, decrypt_rsa, decrypt_aes, encrypt_aes
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+from flask import Flask, render_template_string, send_file, abort, jsonify
+from crypto_utils import is_legacy_ciphertext, forget_aes_key
+from crypto_pool import CryptoPool, CRYPTO_BACKEND
+from cluster import Cluster, BusManager
+from user_registry import UserRegistry
+from group_key import GroupKey
+from partial_uploads import PartialUpload, range_tree_root
+from blob_store import BlobStore
+from download_engine import DownloadEngine
+from message_bus import connect_bus
+from outbound import OutboundScheduler
+from presence import PresenceBatcher
+from message_store import (MessageStore, GLOBAL_CHANNEL, PRIVATE_CHANNEL, HISTORY_PAGE_SIZE,
+                           HISTORY_PAGE_MAX, SEARCH_PAGE_SIZE)
 
 # Add parent directory to path for module import
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from logs.db_logger import log_event
+from logs.db_logger import log_event, close_logger, start_log_stream, set_drop_policy
 
 # File
 UPLOAD_FOLDER = "upload_files"
 CHUNK_SIZE = 49152 # 48KB 
+RANGE_CHUNKS = 16 # Chunks per range for parallel downloads
+MAX_DOWNLOAD_STREAMS = 8
 os.makedirs(UPLOAD_FOLDER, exist_ok = True)
 
+# Chat history served to clients through fetch_history; in a cluster this
+# must be on the same shared storage as UPLOAD_FOLDER
+HISTORY_DB = "chat_history.db"
+
+# The hub is not monkey-patched, so a log call blocking on a full queue would
+# stall every greenlet; shed the oldest entries instead
+LOG_DROP_POLICY = "drop_oldest"
+
+# Seconds between sweeps of blobs that were stored but never linked to a filename
+BLOB_GC_INTERVAL = 3600
+
+# Opt-in: serve stored files over plain HTTP at /files/<filename>, with Range support
+HTTP_DOWNLOADS = False
+
+# Opt-in: encrypt each global message once under a shared, rotating group key
+# instead of once per connected user
+GROUP_KEY_BROADCAST = False
+
+# Simple landing page
+INDEX_HTML = '''
+<!DOCTYPE html>
+<html>
+<head><title>Chat</title></head>
+<body><h1>Secure Chat Server</h1></body>
+</html>
+'''
+
+# How the server is run: 'eventlet' (WSGI, socketio.Server) or 'asgi'
+# (asyncio, socketio.AsyncServer under uvicorn; see async_server.py)
+SERVER_MODE = "eventlet"
+HOST = "localhost"
+PORT = 8080
+
+# Opt-in scale-out: run several server processes sharing one message bus,
+# e.g. "tcp://localhost:6380" (python message_bus.py) or "redis://localhost:6379/0".
+# UPLOAD_FOLDER must then be shared storage, and clients need sticky sessions.
+BUS_URL = None
+
+# Push log rows live to `python logs/view_logs.py -f` over a Unix socket
+LOG_STREAM = True
+
+def page_arg(value, default, low, high):
+    """A paging argument from a client, clamped to [low, high]; default when missing or not a number."""
+    try:
+        value = int(value) if value else default
+    except (TypeError, ValueError):
+        value = default
+    return min(max(value, low), high)
+
 class ChatServer:
-    def __init__(self):
-        # Initialize Flask and Socket.IO
-        self.sio = socketio.Server()
-        self.app = Flask(__name__)
-        self.app.wsgi_app = socketio.WSGIApp(self.sio, self.app.wsgi_app)
+    crypto_pool_class = CryptoPool
+    outbound_class = OutboundScheduler
+
+    def __init__(self, group_key_broadcast=GROUP_KEY_BROADCAST, http_downloads=HTTP_DOWNLOADS,
+                 crypto_backend=CRYPTO_BACKEND, bus_url=BUS_URL, history_db=HISTORY_DB, log_stream=LOG_STREAM):
+        self.http_downloads = http_downloads
+        set_drop_policy(LOG_DROP_POLICY)
+        if log_stream:
+            start_log_stream()
+        self.bus = self.connect_bus(bus_url) if bus_url else None
+        self.setup_transport()
+        # Everything sent to one session goes through its prioritized outbound queues
+        self.outbound = self.outbound_class(self.sio)
 
         # In-memory state
-        self.users = []          # Connected users: list of {'sid', 'username', 'aes_key'}
+        self.users = UserRegistry()  # Connected users, indexed by sid and username
+        self._roster_seq = 0         # Bumped per presence update; clients use it to spot missed deltas
+        self.presence = PresenceBatcher()  # Joins/leaves are announced in batches
         self.aes_keys = {}       # Temporary AES key store: sid -> aes_key
-        self.private_key = load_rsa_private_key("private_key.pem")  # Load RSA private key
+        # RSA private key and all per-message crypto live behind a worker pool,
+        # so heavy decrypt/encrypt work does not stall the event loop
+        self.crypto = self.crypto_pool_class("private_key.pem", backend=crypto_backend)
+        # Shared user directory + node-to-node relay (None when running alone)
+        self.cluster = Cluster(self.bus, "private_key.pem") if self.bus else None
+
+        # Every global and private message, for fetch_history
+        self.history = MessageStore(history_db, "private_key.pem")
 
-        # File transfer
+        # Group key for broadcast mode (None when disabled)
+        self.group_key = GroupKey() if group_key_broadcast else None
+
+        # sid -> lock held while one of its messages is handled. Each event runs in its own
+        # green thread and crypto yields, so without it a later message could overtake an earlier one
+        self.message_locks = {}
+
+        # File transfer: (sid, filename, recipient, transfer_id) -> PartialUpload
         self.upload_files = {}
+        self.download_cancels = {}  # (sid, transfer_id) -> cancel flag of a download being sent
+        self.files = BlobStore(UPLOAD_FOLDER)  # Deduplicated storage of finished uploads
+        self.public_blobs = set()              # Digests of files sent to Global; anyone may link them
+        self.downloads = DownloadEngine()      # Cached digests + memory-mapped chunk reads
         
         self.setup_routes()
         self.register_events()
+        if self.cluster:
+            self.start_relay()
+        self.start_blob_gc()
+
+    def connect_bus(self, bus_url):
+        # Cooperative sockets: this server runs on an unpatched eventlet hub
+        return connect_bus(bus_url, green=True)
+
+    def setup_transport(self):
+        # Initialize Flask and Socket.IO; with a bus, rooms and broadcasts span all nodes
+        manager = BusManager(self.bus) if self.bus else None
+        self.sio = socketio.Server(client_manager=manager)
+        self.app = Flask(__name__)
+        self.app.wsgi_app = socketio.WSGIApp(self.sio, self.app.wsgi_app)
+
+    def start_relay(self):
+        self.sio.start_background_task(self.relay_loop)
+
+    def in_order(self, handler):
+        """Handle a session's events one at a time, in the order they arrived."""
+        @wraps(handler)
+        def ordered(sid, data):
+            lock = self.message_locks.setdefault(sid, Semaphore())
+            with lock:
+                return handler(sid, data)
+        return ordered
+
+    def start_blob_gc(self):
+        self.sio.start_background_task(self.blob_gc_loop)
+
+    def local_sids(self):
+        return [user.sid for user in self.users]
+
+    def broadcast(self, event, data):
+        # Every joined user, on this node and (clustered) on the others
+        self.outbound.send_all(self.local_sids(), event, data)
+        if self.cluster:
+            self.cluster.send(None, 'broadcast', event=event, data=data)
+
+    def roster(self):
+        return self.cluster.usernames() if self.cluster else self.users.usernames()
+
+    # --- Roster versioning ---
+    def roster_seq(self):
+        return self.cluster.roster_seq() if self.cluster else self._roster_seq
+
+    def next_roster_seq(self):
+        if self.cluster:
+            return self.cluster.next_roster_seq()
+        self._roster_seq += 1
+        return self._roster_seq
+
+    # --- Presence ---
+    def presence_changed(self, username, joined):
+        if self.presence.record(username, joined):
+            self.sio.start_background_task(self.flush_presence)
+
+    def flush_presence(self):
+        # One update for everything that changed during the window
+        self.sio.sleep(self.presence.window)
+        added, removed = self.presence.take()
+        if not added and not removed:
+            return
+        update = {'seq': self.next_roster_seq(), 'added': added, 'removed': removed, 'usernames': self.roster()}
+        log_event("server", "presence", f"Joined: {', '.join(added) or '-'}; Left: {', '.join(removed) or '-'}")
+
+        self.outbound.send_presence(self.local_sids(), update)
+        if self.cluster:
+            self.cluster.send(None, 'presence', update=update)
 
     def setup_routes(self):
         # Simple landing page
-        INDEX_HTML = '''
-        <!DOCTYPE html>
-        <html>
-        <head><title>Chat</title></head>
-        <body><h1>Secure Chat Server</h1></body>
-        </html>
-        '''
         @self.app.route('/')
         def index():
             return render_template_string(INDEX_HTML)
 
+        @self.app.route('/metrics')
+        def metrics():
+            # Outbound queue depths per session, plus scheduler counters
+            return jsonify(self.outbound.metrics())
+
+        if self.http_downloads:
+            @self.app.route('/files/<filename>')
+            def download_file(filename):
+                # Werkzeug answers Range requests and hands the open file to the
+                # server's wsgi.file_wrapper, which can use sendfile
+                path = self.resolve_file(filename)
+                if not path:
+                    abort(404)
+                return send_file(path, download_name=filename, conditional=True,
+                                 etag=self.file_digest(filename, path))
+
     def register_events(self):
         # --- Connection lifecycle ---
         @self.sio.event
         def connect(sid, environ):
+            self.outbound.open(sid)
             print(f"Client connected: {sid}")
-            log_event("server", "connect", f"Client {sid} connected.")
+            log_event("server", "connect", f"Client {sid} connected.", sid=sid)
 
         @self.sio.event
         def disconnect(sid):
             # Handle disconnect: remove user and notify others
-            username = None
-            for user in self.users:
-                if user['sid'] == sid:
-                    username = user['username']
-                    break
-            self.users = [user for user in self.users if user['sid'] != sid]
+            user = self.users.remove(sid)
+            username = user.username if user else None
             self.aes_keys.pop(sid, None)
-            usernames = [user['username'] for user in self.users]
+            if user and self.cluster:
+                self.cluster.release(user.username, sid)
+
+            if user and user.aes_key:
+                forget_aes_key(user.aes_key)
+            self.outbound.close(sid)
+            self.message_locks.pop(sid, None)
+
+            # Keep unfinished uploads on disk so the client can resume them later
+            for key in [key for key in self.upload_files if key[0] == sid]:
+                self.upload_files.pop(key).close()
+
+            if user:
+                self.rekey_group()
 
             if username:
                 print(f"User {username} disconnected ({sid})")
-                log_event("server", "disconnect", f"User {username} disconnected ({sid})")
-                self.sio.emit('user_left', {'username': username, 'usernames': usernames})
+                self.presence_changed(username, joined=False)
             else:
                 print(f"Client disconnected: {sid}")
-                log_event("server", "disconnect", f"Client disconnected: {sid}")
-                self.sio.emit('user_left', {'username': 'Unknown', 'usernames': usernames})
+                log_event("server", "disconnect", f"Client disconnected: {sid}", sid=sid)
 
         # --- Key exchange and user join/leave ---
         @self.sio.event
@@ -83,97 +265,181 @@ class ChatServer:
             encrypted_aes_b64 = data.get('encrypted_aes')
             encrypted_aes = base64.b64decode(encrypted_aes_b64.encode())
             try:
-                aes_key = decrypt_rsa(self.private_key, encrypted_aes)
+                aes_key = self.crypto.decrypt_rsa(encrypted_aes)
                 self.aes_keys[sid] = aes_key
                 print(f"[Key Exchange] AES key received for client {sid}")
-                log_event("server", "exchange_key", f"[Key Exchange] AES key received for client {sid}")
+                log_event("server", "exchange_key", f"[Key Exchange] AES key received for client {sid}", sid=sid)
             except Exception as e:
                 print(f"[Key Exchange] Failed: {e}")
-                log_event("server", "exchange_key_failed", f"[Key Exchange] Failed: {e}")
+                log_event("server", "exchange_key_failed", f"[Key Exchange] Failed: {e}", sid=sid)
 
         @self.sio.event
         def user_joined(sid, data):
             # Finalize user join by binding username with sid and AES key
             username = data.get('username', 'Unknown')
             aes_key = self.aes_keys.pop(sid, None)
-            self.users.append({'sid': sid, 'username': username, 'aes_key': aes_key})
-            usernames = [user['username'] for user in self.users]
+            if data.get('roster_deltas'):
+                self.outbound.use_roster_deltas(sid)
+            if self.cluster and not self.cluster.claim(username, sid):
+                # Lost a race with a join on another node; the client checked the roster first
+                print(f"Username {username} is already in use on another node")
+                log_event("server", "user_joined", f"Username '{username}' already claimed on another node (SID: {sid})",
+                          sid=sid, username=username)
+                self.aes_keys[sid] = aes_key  # The client may join again under another name
+                self.outbound.send(sid, 'join_rejected', {'username': username, 'reason': 'Username is already in use.'})
+                return
+            session = self.users.add(sid, username, aes_key)
             print(f"User {username} joined with session ID {sid}")
-            log_event("server", "user_joined", f"User '{username}' joined (SID: {sid})")
-            self.sio.emit('user_joined', {'username': username, 'usernames': usernames})
+            self.send_group_key(session)
+            self.presence_changed(username, joined=True)
 
         @self.sio.event
         def user_left(sid, data):
             # Remove user from list on leave event
             username = data.get('username', 'Unknown')
-            self.users[:] = [user for user in self.users if user['sid'] != sid]
-            usernames = [user['username'] for user in self.users]
+            user = self.users.remove(sid)
+            if user and self.cluster:
+                self.cluster.release(user.username, sid)
+            if user:
+                self.rekey_group()
+                self.presence_changed(user.username, joined=False)
             print(f"User {username} left with session ID {sid}")
-            log_event("server", "user_left", f"User {username} left with session ID {sid}")
-            self.sio.emit('user_left', {'username': username, 'usernames': usernames})
             self.aes_keys.pop(sid, None)
 
         # --- Messaging ---
         @self.sio.event
+        @self.in_order
         def global_message(sid, data):
             # Receive AES-encrypted global message, decrypt, re-encrypt for each user
             sender = data.get('sender', 'Anonymous')
             ciphertext = data.get('message', '')
-            sender_entry = next((u for u in self.users if u['sid'] == sid), None)
+            sender_entry = self.users.get_by_sid(sid)
 
             if not sender_entry:
                 print("Sender not found.")
-                log_event("server", "global_msg", "Sender not found.")
+                log_event("server", "global_msg", "Sender not found.", sid=sid)
                 return
+            sender = sender_entry.username  # Never the name the client claims
 
             try:
-                plaintext = decrypt_aes(sender_entry['aes_key'], ciphertext)
+                plaintext = self.crypto.decrypt_aes(sender_entry.aes_key, ciphertext)
+                sender_entry.legacy_cbc = is_legacy_ciphertext(ciphertext)
                 print(f"[GLOBAL] From {sender}: {ciphertext}")
-                log_event("server", "global_msg", f"[GLOBAL] From {sender}: {ciphertext}")
+                log_event("server", "global_msg", f"[GLOBAL] From {sender}: {ciphertext}", sid=sid, username=sender)
             except Exception as e:
                 print(f"Failed to decrypt sender's message: {e}")
-                log_event("server", "global_msg", f"Failed to decrypt sender's message: {e}")
+                log_event("server", "global_msg", f"Failed to decrypt sender's message: {e}", sid=sid, username=sender)
                 return
 
-            for user in self.users:
+            message_id = self.record_message(GLOBAL_CHANNEL, sender, None, plaintext=plaintext)
+            self.deliver_global(sender, plaintext, message_id)
+            if self.cluster:
+                # Other nodes re-encrypt for their own users
                 try:
-                    re_encrypted = encrypt_aes(user['aes_key'], plaintext)
-                    self.sio.emit('incoming_global_message', {'message': re_encrypted, 'sender': sender}, room=user['sid'])
+                    relayed = self.crypto.encrypt_aes(self.cluster.key, plaintext)
+                    self.cluster.send(None, 'global_message', sender=sender, message=relayed, id=message_id)
                 except Exception as e:
-                    print(f"Failed to re-encrypt for {user['username']}: {e}")
-                    log_event("server", "global_msg", f"Failed to re-encrypt for {user['username']}: {e}")
+                    print(f"Failed to relay global message: {e}")
+                    log_event("server", "global_msg", f"Failed to relay global message: {e}", sid=sid, username=sender)
 
         @self.sio.event
+        @self.in_order
         def private_message(sid, data):
             # Receive AES-encrypted private message, re-encrypt for specific recipient
             recipient_name = data.get('recipient', '')
             ciphertext = data.get('message', '')
             sender = data.get('sender', 'Anonymous')
 
-            sender_entry = next((u for u in self.users if u['sid'] == sid), None)
-            recipient_entry = next((u for u in self.users if u['username'] == recipient_name), None)
+            sender_entry = self.users.get_by_sid(sid)
+            recipient_entry = self.users.get_by_username(recipient_name)
+            location = None
+            if not recipient_entry and self.cluster:
+                location = self.cluster.locate(recipient_name)  # Connected to another node?
 
-            if not sender_entry or not recipient_entry:
+            if not sender_entry or not (recipient_entry or location):
                 print("Sender or recipient not found.")
-                log_event("server", "private_msg", "Sender or recipient not found.")
+                log_event("server", "private_msg", "Sender or recipient not found.", sid=sid, username=sender)
                 return
+            sender = sender_entry.username  # Never the name the client claims
 
             try:
-                plaintext = decrypt_aes(sender_entry['aes_key'], ciphertext)
+                sender_entry.legacy_cbc = is_legacy_ciphertext(ciphertext)
                 print(f"[PRIVATE] From {sender} to {recipient_name}: {ciphertext}")
-                log_event("server", "private_msg", f"[PRIVATE] From {sender} to {recipient_name}: {ciphertext}")
-                re_encrypted = encrypt_aes(recipient_entry['aes_key'], plaintext)
-                self.sio.emit('incoming_private_message', {'message': re_encrypted, 'sender': sender}, room=recipient_entry['sid'])
+                log_event("server", "private_msg", f"[PRIVATE] From {sender} to {recipient_name}: {ciphertext}", sid=sid, username=sender)
+                message_id = self.record_message(PRIVATE_CHANNEL, sender, recipient_name,
+                                                 ciphertext=ciphertext, aes_key=sender_entry.aes_key)
+                if not recipient_entry:
+                    # The recipient's node holds their key: hand the message over under the cluster key
+                    relayed = self.crypto.reencrypt(sender_entry.aes_key, ciphertext, self.cluster.key)
+                    self.cluster.send(location[0], 'private_message', sender=sender,
+                                      recipient=recipient_name, message=relayed, id=message_id)
+                    return
+                # Decrypt + re-encrypt in one worker dispatch
+                re_encrypted = self.crypto.reencrypt(sender_entry.aes_key, ciphertext,
+                                                     recipient_entry.aes_key, recipient_entry.legacy_cbc)
+                self.outbound.send(recipient_entry.sid, 'incoming_private_message',
+                                   {'message': re_encrypted, 'sender': sender, 'id': message_id})
             except Exception as e:
                 print(f"Failed private message forwarding: {e}")
-                log_event("server", "private_msg", f"Failed private message forwarding: {e}")
+                log_event("server", "private_msg", f"Failed private message forwarding: {e}", sid=sid, username=sender)
 
         # --- User info ---
         @self.sio.event
         def get_current_users(sid):
-            # Return current list of usernames
-            usernames = [user['username'] for user in self.users]
-            return {'current_usernames': usernames}
+            # Return current list of usernames; the seq is read first, so any
+            # delta after it is safe to apply on top of this snapshot
+            seq = self.roster_seq()
+            return {'current_usernames': self.roster(), 'seq': seq}
+
+        @self.sio.event
+        def fetch_history(sid, data=None):
+            # One page of older messages, newest first, encrypted under the caller's session key
+            user = self.users.get_by_sid(sid)
+            if not user:
+                return {'messages': [], 'has_more': False}
+            data = data or {}
+            limit = page_arg(data.get('limit'), HISTORY_PAGE_SIZE, 1, HISTORY_PAGE_MAX)
+            try:
+                rows, has_more = self.history.page(user.username, data.get('before_id'), limit)
+                results = self.crypto.reencrypt_many([(self.history.key, row['message'], user.aes_key, user.legacy_cbc)
+                                                      for row in rows])
+            except Exception as e:
+                print(f"Failed to load history for {user.username}: {e}")
+                log_event("server", "fetch_history_failed", f"Failed to load history for {user.username}: {e}",
+                          sid=sid, username=user.username)
+                return {'messages': [], 'has_more': False}
+
+            messages = []
+            for row, message in zip(rows, results):
+                if isinstance(message, Exception):
+                    log_event("server", "fetch_history_failed", f"Failed to re-encrypt message {row['id']}: {message}",
+                              sid=sid, username=user.username)
+                    continue
+                messages.append(dict(row, message=message))
+            return {'messages': messages, 'has_more': has_more}
+
+        @self.sio.event
+        def search_messages(sid, data=None):
+            # Ranked matches among global messages and the caller's own private ones
+            user = self.users.get_by_sid(sid)
+            data = data or {}
+            query = data.get('query', '')
+            if not user or not query:
+                return {'messages': [], 'has_more': False}
+            limit = page_arg(data.get('limit'), SEARCH_PAGE_SIZE, 1, HISTORY_PAGE_MAX)
+            offset = page_arg(data.get('offset'), 0, 0, sys.maxsize)
+            try:
+                rows, has_more = self.history.search(user.username, query, offset, limit)
+                results = self.crypto.reencrypt_many([(self.history.key, row['message'], user.aes_key, user.legacy_cbc)
+                                                      for row in rows])
+            except Exception as e:
+                print(f"Search failed for {user.username}: {e}")
+                log_event("server", "search_failed", f"Search failed for {user.username}: {e}", sid=sid, username=user.username)
+                return {'messages': [], 'has_more': False}
+
+            messages = [dict(row, message=message) for row, message in zip(rows, results)
+                        if not isinstance(message, Exception)]
+            return {'messages': messages, 'has_more': has_more}
         
         # --- File transfer: Public & Private ---
         @self.sio.event
@@ -181,24 +447,45 @@ class ChatServer:
             filename = data.get('filename', '')
             sender = data.get('sender', 'Anonymous')
             recipient = data.get('recipient', 'Global')
+            file_hash = data.get('file_hash')  # Sent up front by resumable clients
+            size = data.get('size')
+            range_size = data.get('range_size')      # Per-range hash tree for incremental verification
+            range_hashes = data.get('range_hashes')
+            transfer_id = data.get('transfer_id')    # Tells apart uploads of the same name; None from old clients
             
             if not recipient:
                 print("Recipient not found.")
-                log_event("server", "start_upload", "Recipient not found.")
+                log_event("server", "start_upload", "Recipient not found.", sid=sid, username=sender)
                 return
 
-            path = os.path.join(UPLOAD_FOLDER, filename)
+            upload_id = self.upload_id_for(sid, filename, recipient, file_hash)
+            if upload_id is None:
+                print("Sender not found.")
+                log_event("server", "start_upload", "Sender not found.", sid=sid, username=sender)
+                return
+
+            if range_hashes and range_tree_root(range_hashes) != data.get('range_root'):
+                log_event("server", "start_upload", f"Ignoring inconsistent range hashes for {filename}")
+                range_hashes = None
 
             try:
-                file = open(path, 'wb')
-                hash_algo = hashlib.sha256()
+                upload = PartialUpload(UPLOAD_FOLDER, upload_id, filename, size, range_size, range_hashes)
+                offset = upload.open(resume=bool(file_hash))
                 
                 # self.upload_files[(sid, filename, recipient)] = file  # Track the file by sid
-                self.upload_files[(sid, filename, recipient)] = {"file": file, 
-                                                                 "hash_compare": hash_algo}
+                self.upload_files[(sid, filename, recipient, transfer_id)] = upload
                 
-                print(f"[Upload from {sender} to Server] Start: {filename}")
-                log_event("server", "start_upload", f"Start upload: {filename} from {sender} to {recipient}")
+                if offset:
+                    print(f"[Upload from {sender} to Server] Resume: {filename} at byte {offset}")
+                    log_event("server", "start_upload", f"Resume upload: {filename} from {sender} to {recipient} at byte {offset}",
+                              sid=sid, username=sender)
+                else:
+                    print(f"[Upload from {sender} to Server] Start: {filename}")
+                    log_event("server", "start_upload", f"Start upload: {filename} from {sender} to {recipient}", sid=sid, username=sender)
+
+                # Ack tells the client it may send raw bytes, where to continue from
+                # and whether chunks may arrive out of order with per-range checks
+                return {'binary': True, 'offset': offset, 'ranges': bool(upload.range_size)}
             except Exception as e:
                 print(f"[start_upload] Failed to create file: {e}")
                 log_event("server", "start_upload", f"Failed to create file: {e}")
@@ -206,27 +493,38 @@ class ChatServer:
         # Send checks
         @self.sio.event
         def upload_chunk(sid, data):
-            # Decode the base64 to binary when server receives the chunks
-            chunk = base64.b64decode(data.get('chunk_data', None))
+            # Binary clients send raw bytes; older clients still send base64 strings
+            chunk = data.get('chunk_data', None)
+            if isinstance(chunk, str):
+                chunk = base64.b64decode(chunk)
             filename = data.get('filename', '')
             recipient = data.get('recipient', 'Global')
+            seq = data.get('seq')          # Window slot, echoed back in the ack
+            offset = data.get('offset')    # Byte position; missing for old clients
+            chunk_hash = data.get('chunk_hash')
             
-            file_info = self.upload_files.get((sid, filename, recipient))
-            if not file_info:
+            upload = self.upload_files.get((sid, filename, recipient, data.get('transfer_id')))
+            if not upload:
                 return
             
-            file = file_info['file']
-            hash_compare = file_info['hash_compare']
-            
-            if file:
-                try:
-                    file.write(chunk) # Write in the received file
-                    hash_compare.update(chunk)
-                    # print(f"[upload_chunk] Chunk received: {filename}")
-                    # file['content'].write(chuck)
-                except Exception as e:
-                    print(f"[upload_chunk] Failed to write chunk")
-                    log_event("server", "upload_chunk_failed", f"Failed to write chunk for {filename}: {e}")
+            try:
+                # Reject a corrupted chunk so only that chunk is resent
+                if chunk_hash and hashlib.sha256(chunk).hexdigest() != chunk_hash:
+                    log_event("server", "upload_chunk_failed", f"Chunk hash mismatch for {filename} at byte {offset}")
+                    return {'seq': seq, 'ok': False}
+
+                # Positional write; completing a range checks it against the hash tree
+                if not upload.write(chunk, offset):
+                    log_event("server", "upload_chunk_failed", f"Range hash mismatch for {filename} at byte {offset}")
+                    return {'seq': seq, 'ok': False, 'resend_range': True}
+                # print(f"[upload_chunk] Chunk received: {filename}")
+
+                # The ack returns a credit to the client's upload window
+                return {'seq': seq, 'ok': True}
+            except Exception as e:
+                print(f"[upload_chunk] Failed to write chunk")
+                log_event("server", "upload_chunk_failed", f"Failed to write chunk for {filename}: {e}")
+                return {'seq': seq, 'ok': False}
                     
         # Finish uploading file
         @self.sio.event
@@ -236,99 +534,356 @@ class ChatServer:
             recipient = data.get('recipient', 'Global')
             client_hash = data.get('hash_file', '')
             timestamp = data.get('time', '')
+            key = (sid, filename, recipient, data.get('transfer_id'))
                 
-            file_info = self.upload_files.get((sid, filename, recipient))
-            if not file_info:
+            upload = self.upload_files.get(key)
+            if not upload:
                 return
             
             try: 
-                file_info['file'].close()
-                computed_hash = file_info['hash_compare'].hexdigest()
+                computed_hash = upload.hexdigest()
                 
                 if computed_hash != client_hash:
                     print(f"[finish_upload] Hash mismatch: expected {client_hash}, got {computed_hash}")
                     log_event("server", "finish_upload_failed", f"Hash mismatch for {filename}")
                     
-                    # Construct full path to the file
-                    file_path = os.path.join(UPLOAD_FOLDER, filename)  # Replace UPLOAD_FOLDER with your actual directory variable
-                    
-                    # # Delete the failed file
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        print(f"[finish_upload] Deleted corrupt file: {file_path}")
-                        log_event("server", "delete_failed_upload_file", f"Deleted corrupt file: {file_path}")
+                    # Delete the failed partial file and its resume state
+                    upload.discard()
+                    print(f"[finish_upload] Deleted corrupt file: {upload.data_path}")
+                    log_event("server", "delete_failed_upload_file", f"Deleted corrupt file: {upload.data_path}")
                                     
                     self.sio.emit('retry_sending', {
                         'filename': filename,
-                        'sender': sender
+                        'sender': sender,
+                        'transfer_id': data.get('transfer_id')
                     })
                     return
                 
+                # Identical content already stored is simply replaced by the same bytes
+                upload.complete(self.files.blob_path(computed_hash))
+                stored_name = self.files.link(filename, computed_hash)
+                self.grant_blob(sid, computed_hash, recipient)
                 print(f"[Upload from {sender} to Server] Finished upload {filename}")
-                log_event("server", "finish_upload", f"Finished upload: {filename} from {sender} to {recipient} at {timestamp}")
+                log_event("server", "finish_upload", f"Finished upload: {filename} from {sender} to {recipient} at {timestamp}",
+                          sid=sid, username=sender)
                 
-                if recipient == "Global":
-                    for user in self.users:
-                        # Notify 'incoming_global_file' to all users
-                        # Global file
-                        self.sio.emit('incoming_global_file', {
-                                      'filename': filename,
-                                      'sender': sender,
-                                      'time': timestamp
-                        }, room=user['sid'])
-                else:
-                    recipient_entry = next((u for u in self.users if u['username'] == recipient), None)
-                    
-                    self.sio.emit('incoming_private_file', {
-                                  'filename': filename,
-                                  'sender': sender,
-                                  'time': timestamp
-                    }, room=recipient_entry['sid'])    
+                self.announce_file(stored_name, sender, recipient, timestamp)
                                 
             except Exception as e:
                 print(f"[finish_upload] Failed to finalize file")
                 log_event("server", "finish_upload_failed", f"Failed to finalize file {filename}: {e}")
             finally:
-                self.upload_files.pop((sid, filename, recipient), None)
+                self.upload_files.pop(key, None)
+
+        @self.sio.event
+        def cancel_upload(sid, data):
+            # Keep what arrived on disk, as on disconnect, so sending it again resumes
+            key = (sid, data.get('filename', ''), data.get('recipient', 'Global'), data.get('transfer_id'))
+            upload = self.upload_files.pop(key, None)
+            if upload:
+                upload.close()
+                log_event("server", "cancel_upload", f"Upload cancelled: {key[1]}", sid=sid)
                         
+        # --- Deduplication: skip uploading content the server already has ---
+        @self.sio.event
+        def check_file(sid, data):
+            return {'exists': self.may_link(sid, data.get('file_hash', ''))}
+
+        @self.sio.event
+        def link_file(sid, data):
+            # Publish an existing blob under a new filename, as if it had just been uploaded
+            filename = data.get('filename', '')
+            sender = data.get('sender', 'Anonymous')
+            recipient = data.get('recipient', 'Global')
+            file_hash = data.get('file_hash', '')
+            timestamp = data.get('time', '')
+
+            if not self.may_link(sid, file_hash):
+                print(f"[link_file] Unknown blob for {filename}")
+                log_event("server", "link_file_failed", f"Unknown blob {file_hash} for {filename}")
+                self.outbound.send(sid, 'retry_sending', {'filename': filename, 'sender': sender,
+                                                          'transfer_id': data.get('transfer_id')})
+                return
+
+            try:
+                stored_name = self.files.link(filename, file_hash)
+                self.grant_blob(sid, file_hash, recipient)
+                print(f"[Upload from {sender} to Server] Deduplicated {filename}")
+                log_event("server", "link_file", f"Linked existing blob: {filename} from {sender} to {recipient} at {timestamp}",
+                          sid=sid, username=sender)
+                self.announce_file(stored_name, sender, recipient, timestamp)
+            except Exception as e:
+                print(f"[link_file] Failed to link file")
+                log_event("server", "link_file_failed", f"Failed to link file {filename}: {e}")
+
         # --- Request download file --- 
         @self.sio.event
         def download_request(sid, data):
             filename = data.get('filename', '')
-            path = os.path.join(UPLOAD_FOLDER, filename)
-            hash_algo_download = hashlib.sha256()
+            binary = data.get('binary', False)  # Old clients only understand base64 chunks
+            offset = data.get('offset', 0)      # Resume point of a partial download
+            streams = data.get('streams', 1)    # Ranges sent concurrently, reassembled by offset
+            transfer_id = data.get('transfer_id')  # Echoed in every chunk; lets the client cancel
+            path = self.resolve_file(filename)
             
-            if not os.path.exists(path):
+            if not path:
                 print(f"[download_request] File not found: {filename}")
                 log_event("server", "download_request_failed", f"File not found: {filename}")
                 return
 
+            size = os.path.getsize(path)
+            if not isinstance(offset, int) or not 0 <= offset <= size:
+                offset = 0
+            if not isinstance(streams, int) or streams < 1:
+                streams = 1
+            streams = min(streams, MAX_DOWNLOAD_STREAMS)
+
             print(f"Start to downloading {filename}")
-            # Send chunks to receiver
-            def send_chunks():
+            lock = threading.Lock()
+            running = [streams]
+            cancelled = threading.Event()
+            if transfer_id is not None:
+                self.download_cancels[(sid, transfer_id)] = cancelled
+
+            # Send chunks to receiver; stream i sends every streams-th range of RANGE_CHUNKS chunks
+            def send_chunks(stream):
                 try:
-                    with open(path, 'rb') as file:
-                        while True:
-                            chunk = file.read(CHUNK_SIZE)
-                            if not chunk:
-                                break
-                            hash_algo_download.update(chunk)
-                            
-                            encoded_data = base64.b64encode(chunk).decode()
-                            self.sio.emit('incoming_file_chunk', {
-                                    'chunk_data': encoded_data,
-                                    'filename': filename}, 
-                                    room=sid)
-                            
-                    self.sio.emit('finish_download', {'filename': filename, 'hash_file': hash_algo_download.hexdigest()}, room=sid)
+                    for position, chunk in self.downloads.iter_chunks(path, CHUNK_SIZE, offset):
+                        if (position - offset) // (CHUNK_SIZE * RANGE_CHUNKS) % streams != stream:
+                            continue
+                        # Only queue more once this client has taken what is already queued
+                        if not self.outbound.wait_for_room(sid) or cancelled.is_set():
+                            return
+                        # Socket.IO only attaches real bytes objects, so that is the one copy made
+                        chunk_data = bytes(chunk) if binary else base64.b64encode(chunk).decode()
+                        self.outbound.send(sid, 'incoming_file_chunk', {
+                                'chunk_data': chunk_data,
+                                'filename': filename,
+                                'offset': position,
+                                'transfer_id': transfer_id})
                 except Exception as e:
                     print(f"[send_chunks] Failed to send file: {e}")
                     log_event("server", "send_chunks_failed", f"Failed to send file {filename}: {e}")
+                finally:
+                    with lock:
+                        running[0] -= 1
+                        last = running[0] == 0
+                    if last:
+                        self.download_cancels.pop((sid, transfer_id), None)
+                    if last and not cancelled.is_set():
+                        # Digest is known from the upload (or cached), so nothing is re-hashed here
+                        self.outbound.send(sid, 'finish_download', {'filename': filename, 'hash_file': self.file_digest(filename, path),
+                                                                    'transfer_id': transfer_id})
             
-            self.sio.start_background_task(send_chunks)
+            for stream in range(streams):
+                self.sio.start_background_task(send_chunks, stream)
+            # Lets the client show progress and an ETA
+            return {'size': size}
+
+        @self.sio.event
+        def cancel_download(sid, data):
+            cancelled = self.download_cancels.get((sid, data.get('transfer_id')))
+            if cancelled:
+                cancelled.set()
+                log_event("server", "cancel_download", f"Download cancelled: {data.get('filename', '')}", sid=sid)
+
+    # --- File lookup ---
+    def resolve_file(self, filename):
+        # Only plain names; files uploaded before the blob store existed live directly in UPLOAD_FOLDER
+        if not filename or filename != os.path.basename(filename):
+            return None
+        path = self.files.path_for(filename) or os.path.join(UPLOAD_FOLDER, filename)
+        return path if os.path.isfile(path) else None
+
+    def file_digest(self, filename, path):
+        return self.files.digest_for(filename) or self.downloads.digest(path)
+
+    # --- Blob access ---
+    def grant_blob(self, sid, digest, recipient):
+        """Let the uploader and the recipients of a file link its blob again."""
+        if recipient == "Global":
+            self.public_blobs.add(digest)
+        for session in (self.users.get_by_sid(sid), self.users.get_by_username(recipient)):
+            if session:
+                session.blobs.add(digest)
+
+    def may_link(self, sid, digest):
+        # Knowing a digest is not enough to publish its blob: the caller must have had the file
+        session = self.users.get_by_sid(sid)
+        if session is None or (digest not in self.public_blobs and digest not in session.blobs):
+            return False
+        return self.files.has(digest)
+
+    def collect_blobs(self):
+        try:
+            removed = self.files.collect_garbage()
+        except (OSError, ValueError) as e:
+            # An unreadable index must not make every blob look unreferenced
+            log_event("server", "blob_gc_failed", f"Blob garbage collection failed: {e}")
+            return
+        if removed:
+            log_event("server", "blob_gc", f"Removed {removed} unreferenced blobs")
+
+    def blob_gc_loop(self):
+        while True:
+            tpool.execute(self.collect_blobs)
+            self.sio.sleep(BLOB_GC_INTERVAL)
+
+    def upload_id_for(self, sid, filename, recipient, file_hash):
+        """Name of the partial file of an upload, or None if sid has not joined.
+
+        Keyed on the session's username, never on the sender the client claims,
+        so one user cannot resume into another's partial upload.
+        """
+        session = self.users.get_by_sid(sid)
+        if session is None:
+            return None
+        # Same user + same recipient + same content -> same partial file, so a retry picks up where it stopped
+        if file_hash:
+            return hashlib.sha256(f"{session.username}:{recipient}:{file_hash}".encode()).hexdigest()[:32]
+        return hashlib.sha256(f"{sid}:{filename}".encode()).hexdigest()[:32]
+
+    # --- File notifications ---
+    def announce_file(self, filename, sender, recipient, timestamp):
+        announcement = {'filename': filename, 'sender': sender, 'time': timestamp}
+        if recipient == "Global":
+            # Notify 'incoming_global_file' to all users
+            self.broadcast('incoming_global_file', announcement)
+        else:
+            recipient_entry = self.users.get_by_username(recipient)
+            if recipient_entry:
+                self.outbound.send(recipient_entry.sid, 'incoming_private_file', announcement)
+            else:
+                node_id, recipient_sid = self.cluster.locate(recipient)
+                self.cluster.send(node_id, 'direct', sid=recipient_sid, event='incoming_private_file', data=announcement)
+
+    # --- History ---
+    def record_message(self, channel, sender, recipient, plaintext=None, ciphertext=None, aes_key=None):
+        """Store a message (plaintext, or ciphertext under aes_key) in the history. Returns its id or None."""
+        try:
+            if plaintext is None:
+                plaintext = self.crypto.decrypt_aes(aes_key, ciphertext)
+            body = self.crypto.encrypt_aes(self.history.key, plaintext)
+            text = plaintext.split("|", 1)[-1]  # Clients send "HH:MM:SS|message"; only the message is indexed
+            return self.history.add(channel, sender, recipient, body, text)
+        except Exception as e:
+            print(f"Failed to store message from {sender}: {e}")
+            log_event("server", "history_failed", f"Failed to store message from {sender}: {e}", username=sender)
+            return None
+
+    # --- Global delivery (this node's users) ---
+    def deliver_global(self, sender, plaintext, message_id=None):
+        if self.group_key:
+            # Broadcast mode: one encryption, the same envelope queued for every session
+            try:
+                # Snapshot the epoch: a rekey may happen while the worker encrypts
+                epoch, group_key = self.group_key.epoch, self.group_key.key
+                message = self.crypto.encrypt_aes(group_key, plaintext)
+                # Group keys are per node, so this never goes over the bus. Queued per
+                # session (same payload object) so it cannot overtake the key itself
+                self.outbound.send_all(self.local_sids(), 'incoming_global_message',
+                                       {'epoch': epoch, 'message': message, 'sender': sender, 'id': message_id})
+            except Exception as e:
+                print(f"Failed to broadcast global message: {e}")
+                log_event("server", "global_msg", f"Failed to broadcast global message: {e}")
+            return
+
+        # All re-encryptions go to the pool in batches, then the emits happen here
+        users = list(self.users)
+        results = self.crypto.encrypt_many([(user.aes_key, plaintext, user.legacy_cbc) for user in users])
+        for user, re_encrypted in zip(users, results):
+            try:
+                if isinstance(re_encrypted, Exception):
+                    raise re_encrypted
+                self.outbound.send(user.sid, 'incoming_global_message',
+                                   {'message': re_encrypted, 'sender': sender, 'id': message_id})
+            except Exception as e:
+                print(f"Failed to re-encrypt for {user.username}: {e}")
+                log_event("server", "global_msg", f"Failed to re-encrypt for {user.username}: {e}", sid=user.sid, username=user.username)
+
+    # --- Cluster relay ---
+    def relay_loop(self):
+        for kind, fields in self.cluster.messages():
+            self.handle_relay(kind, fields)
+
+    def handle_relay(self, kind, fields):
+        # A message from another node; chat payloads are encrypted under the cluster key
+        try:
+            if kind == 'presence':
+                self.outbound.send_presence(self.local_sids(), fields['update'])
+                return
+            if kind == 'broadcast':
+                self.outbound.send_all(self.local_sids(), fields['event'], fields['data'])
+                return
+            if kind == 'direct':
+                self.outbound.send(fields['sid'], fields['event'], fields['data'])
+                return
+            plaintext = self.crypto.decrypt_aes(self.cluster.key, fields['message'])
+            if kind == 'global_message':
+                self.deliver_global(fields['sender'], plaintext, fields.get('id'))
+            elif kind == 'private_message':
+                recipient_entry = self.users.get_by_username(fields['recipient'])
+                if not recipient_entry:
+                    log_event("server", "private_msg", f"Relayed message for unknown user {fields['recipient']}")
+                    return
+                re_encrypted = self.crypto.encrypt_aes(recipient_entry.aes_key, plaintext, recipient_entry.legacy_cbc)
+                self.outbound.send(recipient_entry.sid, 'incoming_private_message',
+                                   {'message': re_encrypted, 'sender': fields['sender'], 'id': fields.get('id')})
+        except Exception as e:
+            print(f"[Cluster] Failed to handle relayed {kind}: {e}")
+            log_event("server", "cluster_relay_failed", f"Failed to handle relayed {kind}: {e}")
+
+    # --- Group key (broadcast mode) ---
+    def send_group_key(self, session):
+        # Hand the current group key to one user, wrapped in their session key
+        if not self.group_key or not session.aes_key:
+            return
+        try:
+            epoch = self.group_key.epoch
+            wrapped = self.crypto.encrypt_aes(session.aes_key, self.group_key.key_b64(), session.legacy_cbc)
+            self.outbound.send(session.sid, 'group_key', {'epoch': epoch, 'key': wrapped})
+        except Exception as e:
+            print(f"[Group Key] Failed to send key to {session.username}: {e}")
+            log_event("server", "group_key_failed", f"Failed to send group key to {session.username}: {e}")
+
+    def rekey_group(self):
+        # Someone left: rotate so they cannot read later broadcasts
+        if not self.group_key:
+            return
+        self.group_key.rotate()
+        epoch, key_b64 = self.group_key.epoch, self.group_key.key_b64()
+        log_event("server", "group_key", f"Group key rotated to epoch {epoch}")
+
+        sessions = [session for session in self.users if session.aes_key]
+        results = self.crypto.encrypt_many([(session.aes_key, key_b64, session.legacy_cbc) for session in sessions])
+        for session, wrapped in zip(sessions, results):
+            if isinstance(wrapped, Exception):
+                print(f"[Group Key] Failed to send key to {session.username}: {wrapped}")
+                log_event("server", "group_key_failed", f"Failed to send group key to {session.username}: {wrapped}")
+                continue
+            self.outbound.send(session.sid, 'group_key', {'epoch': epoch, 'key': wrapped})
         
 # --- Entry Point ---
+def parse_args():
+    parser = argparse.ArgumentParser(description="Secure chat server")
+    parser.add_argument('--mode', choices=("eventlet", "asgi"), default=SERVER_MODE,
+                        help="event loop to run on (default: %(default)s)")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--bus', default=BUS_URL, help="message bus URL for multi-process mode")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    server = ChatServer()
-    # server.app.run(port=8080, debug=True)
-    eventlet.wsgi.server(eventlet.listen(('localhost', 8080)), server.app)
\ No newline at end of file
+    args = parse_args()
+    if args.mode == "asgi":
+        from async_server import serve
+        serve(args.host, args.port, bus_url=args.bus)
+    else:
+        server = ChatServer(bus_url=args.bus)
+        # server.app.run(port=8080, debug=True)
+        try:
+            eventlet.wsgi.server(eventlet.listen((args.host, args.port)), server.app)
+        finally:
+            server.crypto.close()
+            server.history.close()
+            close_logger()  # Drain buffered log rows before exiting
@@ -0,0 +1,68 @@
+class UserSession:
+    """One connected user: socket id, chosen username and session AES key."""
+    __slots__ = ('sid', 'username', 'aes_key', 'legacy_cbc', 'blobs')
+
+    def __init__(self, sid, username, aes_key):
+        self.sid = sid
+        self.username = username
+        self.aes_key = aes_key
+        self.legacy_cbc = False  # Client still sends AES-CBC, so answer in kind
+        self.blobs = set()       # Digests of files this session uploaded or was sent; the only ones it may link
+
+    def __repr__(self):
+        return f"UserSession(sid={self.sid!r}, username={self.username!r})"
+
+
+class UserRegistry:
+    """Connected users indexed by sid and by username.
+
+    Lookups are O(1). The roster (usernames in join order) is an immutable tuple
+    cached between membership changes, so it can be handed to emit() safely and
+    repeated reads cost nothing.
+    """
+
+    def __init__(self):
+        self._by_sid = {}        # sid -> UserSession (insertion order == join order)
+        self._by_username = {}   # username -> UserSession
+        self._roster = None      # Cached tuple of usernames, None when stale
+
+    def add(self, sid, username, aes_key):
+        # Re-joining with the same sid replaces the previous entry
+        self.remove(sid)
+        session = UserSession(sid, username, aes_key)
+        self._by_sid[sid] = session
+        self._by_username[username] = session
+        self._roster = None
+        return session
+
+    def remove(self, sid):
+        session = self._by_sid.pop(sid, None)
+        if session is None:
+            return None
+        if self._by_username.get(session.username) is session:
+            del self._by_username[session.username]
+        self._roster = None
+        return session
+
+    def get_by_sid(self, sid):
+        return self._by_sid.get(sid)
+
+    def get_by_username(self, username):
+        return self._by_username.get(username)
+
+    def usernames(self):
+        if self._roster is None:
+            self._roster = tuple(session.username for session in self._by_sid.values())
+        return self._roster
+
+    def sessions(self):
+        return self._by_sid.values()
+
+    def __contains__(self, sid):
+        return sid in self._by_sid
+
+    def __iter__(self):
+        return iter(list(self._by_sid.values()))
+
+    def __len__(self):
+        return len(self._by_sid)